@@ -1,11 +1,43 @@
-"""Init"""
-from ._utils import draw_bounding_boxes, draw_landmarks,\
-                    draw_name, draw_fps
-from .detect import FaceDetection
-from .align import FaceAlignment
-from .represent import FaceRepresentation
-from .identify import FaceIdentification
+"""Init
+
+The classes and functions are imported from their submodules on first access (PEP 562), so that
+importing the package doesn't load MediaPipe, dlib, FAISS and OpenCV until a stage needs them.
+"""
+from typing import List
+import importlib
+
+# Public name -> submodule it's defined in
+_EXPORTS = {
+    "draw_bounding_boxes": "_utils", "draw_landmarks": "_utils", "draw_name": "_utils",
+    "draw_fps": "_utils", "landmarks_to_dlib": "_utils", "landmarks_from_dlib": "_utils",
+    "crop_box": "_utils", "crop_faces": "_utils",
+    "FaceDetection": "detect",
+    "FaceAlignment": "align",
+    "FaceRepresentation": "represent",
+    "FaceIdentification": "identify", "IdentityMatches": "identify", "RangeMatches": "identify",
+    "FaceGallery": "gallery",
+    "PrototypeIndex": "prototypes",
+    "FacePipeline": "pipeline", "FrameResult": "pipeline", "read_frames": "pipeline",
+    "FaceTracker": "tracker", "FaceTrack": "tracker"
+}
 
 __all__ = ["draw_bounding_boxes", "draw_landmarks", "draw_name",\
-           "draw_fps", "FaceDetection", "FaceAlignment", "FaceRepresentation",\
-           "FaceIdentification"]
+           "draw_fps", "landmarks_to_dlib", "landmarks_from_dlib", "crop_box", "crop_faces",\
+           "FaceDetection",\
+           "FaceAlignment", "FaceRepresentation", "FaceIdentification", "IdentityMatches",\
+           "RangeMatches", "FaceGallery", "PrototypeIndex",\
+           "FacePipeline", "FrameResult", "read_frames", "FaceTracker", "FaceTrack"]
+
+def __getattr__(
+        name:str
+    ):
+    """Imports a public name from its submodule on first access (and caches it)."""
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{module}", __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__() -> List[str]:
+    return sorted({*globals(), *__all__})
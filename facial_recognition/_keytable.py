@@ -0,0 +1,193 @@
+"""Memory-mapped Vector DB Key Table Functionality"""
+# pylint: disable=E1101,E0401,C0413
+from typing import List, Dict, Iterable, Iterator, Optional, Tuple, Union, Callable
+import os
+import mmap
+import struct
+import numpy as np
+
+KEY_TABLE_MAGIC = b'FRK1'
+# magic, keys, bytes of the keys, names, bytes of the names
+KEY_TABLE_HEADER = struct.Struct('<4s4xQQQQ')
+KEY_KIND_STR = 0
+KEY_KIND_INT = 1
+KEY_KIND_NONE = 2
+
+def _aligned(
+        size:int
+    ) -> int:
+    """Rounds a size up to a multiple of 8 bytes."""
+    return (size + 7) // 8 * 8
+
+def _string_table(
+        strings:List[bytes]
+    ) -> Tuple[np.ndarray, bytes]:
+    """Packs strings into their (n + 1) offsets and a single blob."""
+    offsets = np.zeros(len(strings) + 1, dtype='<i8')
+    np.cumsum([len(s) for s in strings], out=offsets[1:])
+    return offsets, b''.join(strings)
+
+def write_key_table(
+        vectorkeys:Iterable[Union[str,int,None]],
+        path:str,
+        key_name:Callable[[Union[str,int,None]], Optional[str]]
+    ) -> None:
+    """Writes the keys of the Vector DB as a key table, atomically.
+
+    The file holds the keys as a string table (offsets and a UTF-8 blob), the kind of each key
+    (str, int or None for a deleted row), and the label of the identity of each row along with
+    the table of the names of the labels, so that a gallery can be opened without parsing keys.
+
+    Args:
+        vectorkeys (Iterable[Union[str,int,None]]): The keys, one per row.
+        path (str): The path of the key table.
+        key_name (Callable[[Union[str,int,None]], Optional[str]]): Gets the name of a key.
+
+    Returns:
+        None
+    """
+    keys, kinds, labels = [], [], []
+    label_ids:Dict[str,int] = {}
+    for key in vectorkeys:
+        kinds.append(KEY_KIND_NONE if key is None else\
+                     KEY_KIND_INT if isinstance(key, (int, np.integer)) else KEY_KIND_STR)
+        keys.append(b'' if key is None else str(key).encode('utf-8'))
+        name = key_name(key)
+        labels.append(-1 if name is None else label_ids.setdefault(name, len(label_ids)))
+    key_offsets, key_blob = _string_table(keys)
+    name_offsets, name_blob = _string_table([name.encode('utf-8') for name in label_ids])
+    parts = [KEY_TABLE_HEADER.pack(KEY_TABLE_MAGIC, len(keys), len(key_blob), len(label_ids),\
+                                   len(name_blob)),
+             key_offsets.tobytes(), name_offsets.tobytes(),
+             np.array(labels, dtype='<i4').tobytes(), np.array(kinds, dtype='i1').tobytes(),
+             name_blob, key_blob]
+    with open(path + '.tmp', 'wb') as table_file:
+        for part in parts:
+            table_file.write(part)
+            table_file.write(b'\0' * (_aligned(len(part)) - len(part)))
+        table_file.flush()
+        os.fsync(table_file.fileno())
+    os.replace(path + '.tmp', path)
+
+class KeyTable:
+    """Class for the Keys of the Vector DB, backed by a Memory-mapped Key Table
+
+    Behaves like the list of keys (indexing, assignment, `extend`, iteration), but the keys of
+    the snapshot stay in the read-only mapped file, shared by every process that opens it, and
+    are only decoded when accessed. Keys added or deleted since the snapshot are kept in memory
+    until the next one.
+
+    Attributes:
+        base_len (int): The number of keys in the mapped file.
+        labels (np.ndarray): The (base_len,) int32 labels of the rows in the file (-1 for deleted).
+        label_names (List[str]): The names of the labels in the file.
+        changed (Dict[int,Union[str,int,None]]): The keys of the file that were replaced.
+    """
+    def __init__(
+            self,
+            path:str
+        ) -> None:
+        with open(path, 'rb') as table_file:
+            self._mmap = mmap.mmap(table_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n, _, n_names, names_len = KEY_TABLE_HEADER.unpack_from(self._mmap)
+        if magic != KEY_TABLE_MAGIC:
+            raise ValueError(f"`{path}` isn't a key table")
+        offset = KEY_TABLE_HEADER.size
+
+        def take(
+                dtype:str,
+                count:int
+            ) -> np.ndarray:
+            nonlocal offset
+            array = np.frombuffer(self._mmap, dtype=dtype, count=count, offset=offset)
+            offset += _aligned(array.nbytes)
+            return array
+
+        self._offsets = take('<i8', n + 1)
+        name_offsets = take('<i8', n_names + 1)
+        self.labels = take('<i4', n)
+        self._kinds = take('i1', n)
+        names = bytes(self._mmap[offset:offset + names_len])
+        offset += _aligned(names_len)
+        self._blob_start = offset
+        self.base_len = n
+        self.label_names = [names[start:end].decode('utf-8')\
+                            for start, end in zip(name_offsets[:-1].tolist(),\
+                                                  name_offsets[1:].tolist())]
+        self.changed:Dict[int,Union[str,int,None]] = {}
+        self._added:List[Union[str,int,None]] = []
+
+    def _base_key(
+            self,
+            i:int
+        ) -> Union[str,int,None]:
+        """Decodes a key of the mapped file."""
+        kind = self._kinds[i]
+        if kind == KEY_KIND_NONE:
+            return None
+        start, end = int(self._offsets[i]), int(self._offsets[i + 1])
+        key = self._mmap[self._blob_start + start:self._blob_start + end].decode('utf-8')
+        return int(key) if kind == KEY_KIND_INT else key
+
+    def __len__(self) -> int:
+        return self.base_len + len(self._added)
+
+    def __getitem__(
+            self,
+            i:int
+        ) -> Union[str,int,None]:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("key index out of range")
+        if i >= self.base_len:
+            return self._added[i - self.base_len]
+        if i in self.changed:
+            return self.changed[i]
+        return self._base_key(i)
+
+    def __setitem__(
+            self,
+            i:int,
+            key:Union[str,int,None]
+        ) -> None:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("key index out of range")
+        if i >= self.base_len:
+            self._added[i - self.base_len] = key
+        else:
+            self.changed[i] = key
+
+    def __iter__(self) -> Iterator[Union[str,int,None]]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def extend(
+            self,
+            keys:Iterable[Union[str,int,None]]
+        ) -> None:
+        """Appends keys.
+
+        Args:
+            keys (Iterable[Union[str,int,None]]): The keys to append.
+
+        Returns:
+            None
+        """
+        self._added.extend(keys)
+
+    def append(
+            self,
+            key:Union[str,int,None]
+        ) -> None:
+        """Appends a key.
+
+        Args:
+            key (Union[str,int,None]): The key to append.
+
+        Returns:
+            None
+        """
+        self._added.append(key)
@@ -0,0 +1,250 @@
+"""Vector DB Metadata Store (SQLite) Functionality"""
+# pylint: disable=E1101,E0401,C0413
+from typing import List, Dict, Optional, Tuple, Union, Sequence
+import time
+import sqlite3
+import threading
+from ._vectorlog import key_name
+
+METADATA_SCHEMA = """
+CREATE TABLE IF NOT EXISTS identities (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    created REAL
+);
+CREATE TABLE IF NOT EXISTS faces (
+    row INTEGER PRIMARY KEY,
+    identity INTEGER REFERENCES identities(id),
+    path TEXT,
+    enrolled REAL,
+    quality REAL,
+    deleted INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS faces_identity ON faces(identity, deleted);
+CREATE INDEX IF NOT EXISTS faces_deleted ON faces(deleted);
+"""
+# Seconds to wait for another process that holds the write lock of the database
+METADATA_TIMEOUT = 30.0
+
+class MetadataStore:
+    """Class for the Metadata of the Enrolled Faces, in SQLite
+
+    Holds an identity table (name, creation time) and a row per embedding of the gallery (its
+    identity, source path, enrollment time and quality score, and whether it was deleted), with an
+    index by identity, so that identities can be listed, counted, filtered and looked up by name
+    without loading every key. Writes are incremental (one transaction per enrollment or
+    deletion), and a deleted row stays deleted whatever order the writes of concurrent
+    enrollments and deletions (i.e. by different processes) reach the store in.
+
+    The snapshot and log of the gallery stay the source of truth: `sync` fills in the rows that
+    are missing from the store (i.e. enrolled by an older version, or before a crash), without
+    enrollment time or quality.
+    """
+    def __init__(
+            self,
+            path:str
+        ) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=METADATA_TIMEOUT, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(METADATA_SCHEMA)
+
+    def _identity_ids(
+            self,
+            names:Sequence[str],
+            now:float
+        ) -> Dict[str,int]:
+        """Gets the IDs of identities by name, creating the missing ones (within a transaction)."""
+        self.conn.executemany("INSERT OR IGNORE INTO identities (name, created) VALUES (?, ?)",\
+                              [(name, now) for name in set(names)])
+        ids = {}
+        for name in set(names):
+            ids[name] = self.conn.execute("SELECT id FROM identities WHERE name = ?",\
+                                          (name,)).fetchone()[0]
+        return ids
+
+    def add(
+            self,
+            start:int,
+            keys:List[Union[str,int,None]],
+            qualities:Optional[Sequence[Optional[float]]] = None,
+            enrolled:Optional[float] = None
+        ) -> None:
+        """Records the faces stored at consecutive rows of the gallery.
+
+        Args:
+            start (int): The row of the first face.
+            keys (List[Union[str,int,None]]): The keys of the faces (their identity is resolved
+                                              from them).
+            qualities (Optional[Sequence[Optional[float]]]): The quality score of each face.
+                                                             Defaults to None (unknown).
+            enrolled (Optional[float]): The enrollment time (`time.time()`). Defaults to None
+                                        (unknown).
+
+        Returns:
+            None
+        """
+        if qualities is None:
+            qualities = [None] * len(keys)
+        names = [key_name(key) for key in keys]
+        with self.lock, self.conn:
+            ids = self._identity_ids([name for name in names if name is not None], time.time())
+            self.conn.executemany(
+                "INSERT INTO faces (row, identity, path, enrolled, quality, deleted)"
+                " VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(row) DO UPDATE SET"
+                " identity = excluded.identity, path = excluded.path,"
+                " enrolled = excluded.enrolled, quality = excluded.quality,"
+                " deleted = MAX(deleted, excluded.deleted)",
+                [(start + i, ids.get(name),\
+                  key if isinstance(key, str) and '/' in key else None,\
+                  enrolled, quality, int(name is None))\
+                 for i, (key, name, quality) in enumerate(zip(keys, names, qualities))])
+
+    def delete(
+            self,
+            name:str,
+            rows:Sequence[int]
+        ) -> None:
+        """Marks faces of an identity as deleted (even if their enrollment isn't in the store yet).
+
+        Args:
+            name (str): The name of the identity.
+            rows (Sequence[int]): The rows of the faces.
+
+        Returns:
+            None
+        """
+        with self.lock, self.conn:
+            identity = self._identity_ids([name], time.time())[name]
+            self.conn.executemany(
+                "INSERT INTO faces (row, identity, deleted) VALUES (?, ?, 1)"
+                " ON CONFLICT(row) DO UPDATE SET deleted = 1",
+                [(int(row), identity) for row in rows])
+
+    def rows(
+            self,
+            name:str
+        ) -> List[int]:
+        """Lists the rows of the faces enrolled for an identity.
+
+        Args:
+            name (str): The name of the identity.
+
+        Returns:
+            List[int]: The rows of the faces (not deleted) of the identity, in order.
+        """
+        with self.lock:
+            return [row for row, in self.conn.execute(
+                "SELECT row FROM faces JOIN identities ON identities.id = faces.identity"
+                " WHERE name = ? AND deleted = 0 ORDER BY row", (name,))]
+
+    @property
+    def num_rows(self) -> int:
+        """int: The number of rows of the gallery recorded in the store."""
+        with self.lock:
+            return self.conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM faces").fetchone()[0]
+
+    def sync(
+            self,
+            vectorkeys:Sequence[Union[str,int,None]],
+            deleted:Sequence[int]
+        ) -> None:
+        """Brings the store in line with the keys of the gallery (i.e. after a migration, a crash
+           or enrollments by another process).
+
+        Args:
+            vectorkeys (Sequence[Union[str,int,None]]): The keys of the gallery.
+            deleted (Sequence[int]): The deleted rows of the gallery.
+
+        Returns:
+            None
+        """
+        start = self.num_rows
+        if start > len(vectorkeys):
+            # the gallery was rebuilt from scratch
+            with self.lock, self.conn:
+                self.conn.execute("DELETE FROM faces")
+            start = 0
+        if start < len(vectorkeys):
+            keys = [vectorkeys[row] for row in range(start, len(vectorkeys))]
+            self.add(start, keys)
+        with self.lock, self.conn:
+            num_deleted = self.conn.execute("SELECT COUNT(*) FROM faces WHERE deleted = 1")\
+                                   .fetchone()[0]
+            if num_deleted != len(deleted):
+                self.conn.executemany("UPDATE faces SET deleted = 1 WHERE row = ?",\
+                                      [(row,) for row in deleted])
+
+    def count(
+            self,
+            name:str
+        ) -> int:
+        """Counts the faces enrolled for an identity.
+
+        Args:
+            name (str): The name of the identity.
+
+        Returns:
+            int: The number of faces (not deleted) of the identity.
+        """
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM faces JOIN identities ON identities.id = faces.identity"
+                " WHERE name = ? AND deleted = 0", (name,)).fetchone()[0]
+
+    def identities(self) -> List[Tuple[str, int]]:
+        """Lists the identities that have faces enrolled.
+
+        Returns:
+            List[Tuple[str, int]]: The name and number of faces of each identity, by name.
+        """
+        with self.lock:
+            return self.conn.execute(
+                "SELECT name, COUNT(*) FROM faces JOIN identities ON identities.id = faces.identity"
+                " WHERE deleted = 0 GROUP BY identity ORDER BY name").fetchall()
+
+    def faces(
+            self,
+            name:Optional[str] = None,
+            since:Optional[float] = None,
+            min_quality:Optional[float] = None
+        ) -> List[Dict]:
+        """Lists the enrolled faces, optionally filtered.
+
+        Args:
+            name (Optional[str]): Only the faces of this identity. Defaults to None (all).
+            since (Optional[float]): Only the faces enrolled since this time (`time.time()`).
+                                     Defaults to None.
+            min_quality (Optional[float]): Only the faces with at least this quality score.
+                                           Defaults to None.
+
+        Returns:
+            List[Dict]: The row, name, path, enrollment time and quality of each face, by row.
+        """
+        query = "SELECT row, name, path, enrolled, quality FROM faces JOIN identities"\
+                " ON identities.id = faces.identity WHERE deleted = 0"
+        params = []
+        if name is not None:
+            query += " AND name = ?"
+            params.append(name)
+        if since is not None:
+            query += " AND enrolled >= ?"
+            params.append(since)
+        if min_quality is not None:
+            query += " AND quality >= ?"
+            params.append(min_quality)
+        with self.lock:
+            cursor = self.conn.execute(query + " ORDER BY row", params)
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, values)) for values in cursor.fetchall()]
+
+    def close(self) -> None:
+        """Closes the database.
+
+        Returns:
+            None
+        """
+        with self.lock:
+            self.conn.close()
@@ -1,10 +1,12 @@
 """Utility Functions"""
 # pylint: disable=E1101,E0401,C0413
-from typing import List
+from typing import List, Tuple, Union, Optional
 import cv2
 import dlib
 import numpy as np
 
+CROP_PADDING = 0.35
+
 def draw_bounding_boxes(
         frame:np.ndarray,
         faces:List[dlib.rectangle]
@@ -30,13 +32,16 @@ def draw_bounding_boxes(
 
 def draw_landmarks(
         frame:np.ndarray,
-        landmarks:List[dlib.point]
+        landmarks:Union[List[dlib.full_object_detection], np.ndarray]
     ) -> None:
     """Draws landmarks on the given frame.
 
     Args:
         frame (np.ndarray): The frame on which the landmarks will be drawn.
-        landmarks (List[dlib.point]): The list of landmarks to be drawn.
+        landmarks (Union[List[dlib.full_object_detection], np.ndarray]): The landmarks to be
+                                                                         drawn, as dlib shapes or
+                                                                         as a (n_faces, n_points,
+                                                                         2) array.
 
     Returns:
         None
@@ -46,6 +51,10 @@ def draw_landmarks(
         the frame.
         The circle is filled with green color and has a radius of 2 pixels.
     """
+    if isinstance(landmarks, np.ndarray):
+        for x, y in np.rint(landmarks).astype('int32').reshape(-1, 2).tolist():
+            cv2.circle(frame, (x, y), 2, (0, 255, 0), -1)
+        return
     for landmark in landmarks:
         for i in range(landmark.num_parts):
             x = landmark.part(i).x
@@ -94,3 +103,153 @@ def draw_fps(
     fps = 1 / delta
     cv2.putText(frame, f"FPS: {fps :02.1f}", (30, 30),\
                 cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 0), 2)
+
+def rect_iou(
+        a:dlib.rectangle,
+        b:dlib.rectangle
+    ) -> float:
+    """Computes the intersection over union of two rectangles.
+
+    Args:
+        a (dlib.rectangle): The first rectangle.
+        b (dlib.rectangle): The second rectangle.
+
+    Returns:
+        float: The intersection over union, between 0 and 1.
+    """
+    # dlib rectangles include their right and bottom edges (like `width` and `height`)
+    w = min(a.right(), b.right()) - max(a.left(), b.left()) + 1
+    h = min(a.bottom(), b.bottom()) - max(a.top(), b.top()) + 1
+    if w <= 0 or h <= 0:
+        return 0.0
+    inter = w * h
+    union = a.width() * a.height() + b.width() * b.height() - inter
+    return inter / union if union > 0 else 0.0
+
+def match_rectangles(
+        rects_a:List[dlib.rectangle],
+        rects_b:List[dlib.rectangle],
+        min_iou:float = 0.0
+    ) -> List[Tuple[int, int]]:
+    """Greedily matches two lists of rectangles by their overlap, best matches first.
+
+    Args:
+        rects_a (List[dlib.rectangle]): The first list of rectangles.
+        rects_b (List[dlib.rectangle]): The second list of rectangles.
+        min_iou (float): The minimum intersection over union of a match (exclusive). Defaults
+                         to 0.
+
+    Returns:
+        List[Tuple[int, int]]: The (index in `rects_a`, index in `rects_b`) pairs matched, each
+                               index at most once.
+    """
+    pairs = sorted(((rect_iou(a, b), i, j) for i, a in enumerate(rects_a)\
+                    for j, b in enumerate(rects_b)), reverse=True)
+    matches, matched_a, matched_b = [], set(), set()
+    for iou, i, j in pairs:
+        if iou <= min_iou:
+            break
+        if i in matched_a or j in matched_b:
+            continue
+        matches.append((i, j))
+        matched_a.add(i)
+        matched_b.add(j)
+    return matches
+
+def landmarks_to_dlib(
+        landmarks:np.ndarray,
+        faces:Optional[List[dlib.rectangle]] = None
+    ) -> List[dlib.full_object_detection]:
+    """Converts a landmark array to dlib shapes (i.e. right before the recognizer needs them).
+
+    Args:
+        landmarks (np.ndarray): The (n_faces, n_points, 2) landmark coordinates.
+        faces (Optional[List[dlib.rectangle]]): The rectangle of each face. Defaults to None (the
+                                                bounding box of its landmarks).
+
+    Returns:
+        List[dlib.full_object_detection]: The dlib shape of each face.
+    """
+    landmarks = np.rint(landmarks).astype('int32')
+    if faces is None:
+        faces = [dlib.rectangle(*points.min(axis=0).tolist(), *points.max(axis=0).tolist())\
+                 for points in landmarks]
+    # dlib has no constructor from an array of points, mapping the coordinate lists is the
+    # cheapest way to build them
+    return [dlib.full_object_detection(face, list(map(dlib.point, *points.T.tolist())))\
+            for face, points in zip(faces, landmarks)]
+
+def landmarks_from_dlib(
+        landmarks:List[dlib.full_object_detection]
+    ) -> np.ndarray:
+    """Converts dlib shapes to a landmark array.
+
+    Args:
+        landmarks (List[dlib.full_object_detection]): The dlib shape of each face (with the same
+                                                      number of points).
+
+    Returns:
+        np.ndarray: The (n_faces, n_points, 2) int32 landmark coordinates.
+    """
+    if len(landmarks) == 0:
+        return np.empty((0, 0, 2), dtype='int32')
+    return np.array([[(p.x, p.y) for p in landmark.parts()] for landmark in landmarks],\
+                    dtype='int32')
+
+def crop_box(
+        face:dlib.rectangle,
+        img_shape:Tuple[int, ...],
+        padding:float = CROP_PADDING
+    ) -> Tuple[int, int, int, int]:
+    """Computes the square box of a padded crop around a face (clipped to the image).
+
+    Args:
+        face (dlib.rectangle): The face to crop.
+        img_shape (Tuple[int, ...]): The shape of the image (height, width, ...).
+        padding (float): The padding factor around the face (its larger side, half on each side).
+                         Defaults to CROP_PADDING.
+
+    Returns:
+        Tuple[int, int, int, int]: The crop box [x1, y1, x2, y2] (x2 and y2 exclusive).
+    """
+    mh, mw = img_shape[0], img_shape[1]
+    x, y, w, h = face.left(), face.top(), face.width(), face.height()
+    wh = max(w, h)
+    ow = max(0, int(x - (wh * (padding/2)))) + int(wh * (1 + padding)) - mw
+    oh = max(0, int(y - (wh * (padding/2)))) + int(wh * (1 + padding)) - mh
+    if ow > 0 or oh > 0:
+        pad = (max(ow, oh) / wh) * 2
+    else:
+        pad = padding
+    shift = wh * (pad/2)
+    whp = int(wh * (1 + pad))
+    x1, y1 = max(0, int(-shift + x)), max(0, int(-shift + y))
+    x2, y2 = min(mw, x1 + whp), min(mh, y1 + whp)
+    return x1, y1, x2, y2
+
+def crop_faces(
+        img:np.ndarray,
+        faces:List[dlib.rectangle],
+        padding:Optional[float] = CROP_PADDING
+    ) -> List[np.ndarray]:
+    """Crop faces from an image.
+
+    Args:
+        img (numpy.ndarray): The input image.
+        faces (List[dlib.rectangle]): A list of face objects detected in the image.
+        padding (Optional[float]): The padding factor to apply when cropping the faces. Defaults
+                                   to CROP_PADDING.
+
+    Returns:
+        list: A list of cropped face images.
+
+    Example:
+        img = cv2.imread('image.jpg')
+        faces = detect_faces(img)
+        cropped_faces = crop_faces(img, faces)
+    """
+    cropped_faces = []
+    for face in faces:
+        x1, y1, x2, y2 = crop_box(face, img.shape, padding)
+        cropped_faces.append(img[y1:y2, x1:x2])
+    return cropped_faces
@@ -0,0 +1,202 @@
+"""Vector DB Index Factory Functionality"""
+# pylint: disable=E1101,E0401,C0413
+from typing import Literal, Optional
+import math
+import faiss
+import numpy as np
+
+INDEX_TYPES = ('flat', 'ivf', 'hnsw', 'ivfpq')
+HNSW_M = 32
+PQ_M = 16
+PQ_NBITS = 8
+# FAISS warns below 39 training points per centroid
+IVF_MIN_POINTS_PER_LIST = 39
+
+def ivf_nlist(
+        num_records:int
+    ) -> int:
+    """Get the number of inverted lists for an IVF index of a given size (~4*sqrt(n)).
+
+    Args:
+        num_records (int): The number of embeddings the index is trained on.
+
+    Returns:
+        int: The number of inverted lists.
+    """
+    return max(1, min(int(4 * math.sqrt(num_records)), num_records // IVF_MIN_POINTS_PER_LIST))
+
+def index_factory_string(
+        index_type:Literal['flat', 'ivf', 'hnsw', 'ivfpq'],
+        dimensions:int,
+        num_records:int
+    ) -> str:
+    """Get the FAISS index factory string of an index type.
+
+    Args:
+        index_type (Literal['flat', 'ivf', 'hnsw', 'ivfpq']): The type of index.
+        dimensions (int): The dimensions of the embeddings.
+        num_records (int): The number of embeddings the index is trained on.
+
+    Returns:
+        str: The index factory string.
+
+    Raises:
+        ValueError: If the index type isn't one of `INDEX_TYPES`.
+    """
+    if index_type == 'flat':
+        return 'Flat'
+    if index_type == 'ivf':
+        return f"IVF{ivf_nlist(num_records)},Flat"
+    if index_type == 'hnsw':
+        return f"HNSW{HNSW_M}"
+    if index_type == 'ivfpq':
+        pq_m = PQ_M if dimensions % PQ_M == 0 else 8
+        return f"IVF{ivf_nlist(num_records)},PQ{pq_m}x{PQ_NBITS}"
+    raise ValueError(f"Unknown index type `{index_type}`, must be one of {INDEX_TYPES}")
+
+def min_training_records(
+        index_type:Literal['flat', 'ivf', 'hnsw', 'ivfpq']
+    ) -> int:
+    """Get the minimum number of embeddings needed to train an index type.
+
+    Args:
+        index_type (Literal['flat', 'ivf', 'hnsw', 'ivfpq']): The type of index.
+
+    Returns:
+        int: The minimum number of embeddings (0 if it doesn't need training).
+    """
+    if index_type == 'ivf':
+        return 2 * IVF_MIN_POINTS_PER_LIST
+    if index_type == 'ivfpq':
+        return max(2 * IVF_MIN_POINTS_PER_LIST, 2 ** PQ_NBITS)
+    return 0
+
+def index_type_of(
+        index:faiss.Index
+    ) -> str:
+    """Get the type of an index.
+
+    Args:
+        index (faiss.Index): The index.
+
+    Returns:
+        str: One of `INDEX_TYPES` (or the class name of the index if it's none of them).
+    """
+    if isinstance(index, faiss.IndexFlat):
+        return 'flat'
+    if isinstance(index, faiss.IndexHNSW):
+        return 'hnsw'
+    if isinstance(index, faiss.IndexIVFPQ):
+        return 'ivfpq'
+    if isinstance(index, faiss.IndexIVFFlat):
+        return 'ivf'
+    return type(index).__name__
+
+def prepare_index(
+        index:faiss.Index
+    ) -> faiss.Index:
+    """Prepares an index that was just created or read for use by the gallery.
+
+    IVF indexes get a direct map so that their embeddings can be reconstructed by row.
+
+    Args:
+        index (faiss.Index): The index.
+
+    Returns:
+        faiss.Index: The index.
+    """
+    if isinstance(index, faiss.IndexIVF):
+        index.make_direct_map()
+    return index
+
+def own_index(
+        index:faiss.Index
+    ) -> faiss.Index:
+    """Copies an index into memory owned by the process.
+
+    Indexes read with `IO_FLAG_MMAP_IFC` only view their (read-only, shared) file, and FAISS
+    aborts the process when adding to them, so they must be copied before the first write.
+
+    Args:
+        index (faiss.Index): The index.
+
+    Returns:
+        faiss.Index: The copy of the index.
+    """
+    return prepare_index(faiss.deserialize_index(faiss.serialize_index(index)))
+
+def build_index(
+        index_type:Literal['flat', 'ivf', 'hnsw', 'ivfpq'],
+        metric:Literal['euclidean', 'cosine'],
+        embeddings:np.ndarray
+    ) -> faiss.Index:
+    """Builds an index of a given type, training it on and adding the given embeddings.
+
+    Args:
+        index_type (Literal['flat', 'ivf', 'hnsw', 'ivfpq']): The type of index.
+        metric (Literal['euclidean', 'cosine']): The metric of the index.
+        embeddings (np.ndarray): The (n, dimensions) float32 embeddings.
+
+    Returns:
+        faiss.Index: The trained index containing the embeddings.
+    """
+    embeddings = np.ascontiguousarray(embeddings, dtype='float32')
+    num_records, dimensions = embeddings.shape
+    faiss_metric = faiss.METRIC_L2 if metric == 'euclidean' else faiss.METRIC_INNER_PRODUCT
+    index = faiss.index_factory(dimensions, index_factory_string(index_type, dimensions,\
+                                                                 num_records), faiss_metric)
+    if isinstance(index, faiss.IndexIVFPQ):
+        # the codes are never compared by Hamming distance (`polysemous_ht` stays 0), and the
+        # polysemous training takes far longer than training the quantizers
+        index.do_polysemous_training = False
+    if not index.is_trained:
+        index.train(embeddings)
+    index = prepare_index(index)
+    index.add(embeddings)
+    return index
+
+def reconstruct_all(
+        index:faiss.Index
+    ) -> np.ndarray:
+    """Reconstructs every embedding stored in an index (approximately for PQ indexes).
+
+    Args:
+        index (faiss.Index): The index.
+
+    Returns:
+        np.ndarray: The (ntotal, dimensions) float32 embeddings.
+    """
+    if index.ntotal == 0:
+        return np.empty((0, index.d), dtype='float32')
+    return index.reconstruct_n(0, index.ntotal)
+
+def search_parameters(
+        index:faiss.Index,
+        sel:Optional[faiss.IDSelector] = None,
+        nprobe:Optional[int] = None,
+        ef_search:Optional[int] = None
+    ) -> Optional[faiss.SearchParameters]:
+    """Builds the search parameters for an index.
+
+    Args:
+        index (faiss.Index): The index.
+        sel (Optional[faiss.IDSelector]): The selector of rows to search. Defaults to None (all).
+        nprobe (Optional[int]): The number of inverted lists to visit (IVF indexes). Defaults to
+                                None (the index's own setting).
+        ef_search (Optional[int]): The size of the candidate list (HNSW indexes). Defaults to None
+                                   (the index's own setting).
+
+    Returns:
+        Optional[faiss.SearchParameters]: The search parameters (None if there are none to set).
+    """
+    if isinstance(index, faiss.IndexIVF) and nprobe is not None:
+        params = faiss.SearchParametersIVF(nprobe=nprobe)
+    elif isinstance(index, faiss.IndexHNSW) and ef_search is not None:
+        params = faiss.SearchParametersHNSW(efSearch=ef_search)
+    elif sel is not None:
+        params = faiss.SearchParameters()
+    else:
+        return None
+    if sel is not None:
+        params.sel = sel
+    return params
@@ -0,0 +1,421 @@
+"""Append-only Vector DB Log Functionality"""
+# pylint: disable=E1101,E0401,C0413
+from typing import List, Tuple, Iterator, Optional, Union
+import os
+import json
+import zlib
+import struct
+import threading
+try:
+    import fcntl
+except ImportError:
+    # without flock (i.e. on Windows), writers are only serialized within a process
+    fcntl = None
+import faiss
+import numpy as np
+from ._keytable import KeyTable, write_key_table
+from ._vectorindex import own_index
+
+SEGMENT_PREFIX = 'segment_'
+SEGMENT_SUFFIX = '.log'
+RECORD_MAGIC = b'FRL1'
+RECORD_OP_ADD = b'A'
+RECORD_OP_DELETE = b'D'
+# magic, op, start row, rows, dimensions, keys length, crc32 of the payload
+RECORD_HEADER = struct.Struct('<4scQIIII')
+# Keys used to be pickled, next to where the key table is now
+LEGACY_KEYS_SUFFIX = '.pkl'
+# Lock files of the log, held by the process appending to (or rotating) it and by the process
+# writing a snapshot out of it
+LOG_LOCK_NAME = 'LOCK'
+COMPACTION_LOCK_NAME = 'COMPACTION_LOCK'
+
+class SegmentRemoved(RuntimeError):
+    """Raised when segments that weren't read yet were merged into a snapshot and removed by
+       another process (the snapshot must be read again)."""
+
+class FileLock:
+    """Class for a Re-entrant Lock held across the threads of a process and across processes
+       (an exclusive `flock` on a file)"""
+    def __init__(
+            self,
+            path:str
+        ) -> None:
+        self.path = path
+        self.lock = threading.RLock()
+        self._file = None
+        self._depth = 0
+
+    def __enter__(self) -> None:
+        self.lock.acquire()
+        if self._depth == 0 and fcntl is not None:
+            if self._file is None:
+                self._file = open(self.path, 'ab')
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        self._depth += 1
+
+    def __exit__(self, *exc_info) -> None:
+        self._depth -= 1
+        if self._depth == 0 and fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self.lock.release()
+
+class VectorLog:
+    """Class for an Append-only Log of Vector DB Enrollments (aka Write-Ahead Log)
+
+    Every enrollment is appended as one record to the active segment file and fsync'd, so the
+    cost of adding faces doesn't depend on the size of the gallery. Segments are sealed with
+    `rotate` and removed with `remove` once a snapshot containing them has been written.
+
+    Many processes can append to the same log: they hold `lock` (an `flock`) to append or
+    rotate, and first read the records appended by the others since their `position` with
+    `read_new`, so that the start row of each record accounts for every record before it. The
+    active segment is always the last one on disk, so a process never appends to a segment that
+    another process sealed.
+    """
+    def __init__(
+            self,
+            log_dir:str
+        ) -> None:
+        self.log_dir = log_dir
+        self.lock = FileLock(os.path.join(log_dir, LOG_LOCK_NAME))
+        self.compaction_lock = FileLock(os.path.join(log_dir, COMPACTION_LOCK_NAME))
+        self.pending_records = 0
+        os.makedirs(log_dir, exist_ok=True)
+        segments = self.segments()
+        if segments:
+            self.active_seq = self._segment_seq(segments[-1])
+        else:
+            self.active_seq = 1
+        # (segment, offset) right after the last record read or appended by this process
+        self.position = (self.active_seq if not segments else self._segment_seq(segments[0]), 0)
+        self._file = None
+
+    def _segment_path(
+            self,
+            seq:int
+        ) -> str:
+        return os.path.join(self.log_dir, f"{SEGMENT_PREFIX}{seq:08d}{SEGMENT_SUFFIX}")
+
+    @staticmethod
+    def _segment_seq(
+            path:str
+        ) -> int:
+        return int(os.path.basename(path)[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+
+    def segments(self) -> List[str]:
+        """Lists the segment files of the log in the order they were written.
+
+        Returns:
+            List[str]: The paths of the segment files.
+        """
+        files = [f for f in os.listdir(self.log_dir)\
+                 if f.startswith(SEGMENT_PREFIX) and f.endswith(SEGMENT_SUFFIX)]
+        return [os.path.join(self.log_dir, f) for f in sorted(files)]
+
+    def append(
+            self,
+            start:int,
+            embeddings:np.ndarray,
+            ids:List[Union[str,int]],
+            op:bytes = RECORD_OP_ADD
+        ) -> None:
+        """Appends embeddings and their IDs to the active segment and fsyncs it.
+
+        To append to a log shared with other processes, hold `lock` and call `read_new` first so
+        that `start` accounts for the records they appended.
+
+        Args:
+            start (int): The row in the Vector DB where the first embedding is stored (for a
+                         delete, the number of rows at the time of the delete).
+            embeddings (np.ndarray): The (n, dimensions) float32 embeddings (none for a delete).
+            ids (List[Union[str,int]]): The IDs associated with the embeddings (for a delete, the
+                                        names, or single keys, being deleted).
+            op (bytes): The operation, `RECORD_OP_ADD` or `RECORD_OP_DELETE`. Defaults to
+                        `RECORD_OP_ADD`.
+
+        Returns:
+            None
+        """
+        payload = np.ascontiguousarray(embeddings, dtype='float32').tobytes()
+        keys = json.dumps(ids).encode('utf-8')
+        crc = zlib.crc32(keys, zlib.crc32(payload))
+        header = RECORD_HEADER.pack(RECORD_MAGIC, op, start, embeddings.shape[0],\
+                                    embeddings.shape[1], len(keys), crc)
+        with self.lock:
+            segments = self.segments()
+            active_seq = self._segment_seq(segments[-1]) if segments else self.active_seq
+            if self._file is None or active_seq != self.active_seq:
+                # another process rotated the log since the last append
+                self.close()
+                self.active_seq = active_seq
+                self._file = open(self._segment_path(self.active_seq), 'ab')
+            self._file.write(header + payload + keys)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.position = (self.active_seq, self._file.tell())
+            self.pending_records += embeddings.shape[0]
+
+    def rotate(self) -> List[str]:
+        """Seals the active segment so that new records go to a fresh one.
+
+        The new (empty) active segment is created right away, so that the other processes
+        appending to the log switch to it. Call `read_new` first when the log is shared.
+
+        Returns:
+            List[str]: The paths of all sealed segments (every segment but the new active one).
+        """
+        with self.lock:
+            self.close()
+            sealed = self.segments()
+            if sealed:
+                self.active_seq = self._segment_seq(sealed[-1]) + 1
+            open(self._segment_path(self.active_seq), 'ab').close()
+            self.position = (self.active_seq, 0)
+            self.pending_records = 0
+            return sealed
+
+    def remove(
+            self,
+            paths:List[str]
+        ) -> None:
+        """Removes sealed segments (after they have been merged into a snapshot).
+
+        The segments are removed while holding `lock`, so a process that reads the snapshot and
+        then replays the log while holding it never misses the records in between.
+
+        Args:
+            paths (List[str]): The paths of the segments to remove.
+
+        Returns:
+            None
+        """
+        with self.lock:
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def replay(
+            self,
+            repair:bool = False
+        ) -> Iterator[Tuple[bytes, int, np.ndarray, List[Union[str,int]]]]:
+        """Reads back every record in the log in the order they were written.
+
+        A torn record at the tail of a segment (i.e. a crash during `append`) ends the replay of
+        that segment.
+
+        Args:
+            repair (bool): Whether to truncate torn records away, only while holding `lock`.
+                           Defaults to False.
+
+        Returns:
+            Iterator[Tuple[bytes, int, np.ndarray, List[Union[str,int]]]]: The operation, start
+                                                                           row, embeddings and
+                                                                           IDs of each record.
+        """
+        for path in self.segments():
+            yield from self._read_segment(path, 0, repair)
+
+    def read_new(self) -> List[Tuple[bytes, int, np.ndarray, List[Union[str,int]]]]:
+        """Reads the records appended (i.e. by other processes) since the last record this process
+           read or appended.
+
+        Must be called while holding `lock`, so no record is being written and a torn record at
+        the tail of a segment is left by a crash: it's truncated away.
+
+        Returns:
+            List[Tuple[bytes, int, np.ndarray, List[Union[str,int]]]]: The operation, start row,
+                                                                       embeddings and IDs of
+                                                                       each new record.
+
+        Raises:
+            SegmentRemoved: If segments that weren't read yet were compacted and removed.
+        """
+        segments = self.segments()
+        position_seq, offset = self.position
+        if segments and self._segment_seq(segments[0]) > position_seq:
+            raise SegmentRemoved(f"Segment {position_seq} of `{self.log_dir}` was compacted")
+        records = []
+        for path in segments:
+            seq = self._segment_seq(path)
+            if seq >= position_seq:
+                records.extend(self._read_segment(path, offset if seq == position_seq else 0,\
+                                                  repair=True))
+        return records
+
+    def _read_segment(
+            self,
+            path:str,
+            offset:int,
+            repair:bool
+        ) -> Iterator[Tuple[bytes, int, np.ndarray, List[Union[str,int]]]]:
+        """Reads the records of a segment from an offset, advancing `position` past each one."""
+        seq = self._segment_seq(path)
+        good_offset = offset
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            self.position = (seq, offset)
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                magic, op, start, rows, dims, keys_len, crc = RECORD_HEADER.unpack(header)
+                if magic != RECORD_MAGIC:
+                    break
+                payload = f.read(rows * dims * 4)
+                keys = f.read(keys_len)
+                if len(payload) < rows * dims * 4 or len(keys) < keys_len or\
+                   zlib.crc32(keys, zlib.crc32(payload)) != crc:
+                    break
+                good_offset = f.tell()
+                self.position = (seq, good_offset)
+                self.pending_records += rows
+                embeddings = np.frombuffer(payload, dtype='float32').reshape(rows, dims)
+                yield op, start, embeddings, json.loads(keys.decode('utf-8'))
+        if repair and good_offset < os.path.getsize(path):
+            with open(path, 'r+b') as f:
+                f.truncate(good_offset)
+
+    def close(self) -> None:
+        """Closes the active segment file.
+
+        Returns:
+            None
+        """
+        with self.lock.lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+def key_name(
+        key:Union[str,int,None]
+    ) -> Optional[str]:
+    """Get the name of the identity a key in the Vector DB belongs to.
+
+    Args:
+        key (Union[str,int,None]): The key, either a path like `/name/img_face0.jpg`, a name, or
+                                   None for a deleted row.
+
+    Returns:
+        Optional[str]: The name of the identity (None for a deleted row).
+    """
+    if key is None:
+        return None
+    key = str(key)
+    if '/' in key:
+        return os.path.basename(os.path.dirname(key))
+    return key
+
+def legacy_keys_path(
+        keys_path:str
+    ) -> str:
+    """Get the path the keys were pickled to before they were stored as a key table.
+
+    Args:
+        keys_path (str): The path of the key table.
+
+    Returns:
+        str: The path of the pickled keys.
+    """
+    return os.path.splitext(keys_path)[0] + LEGACY_KEYS_SUFFIX
+
+def replay_vectordb(
+        vectordb:faiss.Index,
+        vectorkeys:List[Union[str,int]],
+        log:VectorLog,
+        repair:bool = False,
+        mmapped:bool = False
+    ) -> Optional[faiss.Index]:
+    """Replays the log on top of a snapshot of the Vector DB, in place.
+
+    Records that are already part of the snapshot (by start row) are skipped, which is checked for
+    the index and the keys independently. Deletes (of names, or of single keys) replace the keys of
+    the deleted rows with None (tombstones), the vectors stay in the index.
+
+    Args:
+        vectordb (faiss.Index): The snapshot of the index.
+        vectorkeys (List[Union[str,int]]): The snapshot of the keys.
+        log (VectorLog): The log to replay.
+        repair (bool): Whether to truncate torn records away. Defaults to False.
+        mmapped (bool): Whether the index was read with mmap, so it must be copied before
+                        adding to it. Defaults to False.
+
+    Returns:
+        Optional[faiss.Index]: The index (a copy if it was memory-mapped and records had to be
+                               added to it).
+    """
+    for op, start, embeddings, ids in log.replay(repair):
+        if op == RECORD_OP_DELETE:
+            deleted = set(ids)
+            for row in range(min(start, len(vectorkeys))):
+                if vectorkeys[row] in deleted or key_name(vectorkeys[row]) in deleted:
+                    vectorkeys[row] = None
+            continue
+        end = start + embeddings.shape[0]
+        if vectordb is not None and vectordb.ntotal < end:
+            if mmapped:
+                vectordb, mmapped = own_index(vectordb), False
+            vectordb.add(embeddings[vectordb.ntotal - start:])
+        if len(vectorkeys) < end:
+            vectorkeys.extend(ids[len(vectorkeys) - start:])
+    return vectordb
+
+def write_snapshot(
+        vectordb:faiss.Index,
+        vectorkeys:List[Union[str,int]],
+        db_path:str,
+        keys_path:str
+    ) -> None:
+    """Writes a snapshot of the Vector DB atomically (write to a temporary file and replace).
+
+    Args:
+        vectordb (faiss.Index): The index to write.
+        vectorkeys (List[Union[str,int]]): The keys to write.
+        db_path (str): The path of the index file.
+        keys_path (str): The path of the key table.
+
+    Returns:
+        None
+    """
+    write_key_table(vectorkeys, keys_path, key_name)
+    faiss.write_index(vectordb, db_path + '.tmp')
+    os.replace(db_path + '.tmp', db_path)
+
+def read_vectordb(
+        db_path:Optional[str],
+        keys_path:str,
+        log_dir:Optional[str] = None,
+        mmap:bool = False
+    ) -> Tuple[Optional[faiss.Index], List[Union[str,int]]]:
+    """Reads the last snapshot of the Vector DB and replays the log on top of it.
+
+    With `mmap`, the vectors (of flat and HNSW indexes) and the keys are mapped rather than read,
+    so that opening the snapshot is near-instant and processes opening the same snapshot share its
+    pages. The index is then read-only until it's copied with `own_index`. Keys pickled by older
+    versions are read (in full) when there's no key table yet.
+
+    Args:
+        db_path (Optional[str]): The path of the index file. None to only read the keys.
+        keys_path (str): The path of the key table.
+        log_dir (Optional[str]): The directory of the log segments. Defaults to None (no log).
+        mmap (bool): Whether to map the snapshot instead of reading it. Defaults to False.
+
+    Returns:
+        Tuple[Optional[faiss.Index], List[Union[str,int]]]: The index (None if there's no
+                                                            snapshot) and the keys (a `KeyTable`
+                                                            with `mmap`).
+    """
+    vectordb = None
+    if db_path is not None and os.path.exists(db_path):
+        vectordb = faiss.read_index(db_path, faiss.IO_FLAG_MMAP_IFC if mmap else 0)
+    if os.path.exists(keys_path):
+        vectorkeys = KeyTable(keys_path) if mmap else list(KeyTable(keys_path))
+    elif os.path.exists(legacy_keys_path(keys_path)):
+        # only needed to read galleries pickled by older versions, and slow to import
+        import joblib  # pylint: disable=C0415
+        vectorkeys = joblib.load(legacy_keys_path(keys_path))
+    else:
+        vectorkeys = []
+    if log_dir is not None and os.path.isdir(log_dir):
+        vectordb = replay_vectordb(vectordb, vectorkeys, VectorLog(log_dir), mmapped=mmap)
+    return vectordb, vectorkeys
@@ -1,11 +1,15 @@
 """Align Faces Functionality"""
 # pylint: disable=E1101,E0401,C0413
-from typing import List
+from typing import List, Tuple
 import dlib
 import numpy as np
 import mediapipe as mp
+from ._utils import match_rectangles, landmarks_to_dlib, crop_box, CROP_PADDING
+from .metrics import timed
 
 MP_LANDMARK_SUBSET = 'large'
+MP_STATIC_IMAGE_MODE = True
+MP_MAX_NUM_FACES = 1
 SUBSET_68_IDXS = [127, 234, 93, 215, 172, 136, 150, 176, 152, 400, 379,\
                 365, 367, 433, 366, 447, 372, 70, 63, 105, 66, 107, 336,\
                 296, 334, 293, 276, 168, 197, 195, 4, 240, 97, 2, 326,\
@@ -13,17 +17,141 @@ SUBSET_68_IDXS = [127, 234, 93, 215, 172, 136, 150, 176, 152, 400, 379,\
                 380, 61, 39, 37, 11, 267, 269, 291, 321, 314, 17, 85, 181,\
                 78, 82, 13, 402, 308, 402, 14, 87]
 SUBSET_5_IDXS = [249, 362, 33, 155, 2]
+# Top, bottom, left and right extremes of the face oval, for the bounding box of a mesh
+MESH_OUTLINE_IDXS = [10, 152, 234, 454]
+
+def mesh_rect(
+        mesh:np.ndarray
+    ) -> dlib.rectangle:
+    """Gets the bounding box of a face mesh.
+
+    Args:
+        mesh (np.ndarray): The (p, 2) pixel coordinates of the mesh.
+
+    Returns:
+        dlib.rectangle: The bounding box.
+    """
+    x1, y1 = np.rint(mesh.min(axis=0)).astype(int).tolist()
+    x2, y2 = np.rint(mesh.max(axis=0)).astype(int).tolist()
+    return dlib.rectangle(x1, y1, x2, y2)
 
 class FaceAlignment:
-    """Class for Face Alignment (aka Landmark Predition)"""
+    """Class for Face Alignment (aka Landmark Predition)
+
+    With `static_image_mode` every image is processed independently (a full face detection and
+    mesh each time), which suits unrelated images. Without it, MediaPipe tracks the meshes from one
+    frame to the next and only detects faces again when it loses them, which is much faster on
+    video, so it should be used for consecutive frames of a single source. Up to `max_num_faces`
+    faces are aligned (one by default, more for frames with several faces).
+
+    With `roi`, the mesh only runs on a crop around each face (padded by `roi_padding`) instead of
+    on the whole image, which is much cheaper on high resolution frames. Crops of different faces
+    can't be tracked from one frame to the next, so it's always in static image mode.
+
+    The MediaPipe model is only loaded on first use.
+    """
     def __init__(
             self,
-            landmark_subset = MP_LANDMARK_SUBSET
+            landmark_subset = MP_LANDMARK_SUBSET,
+            static_image_mode:bool = MP_STATIC_IMAGE_MODE,
+            max_num_faces:int = MP_MAX_NUM_FACES,
+            roi:bool = False,
+            roi_padding:float = CROP_PADDING
         ) -> None:
         self.landmark_subset = landmark_subset
-        mp_face_mesh = mp.solutions.face_mesh
-        self.predictor = mp_face_mesh.FaceMesh(static_image_mode=True, max_num_faces=1,\
-                                            refine_landmarks=True, min_detection_confidence=0.5)
+        self.static_image_mode = static_image_mode or roi
+        self.max_num_faces = max_num_faces
+        self.roi = roi
+        self.roi_padding = roi_padding
+        self._predictor = None
+
+    @property
+    def predictor(self):
+        """mp.solutions.face_mesh.FaceMesh: The MediaPipe face mesh, loaded on first use."""
+        if self._predictor is None:
+            mp_face_mesh = mp.solutions.face_mesh
+            self._predictor = mp_face_mesh.FaceMesh(static_image_mode=self.static_image_mode,\
+                                                    max_num_faces=self.max_num_faces,\
+                                                    refine_landmarks=True,\
+                                                    min_detection_confidence=0.5)
+        return self._predictor
+
+    @property
+    def subset_idxs(self) -> List[int]:
+        """List[int]: The indexes of the MediaPipe landmarks in `landmark_subset`."""
+        if self.landmark_subset == 'large':
+            return SUBSET_68_IDXS
+        if self.landmark_subset == 'small':
+            return SUBSET_5_IDXS
+        return [*range(0, 468)]
+
+    def align_array(
+            self,
+            img_rgb:np.ndarray,
+            faces:List[dlib.rectangle]
+        ) -> Tuple[List[dlib.rectangle], np.ndarray]:
+        """Aligns the landmarks of detected faces in an image, as a NumPy array.
+
+        The landmarks of each face are taken from the MediaPipe mesh with a single fancy index,
+        without building any dlib object (see `landmarks_to_dlib` for when they're needed).
+
+        Args:
+            img_rgb (np.ndarray): The input RGB image.
+            faces (List[dlib.rectangle]): The list of detected face rectangles.
+
+        Returns:
+            Tuple[List[dlib.rectangle], np.ndarray]: The faces that have landmarks (in the order of
+                                                     `faces`) and their (n_faces, n_points, 2)
+                                                     int32 landmark coordinates.
+
+        Note:
+            The meshes found by MediaPipe are matched to `faces` by the overlap of their bounding
+            boxes, since they aren't found in the same order.
+        """
+        subset_idxs = self.subset_idxs
+        # only the landmarks of the subset (and the outline, for matching) are converted
+        mesh_idxs = subset_idxs + MESH_OUTLINE_IDXS
+        if self.roi:
+            matched_faces, meshes = [], []
+            for face in faces:
+                x1, y1, x2, y2 = crop_box(face, img_rgb.shape, self.roi_padding)
+                if x2 <= x1 or y2 <= y1:
+                    continue
+                crop_meshes = [mesh + (x1, y1) for mesh in\
+                               self._meshes(np.ascontiguousarray(img_rgb[y1:y2, x1:x2]),\
+                                            mesh_idxs)]
+                matches = match_rectangles([face], [mesh_rect(mesh) for mesh in crop_meshes])
+                if matches:
+                    matched_faces.append(face)
+                    meshes.append(crop_meshes[matches[0][1]])
+        else:
+            all_meshes = self._meshes(img_rgb, mesh_idxs)
+            matches = sorted(match_rectangles(faces, [mesh_rect(mesh) for mesh in all_meshes]))
+            matched_faces = [faces[f] for f, _ in matches]
+            meshes = [all_meshes[m] for _, m in matches]
+        if not meshes:
+            return [], np.empty((0, len(subset_idxs), 2), dtype='int32')
+        landmarks = np.stack(meshes)[:, :len(subset_idxs)]
+        return matched_faces, np.rint(landmarks).astype('int32')
+
+    def _meshes(
+            self,
+            img_rgb:np.ndarray,
+            idxs:List[int]
+        ) -> List[np.ndarray]:
+        """Runs the mesh on an image and returns the (len(idxs), 2) pixel coordinates of the
+           landmarks `idxs` of each face."""
+        with timed('align'):
+            raw_landmarks = self.predictor.process(img_rgb)
+        if not raw_landmarks.multi_face_landmarks:
+            return []
+        h, w, _ = img_rgb.shape
+        meshes = []
+        for face_landmarks in raw_landmarks.multi_face_landmarks:
+            points = face_landmarks.landmark
+            mesh = np.array([points[i].x for i in idxs] + [points[i].y for i in idxs])
+            meshes.append(mesh.reshape(2, -1).T * (w, h))
+        return meshes
 
     def align(
             self,
@@ -37,7 +165,9 @@ class FaceAlignment:
             faces (List[dlib.rectangle]): The list of detected face rectangles.
 
         Returns:
-            List[dlib.full_object_detection]: The list of aligned face landmarks.
+            List[dlib.full_object_detection]: The list of aligned face landmarks, in the order of
+                                              `faces`. Each rectangle is the face it was matched
+                                              to, and faces without landmarks are left out.
 
         Raises:
             None
@@ -51,28 +181,11 @@ class FaceAlignment:
               subset.
             - If `landmark_subset` is set to any other value, the function uses the full 468-point
               landmark subset.
+            - The meshes found by MediaPipe are matched to `faces` by the overlap of their
+              bounding boxes, since they aren't found in the same order.
 
         Example:
             align(img_rgb, faces)
         """
-
-        if self.landmark_subset == 'large':
-            subset_idxs = SUBSET_68_IDXS
-        elif self.landmark_subset == 'small':
-            subset_idxs = SUBSET_5_IDXS
-        else:
-            subset_idxs = [*range(0, 468)]
-
-        raw_landmarks = self.predictor.process(img_rgb)
-        h, w, _ = img_rgb.shape
-        dlib_landmarks = []
-        if raw_landmarks.multi_face_landmarks:
-            for f, face_landmarks in enumerate(raw_landmarks.multi_face_landmarks):
-                dlib_parts = []
-                for p in subset_idxs:
-                    pt = face_landmarks.landmark[p]
-                    dlib_parts.append(dlib.point(round(pt.x*w), round(pt.y*h)))
-                dlib_fod = dlib.full_object_detection(rect=faces[f], parts=dlib_parts)
-                dlib_landmarks.append(dlib_fod)
-
-        return dlib_landmarks
+        faces, landmarks = self.align_array(img_rgb, faces)
+        return landmarks_to_dlib(landmarks, faces)
@@ -0,0 +1,206 @@
+"""Cache Recent Descriptors and Identification Results Functionality"""
+# pylint: disable=E1101,E0401,C0413
+from typing import Any, Dict, Optional, Set, Hashable
+import time
+import threading
+from collections import OrderedDict
+import cv2
+import dlib
+import numpy as np
+
+CACHE_MAX_SIZE = 1024
+CACHE_TTL = 5.0
+HASH_CHIP_SIZE = 32
+# Mean absolute difference (in gray levels) between two chips with the same hash below which
+# they're taken for the same face, so a hash collision between two faces isn't mistaken for one
+HASH_CHIP_MAX_DIFF = 8.0
+
+def face_chip(
+        img_rgb:np.ndarray,
+        landmarks:dlib.full_object_detection
+    ) -> np.ndarray:
+    """Extracts the small aligned grayscale crop (chip) of a face that its hash is computed on.
+
+    Args:
+        img_rgb (np.ndarray): The RGB image containing the face.
+        landmarks (dlib.full_object_detection): The facial landmarks of the face.
+
+    Returns:
+        np.ndarray: The (HASH_CHIP_SIZE, HASH_CHIP_SIZE) uint8 chip.
+    """
+    chip = dlib.get_face_chip(img_rgb, landmarks, size=HASH_CHIP_SIZE)
+    return cv2.cvtColor(chip, cv2.COLOR_RGB2GRAY)
+
+def chip_hash(
+        chip:np.ndarray
+    ) -> str:
+    """Computes the perceptual hash (dHash) of a face chip.
+
+    Args:
+        chip (np.ndarray): The grayscale chip of the face (see `face_chip`).
+
+    Returns:
+        str: The 64-bit hash as 16 hexadecimal characters.
+    """
+    small = cv2.resize(chip, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return f"{int(np.packbits(bits).view('>u8')[0]):016x}"
+
+def face_hash(
+        img_rgb:np.ndarray,
+        landmarks:dlib.full_object_detection
+    ) -> str:
+    """Computes a perceptual hash (dHash) of the aligned crop of a face.
+
+    Near-duplicate crops of a face (i.e. the same face in consecutive webcam frames) get the same
+    hash, so it can be used as a cache key for its descriptor and identity. Different faces can
+    get the same hash too, so a cached entry should only be reused once `same_chip` confirms it.
+
+    Args:
+        img_rgb (np.ndarray): The RGB image containing the face.
+        landmarks (dlib.full_object_detection): The facial landmarks of the face.
+
+    Returns:
+        str: The 64-bit hash as 16 hexadecimal characters.
+    """
+    return chip_hash(face_chip(img_rgb, landmarks))
+
+def same_chip(
+        chip:np.ndarray,
+        other:np.ndarray,
+        max_diff:float = HASH_CHIP_MAX_DIFF
+    ) -> bool:
+    """Checks whether two face chips are near-duplicates, pixel by pixel.
+
+    Args:
+        chip (np.ndarray): The grayscale chip of a face.
+        other (np.ndarray): The grayscale chip of another face.
+        max_diff (float): The maximum mean absolute difference, in gray levels. Defaults to
+                          `HASH_CHIP_MAX_DIFF`.
+
+    Returns:
+        bool: Whether the chips are near-duplicates.
+    """
+    return float(np.abs(chip.astype('int16') - other.astype('int16')).mean()) <= max_diff
+
+class ResultCache:
+    """Class for a Thread-safe LRU Cache with Expiring Entries
+
+    Entries can be tagged (i.e. with the name of the identity in a result) so that every entry
+    with a tag can be invalidated at once (i.e. when that identity is enrolled again). Hits,
+    misses, evictions and invalidations are counted.
+    """
+    def __init__(
+            self,
+            max_size:int = CACHE_MAX_SIZE,
+            ttl:float = CACHE_TTL
+        ) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries:OrderedDict = OrderedDict()
+        self.tags:Dict[Hashable,Set[Hashable]] = {}
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get(
+            self,
+            key:Hashable,
+            stale:bool = False
+        ) -> Optional[Any]:
+        """Gets the value cached for a key.
+
+        Args:
+            key (Hashable): The key.
+            stale (bool): Whether to return the value even if it has expired. Defaults to False.
+
+        Returns:
+            Optional[Any]: The value (None if it isn't cached or has expired).
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or (not stale and time.time() > entry[0]):
+                self.counters['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return entry[1]
+
+    def set(
+            self,
+            key:Hashable,
+            value:Any,
+            tag:Optional[Hashable] = None,
+            ttl:Optional[float] = None
+        ) -> None:
+        """Caches a value for a key, evicting the least recently used entries beyond `max_size`.
+
+        Args:
+            key (Hashable): The key.
+            value (Any): The value.
+            tag (Optional[Hashable]): The tag to invalidate the entry by. Defaults to None.
+            ttl (Optional[float]): The seconds before the entry expires. Defaults to None (the
+                                   cache's `ttl`).
+
+        Returns:
+            None
+        """
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = (expires, value, tag)
+            if tag is not None:
+                self.tags.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.max_size:
+                self._remove(next(iter(self.entries)))
+                self.counters['evictions'] += 1
+
+    def _remove(
+            self,
+            key:Hashable
+        ) -> None:
+        """Removes an entry (the lock must be held)."""
+        entry = self.entries.pop(key, None)
+        if entry is not None and entry[2] is not None:
+            keys = self.tags.get(entry[2])
+            keys.discard(key)
+            if not keys:
+                del self.tags[entry[2]]
+
+    def invalidate(
+            self,
+            tag:Hashable
+        ) -> int:
+        """Removes every entry with a tag.
+
+        Args:
+            tag (Hashable): The tag.
+
+        Returns:
+            int: The number of entries removed.
+        """
+        with self.lock:
+            keys = list(self.tags.get(tag, ()))
+            for key in keys:
+                self._remove(key)
+            self.counters['invalidations'] += len(keys)
+            return len(keys)
+
+    def clear(self) -> None:
+        """Removes every entry (counted as invalidations).
+
+        Returns:
+            None
+        """
+        with self.lock:
+            self.counters['invalidations'] += len(self.entries)
+            self.entries.clear()
+            self.tags.clear()
+
+    def stats(self) -> Dict[str,int]:
+        """Gets the counters of the cache and its size.
+
+        Returns:
+            Dict[str,int]: The hits, misses, evictions, invalidations and size of the cache.
+        """
+        with self.lock:
+            return {**self.counters, 'size': len(self.entries)}
@@ -1,16 +1,39 @@
 """Detect Faces Functionality"""
 # pylint: disable=E1101,E0401,C0413
-from typing import List
+from typing import List, Optional
+import cv2
 import dlib
 import numpy as np
 import mediapipe as mp
+from .metrics import timed
+
+# Larger side of the frame detection runs on in ROI mode (MediaPipe downscales to 128x128 anyway)
+DETECT_MAX_SIZE = 640
 
 class FaceDetection:
-    """Class for Face Detection"""
-    def __init__(self):
-        mp_face_detection = mp.solutions.face_detection
-        self.detector = mp_face_detection.\
-                                FaceDetection(min_detection_confidence=0.5)
+    """Class for Face Detection
+
+    With `max_size`, larger images are downscaled (so their larger side is `max_size`) before
+    detecting faces, and the rectangles are mapped back to the full image.
+
+    The MediaPipe model is only loaded on first use.
+    """
+    def __init__(
+            self,
+            max_size:Optional[int] = None
+        ) -> None:
+        self.max_size = max_size
+        self._detector = None
+
+    @property
+    def detector(self):
+        """mp.solutions.face_detection.FaceDetection: The MediaPipe face detector, loaded on first
+           use."""
+        if self._detector is None:
+            mp_face_detection = mp.solutions.face_detection
+            self._detector = mp_face_detection.\
+                                    FaceDetection(min_detection_confidence=0.5)
+        return self._detector
 
     def detect(
             self,
@@ -24,8 +47,14 @@ class FaceDetection:
         Returns:
             List[dlib.rectangle]: A list of dlib rectangles representing the detected faces.
         """
-        faces = self.detector.process(img_rgb)
         img_h, img_w, _ = img_rgb.shape
+        if self.max_size is not None and max(img_h, img_w) > self.max_size:
+            scale = self.max_size / max(img_h, img_w)
+            img_rgb = cv2.resize(img_rgb, (round(img_w * scale), round(img_h * scale)),\
+                                 interpolation=cv2.INTER_AREA)
+        # the boxes are relative, so they map back to the full image as they are
+        with timed('detect'):
+            faces = self.detector.process(img_rgb)
         dlib_faces = []
         if faces.detections:
             for face in faces.detections:
@@ -0,0 +1,764 @@
+"""Shared Gallery (in-process Vector DB) Functionality"""
+# pylint: disable=E1101,E0401,C0413
+from typing import Literal, List, Union, Optional, Tuple, Iterator, Dict, Callable
+import os
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+import faiss
+import numpy as np
+from ._vectorlog import VectorLog, replay_vectordb, write_snapshot, read_vectordb, key_name,\
+                        legacy_keys_path, SegmentRemoved, RECORD_OP_DELETE
+from ._vectorindex import build_index, prepare_index, index_type_of, min_training_records,\
+                          reconstruct_all, search_parameters, own_index
+from ._keytable import KeyTable, write_key_table
+from ._metadata import MetadataStore
+from .metrics import timed
+
+VECTOR_DB_PATH = os.path.join(os.path.dirname(__file__),\
+                                     '../data/vectordb/faces_l2.faiss')
+VECTOR_KEYS_PATH = os.path.join(os.path.dirname(__file__),\
+                                     '../data/vectordb/faces_l2.keys')
+VECTOR_LEGACY_KEYS_PATH = legacy_keys_path(VECTOR_KEYS_PATH)
+VECTOR_LOG_PATH = os.path.join(os.path.dirname(__file__),\
+                                     '../data/vectordb/faces_l2.wal')
+VECTOR_METADATA_PATH = os.path.join(os.path.dirname(__file__),\
+                                     '../data/vectordb/faces_l2.sqlite')
+VECTOR_METRIC = 'euclidean'
+VECTOR_DIMENSIONS = 128
+VECTOR_STORAGE = 'log'
+VECTOR_LOG_COMPACT_EVERY = 1000
+VECTOR_INDEX_TYPE = 'flat'
+VECTOR_MMAP = True
+
+class ReadWriteLock:
+    """Class for a Lock that allows many concurrent readers or a single writer
+
+    Writers take precedence over new readers so that a steady stream of searches can't starve
+    enrollments.
+    """
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writers_waiting = 0
+        self._writing = False
+
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        """Holds the lock in shared (read) mode for the duration of the `with` block."""
+        with self._cond:
+            while self._writing or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self) -> Iterator[None]:
+        """Holds the lock in exclusive (write) mode for the duration of the `with` block."""
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writing or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+
+class FaceGallery:
+    """Class for the Gallery of Enrolled Faces (aka Vector DB) shared by Representation and
+       Identification
+
+    A single instance holds the FAISS index and its keys in memory and is updated in place, so
+    new enrollments are searchable as soon as `add` returns without any disk round trip. Searches
+    run concurrently under a read lock, while the in-memory part of an enrollment runs under the
+    write lock (the fsync to the log happens before it, so it never blocks searches).
+
+    Keys are resolved to names once, when they are added, into a row->label array, so search
+    results are named without parsing keys. Deleted rows keep their vectors but lose their key
+    (tombstones) and are excluded from searches.
+
+    The index can be exact ('flat') or approximate ('ivf', 'hnsw' or 'ivfpq'). Approximate
+    indexes are trained on the embeddings already in the gallery, so a flat gallery is migrated
+    to the configured `index_type` as soon as it has enough embeddings to train on (on load or
+    on compaction).
+
+    With `mmap`, the snapshot is memory-mapped rather than read: the vectors and the key table
+    (with the label of every row, so no key is parsed) are paged in from the file as searches
+    touch them, which makes loading near-instant whatever the size of the gallery, and every
+    process that opens the same snapshot (i.e. the workers of a web server) shares the same
+    physical pages. A process only copies the index into its own memory when it first enrolls.
+
+    With 'log' storage, many processes can enroll into the same gallery: each enrollment first
+    applies the records the other processes appended to the log since this one last did (under
+    the lock of the log), so every record gets its own rows.
+
+    The metadata of the faces (identity, source path, enrollment time and quality score) is also
+    recorded in a SQLite `metadata` store, which serves the per-identity lookups (`count`, `rows`,
+    `identities`) and filtering without any per-name structure in memory. It is written after the
+    in-memory update, outside of the write lock; without it, lookups scan the row->label array.
+    """
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(
+            self,
+            metric:Literal['euclidean', 'cosine'] = VECTOR_METRIC,
+            dimensions:int = VECTOR_DIMENSIONS,
+            storage:Literal['snapshot', 'log'] = VECTOR_STORAGE,
+            compact_every:int = VECTOR_LOG_COMPACT_EVERY,
+            db_path:str = VECTOR_DB_PATH,
+            keys_path:str = VECTOR_KEYS_PATH,
+            log_dir:str = VECTOR_LOG_PATH,
+            index_type:Literal['flat', 'ivf', 'hnsw', 'ivfpq'] = VECTOR_INDEX_TYPE,
+            mmap:bool = VECTOR_MMAP,
+            metadata_path:Optional[str] = VECTOR_METADATA_PATH
+        ) -> None:
+        self.metric = metric
+        self.index_type = index_type
+        self.dimensions = dimensions
+        self.storage = storage
+        self.compact_every = compact_every
+        self.db_path = db_path
+        self.keys_path = keys_path
+        self.log_dir = log_dir
+        self.lock = ReadWriteLock()
+        self.write_lock = threading.Lock()
+        self.version = 0
+        self.compaction = None
+        self.listeners:List[Callable[[str, List[str]], None]] = []
+        self.mmap = mmap
+        self.vectorlog = VectorLog(log_dir) if self.storage == 'log' else None
+        with self._log_lock():
+            if not os.path.exists(self.keys_path) and\
+               os.path.exists(legacy_keys_path(self.keys_path)):
+                # keys pickled by an older version, converted once to a key table (the index file
+                # is left as is)
+                write_key_table(read_vectordb(None, self.keys_path)[1], self.keys_path, key_name)
+            self._load()
+        if self._needs_migration():
+            if self.vectorlog is not None:
+                self.compact(block=True)
+            else:
+                self.vectordb = build_index(self.index_type, self.metric,\
+                                            reconstruct_all(self.vectordb))
+                self.mmapped = False
+                write_snapshot(self.vectordb, self.vectorkeys, self.db_path, self.keys_path)
+        self.metadata = None
+        if metadata_path is not None:
+            self.metadata = MetadataStore(metadata_path)
+            # with the log locked no other process has rows in the store that aren't in the log
+            with self._log_lock():
+                self.metadata.sync(self.vectorkeys, self.deleted)
+
+    def _log_lock(self):
+        """The lock of the log, held across processes (a no-op without a log)."""
+        return self.vectorlog.lock if self.vectorlog is not None else nullcontext()
+
+    def _load(self) -> None:
+        """Reads the last snapshot and replays the log on top of it (with the lock of the log
+           held), replacing the index, the keys and the name index."""
+        snapshot, vectorkeys = read_vectordb(self.db_path, self.keys_path, mmap=self.mmap)
+        if snapshot is not None:
+            vectordb = prepare_index(snapshot)
+            self.metric = 'euclidean' if snapshot.metric_type == 1 else 'cosine'
+            self.dimensions = snapshot.d
+        elif self.metric == 'euclidean':
+            vectordb = faiss.IndexFlatL2(self.dimensions)
+        else:
+            vectordb = faiss.IndexFlatIP(self.dimensions)
+        if self.vectorlog is not None:
+            vectordb = replay_vectordb(vectordb, vectorkeys, self.vectorlog, repair=True,\
+                                       mmapped=self.mmap and snapshot is not None)
+        with self.lock.write():
+            self.vectordb, self.vectorkeys = vectordb, vectorkeys
+            # whether the index still views the mapped snapshot (read-only)
+            self.mmapped = self.mmap and snapshot is not None and vectordb is snapshot
+            self._build_name_index()
+            self.version += 1
+
+    def _catch_up(self) -> List[Tuple[str, List[str]]]:
+        """Applies the records appended to the log by other processes since this one last read or
+           appended to it (with `write_lock` and the lock of the log held). Returns the changes to
+           notify the listeners of."""
+        if self.vectorlog is None:
+            return []
+        try:
+            records = self.vectorlog.read_new()
+        except SegmentRemoved:
+            self._load()
+            return [('reload', list(self.label_names))]
+        if not records:
+            return []
+        if self.mmapped and any(op != RECORD_OP_DELETE for op, *_ in records):
+            vectordb = own_index(self.vectordb)
+            with self.lock.write():
+                self.vectordb = vectordb
+                self.mmapped = False
+        added, deleted = set(), set()
+        with self.lock.write():
+            for op, start, embeddings, ids in records:
+                if op == RECORD_OP_DELETE:
+                    for key in ids:
+                        self._tombstone(self._rows_of(key))
+                    deleted.update(key_name(key) for key in ids)
+                    continue
+                num_keys = len(self.vectorkeys)
+                if num_keys < start + embeddings.shape[0]:
+                    self.vectordb.add(embeddings[num_keys - start:])
+                    self.vectorkeys.extend(ids[num_keys - start:])
+                    self._index_keys(num_keys)
+                added.update(key_name(key) for key in ids)
+            self._update_selector()
+            self.version += 1
+        return [(event, sorted(names)) for event, names in (('add', added), ('delete', deleted))\
+                if names]
+
+    def _rows_of(
+            self,
+            key:Union[str,int]
+        ) -> List[int]:
+        """Finds the rows of a name, or of a single key (i.e. a path) when `key` isn't a name (with
+           `write_lock` held)."""
+        name = key_name(key)
+        label = self.label_ids.get(name)
+        if label is None:
+            return []
+        rows = self.label_rows([label]).get(label, np.empty(0, dtype='int64')).tolist()
+        if name != key:
+            rows = [row for row in rows if self.vectorkeys[row] == key]
+        return rows
+
+    def _tombstone(
+            self,
+            rows:List[int]
+        ) -> None:
+        """Tombstones rows (with the write lock held)."""
+        for row in rows:
+            self.vectorkeys[row] = None
+        self.labels[rows] = -1
+        self.deleted.extend(rows)
+
+    def _needs_migration(self) -> bool:
+        """Whether the index should be (and can be) rebuilt as the configured `index_type`."""
+        return index_type_of(self.vectordb) != self.index_type and\
+               self.num_records >= max(1, min_training_records(self.index_type))
+
+    def _build_name_index(self) -> None:
+        """Builds the row->label array from scratch."""
+        self.labels = np.full(max(16, len(self.vectorkeys)), -1, dtype='int32')
+        self.label_names:List[str] = []
+        self.label_ids:Dict[str,int] = {}
+        self.deleted:List[int] = []
+        start = 0
+        if isinstance(self.vectorkeys, KeyTable):
+            start = self._index_key_table(self.vectorkeys)
+        self._index_keys(start)
+        self._update_selector()
+
+    def _index_key_table(
+            self,
+            table:KeyTable
+        ) -> int:
+        """Indexes the rows of a key table from its stored labels (without parsing the keys).
+           Returns the number of rows indexed."""
+        start = table.base_len
+        self.labels[:start] = table.labels
+        self.label_names = list(table.label_names)
+        self.label_ids = {name: label for label, name in enumerate(self.label_names)}
+        # rows deleted since the snapshot was written (replayed from the log)
+        self.labels[[row for row, key in table.changed.items() if key is None and row < start]] = -1
+        self.deleted = np.flatnonzero(self.labels[:start] < 0).tolist()
+        return start
+
+    def _index_keys(
+            self,
+            start:int
+        ) -> None:
+        """Adds the keys from row `start` onwards to the row->label array."""
+        end = len(self.vectorkeys)
+        if end > self.labels.shape[0]:
+            labels = np.full(max(end, 2 * self.labels.shape[0]), -1, dtype='int32')
+            labels[:start] = self.labels[:start]
+            self.labels = labels
+        for row in range(start, end):
+            name = key_name(self.vectorkeys[row])
+            if name is None:
+                self.labels[row] = -1
+                self.deleted.append(row)
+                continue
+            label = self.label_ids.get(name)
+            if label is None:
+                label = len(self.label_names)
+                self.label_ids[name] = label
+                self.label_names.append(name)
+            self.labels[row] = label
+
+    def _update_selector(self) -> None:
+        """Builds the selector that excludes deleted rows from searches (None if there are none)."""
+        self.selector = None
+        if self.deleted:
+            deleted = faiss.IDSelectorBatch(np.array(self.deleted, dtype='int64'))
+            self.selector = faiss.IDSelectorNot(deleted)
+            # keep a reference to the wrapped selector so it isn't garbage collected
+            self._deleted_selector = deleted
+
+    @classmethod
+    def shared(
+            cls,
+            *args,
+            **kwargs
+        ) -> 'FaceGallery':
+        """Gets the gallery shared by every class in this process, creating it on first use.
+
+        Args:
+            *args: Positional arguments for `FaceGallery` (only used on first use).
+            **kwargs: Keyword arguments for `FaceGallery` (only used on first use).
+
+        Returns:
+            FaceGallery: The shared gallery.
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls(*args, **kwargs)
+            return cls._shared
+
+    def subscribe(
+            self,
+            listener:Callable[[str, List[str]], None]
+        ) -> None:
+        """Subscribes a listener to changes of the gallery (i.e. to invalidate caches).
+
+        Args:
+            listener (Callable[[str, List[str]], None]): Called with the event ('add', 'delete' or
+                                                         'reload') and the names affected, after
+                                                         the change.
+
+        Returns:
+            None
+        """
+        self.listeners.append(listener)
+
+    def _notify(
+            self,
+            event:str,
+            names:List[str]
+        ) -> None:
+        """Notifies the listeners of a change."""
+        for listener in self.listeners:
+            listener(event, names)
+
+    def _notify_all(
+            self,
+            events:List[Tuple[str, List[str]]]
+        ) -> None:
+        """Notifies the listeners of changes, in order."""
+        for event, names in events:
+            self._notify(event, names)
+
+    @property
+    def num_records(self) -> int:
+        """int: The number of embeddings in the gallery."""
+        return self.vectordb.ntotal
+
+    def search(
+            self,
+            descriptors:np.ndarray,
+            k:int = 1,
+            nprobe:Optional[int] = None,
+            ef_search:Optional[int] = None
+        ) -> Tuple[np.ndarray, np.ndarray]:
+        """Searches the k nearest neighbors of the descriptors in the gallery.
+
+        Args:
+            descriptors (np.ndarray): The (n, dimensions) descriptors to search for.
+            k (int): The number of nearest neighbors to search for. Defaults to 1.
+            nprobe (Optional[int]): The number of inverted lists to visit with an IVF index (more
+                                    is slower but more accurate). Defaults to None (index default).
+            ef_search (Optional[int]): The size of the candidate list with an HNSW index (more is
+                                       slower but more accurate). Defaults to None (index default).
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The (n, k) distances and row IDs of the neighbors.
+        """
+        descriptors = np.ascontiguousarray(descriptors, dtype='float32')
+        with timed('search'), self.lock.read():
+            params = search_parameters(self.vectordb, self.selector, nprobe, ef_search)
+            if params is None:
+                return self.vectordb.search(descriptors, k)
+            return self.vectordb.search(descriptors, k, params=params)
+
+    def range_search(
+            self,
+            descriptors:np.ndarray,
+            radius:float,
+            nprobe:Optional[int] = None,
+            ef_search:Optional[int] = None
+        ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Searches every neighbor of the descriptors within a radius in the gallery.
+
+        Args:
+            descriptors (np.ndarray): The (n, dimensions) descriptors to search for.
+            radius (float): The radius, in the distances of the index (squared for 'euclidean').
+            nprobe (Optional[int]): The number of inverted lists to visit with an IVF index (more
+                                    is slower but more accurate). Defaults to None (index default).
+            ef_search (Optional[int]): The size of the candidate list with an HNSW index (more is
+                                       slower but more accurate). Defaults to None (index default).
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: The (n + 1,) offsets, and the distances and
+                                                       row IDs of the neighbors (those of
+                                                       descriptor i are at `lims[i]:lims[i+1]`,
+                                                       in no particular order).
+        """
+        descriptors = np.ascontiguousarray(descriptors, dtype='float32')
+        with timed('range_search'), self.lock.read():
+            params = search_parameters(self.vectordb, self.selector, nprobe, ef_search)
+            if params is None:
+                return self.vectordb.range_search(descriptors, radius)
+            return self.vectordb.range_search(descriptors, radius, params=params)
+
+    def labels_of(
+            self,
+            rows:np.ndarray
+        ) -> np.ndarray:
+        """Gets the labels of the identities of rows in the gallery, without resolving names.
+
+        Args:
+            rows (np.ndarray): The row IDs (i.e. as returned by `search`, -1 for no row).
+
+        Returns:
+            np.ndarray: The int32 labels, of the same shape as `rows` (-1 for no row or a deleted
+                        row). `label_names[label]` is the name of a label.
+        """
+        rows = np.asarray(rows)
+        labels = self.labels
+        found = (rows >= 0) & (rows < labels.shape[0])
+        return np.where(found, labels[np.where(found, rows, 0)], -1).astype('int32')
+
+    def get_name(
+            self,
+            i:int
+        ) -> Optional[str]:
+        """Get the name of the identity of a row in the gallery.
+
+        Args:
+            i (int): The sequential ID (row) in the gallery.
+
+        Returns:
+            Optional[str]: The name of the identity (None for a deleted row).
+        """
+        label = self.labels[i]
+        return self.label_names[label] if label >= 0 else None
+
+    def label_rows(
+            self,
+            labels:List[int]
+        ) -> Dict[int,np.ndarray]:
+        """Finds the rows of some labels in the index, with a single scan of the row->label array
+           (with the lock held, i.e. to read their embeddings).
+
+        Args:
+            labels (List[int]): The labels (see `label_ids`).
+
+        Returns:
+            Dict[int,np.ndarray]: The int64 rows of each label that has any, in order.
+        """
+        rows = np.flatnonzero(np.isin(self.labels[:self.num_records],\
+                                      np.asarray(labels, dtype='int32')))
+        found = self.labels[rows]
+        order = np.argsort(found, kind='stable')
+        rows, found = rows[order], found[order]
+        uniques, starts = np.unique(found, return_index=True)
+        return dict(zip(uniques.tolist(), np.split(rows, starts[1:])))
+
+    def count(
+            self,
+            name:str
+        ) -> int:
+        """Counts the number of embeddings enrolled for a name (in the metadata store, if any).
+
+        Args:
+            name (str): The name to count embeddings for.
+
+        Returns:
+            int: The number of embeddings enrolled for the name.
+        """
+        if self.metadata is not None:
+            return self.metadata.count(name)
+        return len(self.rows(name))
+
+    def rows(
+            self,
+            name:str
+        ) -> List[int]:
+        """Lists the rows enrolled for a name (in the metadata store, if any).
+
+        Args:
+            name (str): The name to list the rows for.
+
+        Returns:
+            List[int]: The sequential IDs (rows) of the embeddings enrolled for the name.
+        """
+        if self.metadata is not None:
+            rows = np.array(self.metadata.rows(name), dtype='int64')
+            # leaves out rows enrolled by another process and not caught up with yet, and rows
+            # deleted whose deletion isn't in the store yet
+            return rows[self.labels_of(rows) >= 0].tolist()
+        label = self.label_ids.get(name)
+        if label is None:
+            return []
+        with self.lock.read():
+            return self.label_rows([label]).get(label, np.empty(0, dtype='int64')).tolist()
+
+    def identities(self) -> List[Tuple[str, int]]:
+        """Lists the identities that have embeddings enrolled (in the metadata store, if any).
+
+        Returns:
+            List[Tuple[str, int]]: The name and number of embeddings of each identity, by name.
+        """
+        if self.metadata is not None:
+            return self.metadata.identities()
+        with self.lock.read():
+            labels = self.labels[:self.num_records]
+            counts = np.bincount(labels[labels >= 0], minlength=len(self.label_names))
+            return sorted((self.label_names[label], int(count))\
+                          for label, count in enumerate(counts.tolist()) if count)
+
+    @property
+    def num_identities(self) -> int:
+        """int: The number of identities that have embeddings enrolled."""
+        return len(self.identities())
+
+    def delete(
+            self,
+            name:str
+        ) -> int:
+        """Deletes every embedding enrolled for a name.
+
+        The rows are tombstoned (their keys set to None and excluded from searches) rather than
+        removed from the index, so row IDs stay stable.
+
+        Args:
+            name (str): The name to delete.
+
+        Returns:
+            int: The number of embeddings deleted.
+        """
+        return self._delete([name])
+
+    def delete_keys(
+            self,
+            keys:List[Union[str,int]]
+        ) -> int:
+        """Deletes the embeddings enrolled under some keys (i.e. the previous embedding of an image
+           that changed), leaving the other embeddings of their names.
+
+        Args:
+            keys (List[Union[str,int]]): The keys (paths like `/name/img_face0.jpg`) to delete.
+
+        Returns:
+            int: The number of embeddings deleted.
+        """
+        return self._delete([key for key in keys if key_name(key) != key])
+
+    def _delete(
+            self,
+            keys:List[Union[str,int]]
+        ) -> int:
+        """Tombstones the rows of names or keys (see `_rows_of`) in a single log record. Returns
+           the number of rows deleted."""
+        with self.write_lock:
+            with self._log_lock():
+                events = self._catch_up()
+                key_rows = {key: rows for key, rows in ((key, self._rows_of(key)) for key in keys)\
+                            if rows}
+                if key_rows and self.vectorlog is not None:
+                    self.vectorlog.append(self.num_records,\
+                                          np.empty((0, self.dimensions), 'float32'),\
+                                          list(key_rows), op=RECORD_OP_DELETE)
+            if key_rows:
+                with self.lock.write():
+                    for rows in key_rows.values():
+                        self._tombstone(rows)
+                    self._update_selector()
+                    self.version += 1
+            if key_rows and self.vectorlog is None:
+                with timed('snapshot_write'):
+                    write_snapshot(self.vectordb, self.vectorkeys, self.db_path, self.keys_path)
+        if key_rows and self.metadata is not None:
+            with timed('metadata_write'):
+                for key, rows in key_rows.items():
+                    self.metadata.delete(key_name(key), rows)
+        names = sorted({key_name(key) for key in key_rows})
+        self._notify_all(events + ([('delete', names)] if names else []))
+        return sum(len(rows) for rows in key_rows.values())
+
+    def _within_cap(
+            self,
+            ids:List[Union[str,int]],
+            max_per_name:int
+        ) -> np.ndarray:
+        """Finds the keys that fit within `max_per_name` embeddings per name, counting the ones
+           enrolled already (with `write_lock` and the lock of the log held, after catching up)."""
+        counts:Dict[str,int] = {}
+        keep = np.ones(len(ids), dtype=bool)
+        for i, key in enumerate(ids):
+            name = key_name(key)
+            if name is None:
+                continue
+            if name not in counts:
+                label = self.label_ids.get(name)
+                counts[name] = 0 if label is None else\
+                               int(np.count_nonzero(self.labels[:self.num_records] == label))
+            if counts[name] >= max_per_name:
+                keep[i] = False
+            else:
+                counts[name] += 1
+        return keep
+
+    def add(
+            self,
+            embeddings:np.ndarray,
+            ids:List[Union[str,int]] = None,
+            qualities:Optional[List[Optional[float]]] = None,
+            max_per_name:Optional[int] = None
+        ) -> np.ndarray:
+        """Adds embeddings to the gallery, making them searchable right away.
+
+        With `max_per_name`, the embeddings enrolled for each name are counted and the new ones
+        added in the same write (under the lock of the log, so across processes too), so
+        concurrent enrollments of a name can't exceed it.
+
+        Args:
+            embeddings (np.ndarray): The embeddings to be added to the gallery.
+            ids (List[Union[str,int]], optional): The IDs associated with the embeddings.
+                                                  Defaults to None.
+            qualities (Optional[List[Optional[float]]]): The quality score of each face, for the
+                                                         metadata store. Defaults to None.
+            max_per_name (Optional[int]): The maximum number of embeddings per name; the ones
+                                          beyond it are left out, in order. Defaults to None (no
+                                          maximum).
+
+        Returns:
+            np.ndarray: The (n,) mask of the embeddings that were added.
+
+        Raises:
+            AssertionError: If the length of `ids` is not equal to the length of `embeddings`.
+        """
+        embeddings = np.ascontiguousarray(embeddings, dtype='float32')
+        if (self.num_records==0) and (self.metric == 'cosine'):
+            faiss.normalize_L2(embeddings)
+        emb_len = embeddings.shape[0]
+        added = np.ones(emb_len, dtype=bool)
+        with self.write_lock:
+            with self._log_lock():
+                events = self._catch_up()
+                start = self.num_records
+                if ids is None:
+                    ids = [*range(start, start + emb_len)]
+                else:
+                    assert emb_len == len(ids)
+                if max_per_name is not None:
+                    added = self._within_cap(ids, max_per_name)
+                    embeddings = embeddings[added]
+                    ids = [key for key, keep in zip(ids, added) if keep]
+                    if qualities is not None:
+                        qualities = [quality for quality, keep in zip(qualities, added) if keep]
+                if ids and self.vectorlog is not None:
+                    with timed('log_append'):
+                        self.vectorlog.append(start, embeddings, list(ids))
+            if ids and self.mmapped:
+                # copied while searches keep using the mapped index
+                vectordb = own_index(self.vectordb)
+                with self.lock.write():
+                    self.vectordb = vectordb
+                    self.mmapped = False
+            if ids:
+                with timed('index_add'), self.lock.write():
+                    self.vectordb.add(embeddings)
+                    self.vectorkeys.extend(ids)
+                    self._index_keys(start)
+                    self.version += 1
+            if ids and self.vectorlog is None:
+                with timed('snapshot_write'):
+                    write_snapshot(self.vectordb, self.vectorkeys, self.db_path, self.keys_path)
+        if ids and self.metadata is not None:
+            with timed('metadata_write'):
+                self.metadata.add(start, list(ids), qualities, time.time())
+        names = sorted({key_name(key) for key in ids})
+        self._notify_all(events + ([('add', names)] if names else []))
+        if self.vectorlog is not None and self.vectorlog.pending_records >= self.compact_every:
+            self.compact()
+        return added
+
+    def compact(
+            self,
+            block:bool = False
+        ) -> None:
+        """Merges the sealed log segments into a fresh snapshot of the gallery.
+
+        The active segment is sealed and the index and keys copied while holding the lock, and the
+        snapshot is written in a background thread so that enrollments aren't blocked by it.
+
+        Args:
+            block (bool): Whether to wait for the compaction to finish. Defaults to False.
+
+        Returns:
+            None
+        """
+        if self.vectorlog is None:
+            return
+        with self.write_lock:
+            if self.compaction is not None and self.compaction.is_alive():
+                if not block:
+                    return
+                self.compaction.join()
+            with self.vectorlog.lock:
+                events = self._catch_up()
+                sealed = self.vectorlog.rotate()
+            if self._needs_migration():
+                vectordb = build_index(self.index_type, self.metric,\
+                                       reconstruct_all(self.vectordb))
+                with self.lock.write():
+                    self.vectordb = vectordb
+                    self.mmapped = False
+                    self.version += 1
+            with self.lock.read():
+                vectordb = faiss.clone_index(self.vectordb)
+                vectorkeys = list(self.vectorkeys)
+
+        def _compact():
+            with timed('compaction'), self.vectorlog.compaction_lock:
+                # another process already wrote a snapshot with (at least) these segments
+                if not all(os.path.exists(path) for path in sealed):
+                    return
+                write_snapshot(vectordb, vectorkeys, self.db_path, self.keys_path)
+                self.vectorlog.remove(sealed)
+
+        self.compaction = threading.Thread(target=_compact, daemon=True)
+        self.compaction.start()
+        if block:
+            self.compaction.join()
+        self._notify_all(events)
+
+    def reload(self) -> None:
+        """Reloads the gallery from disk (i.e. to pick up enrollments made by another process).
+
+        Returns:
+            None
+        """
+        with self.write_lock, self._log_lock():
+            self._load()
+            if self.metadata is not None:
+                self.metadata.sync(self.vectorkeys, self.deleted)
+        self._notify('reload', list(self.label_names))
@@ -1,28 +1,141 @@
 """Identify Faces (using Vector DB) Functionality"""
 # pylint: disable=E1101,E0401,C0413
-from typing import Tuple, List, Optional
-import os
+from typing import Tuple, List, Optional, Union
 import faiss
-import joblib
 import numpy as np
+from .gallery import FaceGallery
+from .prototypes import PrototypeIndex
 
-VECTOR_DB_PATH = os.path.join(os.path.dirname(__file__),\
-                                     '../data/vectordb/faces_l2.faiss')
-VECTOR_KEYS_PATH = os.path.join(os.path.dirname(__file__),\
-                                     '../data/vectordb/faces_l2.pkl')
-VECTOR_METRIC = 'euclidean'
-VECTOR_DIMENSIONS = 128
 FACE_RECOGNITION_TOLERANCE = 0.4
+# Number of descriptors searched at a time by the batch methods (enrollments can run in between)
+IDENTIFY_BATCH_SIZE = 4096
+
+def vote(
+        labels:np.ndarray,
+        distances:np.ndarray,
+        valid:np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Votes the identity of each descriptor among its valid nearest neighbors.
+
+    The identity with the most valid neighbors wins, and ties go to the identity of the nearest
+    neighbor among them (so with k=1 it's just the nearest neighbor).
+
+    Args:
+        labels (np.ndarray): The (n, k) labels of the neighbors, sorted by distance.
+        distances (np.ndarray): The (n, k) distances of the neighbors.
+        valid (np.ndarray): The (n, k) mask of the neighbors within tolerance.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: The (n,) labels (-1 for no match), distances
+                                                   of the nearest neighbor of the identity (inf
+                                                   for no match) and votes of the identities.
+    """
+    same = (labels[:, :, None] == labels[:, None, :]) & valid[:, None, :]
+    votes = np.where(valid, same.sum(axis=2), 0)
+    # the first neighbor with the most votes is the nearest one of the winning identity
+    best = votes.argmax(axis=1)[:, None]
+    votes = np.take_along_axis(votes, best, axis=1)[:, 0].astype('int32')
+    matched = votes > 0
+    label = np.where(matched, np.take_along_axis(labels, best, axis=1)[:, 0], -1)
+    distance = np.where(matched, np.take_along_axis(distances, best, axis=1)[:, 0], np.inf)
+    return label.astype('int32'), distance.astype('float32'), votes
+
+class IdentityMatches:
+    """Class for the Results of a Batch Identification (k nearest neighbors)
+
+    Every array has a row per descriptor. Identities are integer labels of the gallery, so that
+    names are only resolved where they are needed (see `FaceIdentification.names`).
+
+    Attributes:
+        distances (np.ndarray): The (n, k) float32 distances of the nearest neighbors, sorted.
+        rows (np.ndarray): The (n, k) int64 gallery rows of the neighbors (-1 for none).
+        labels (np.ndarray): The (n, k) int32 labels of the neighbors (-1 for none).
+        valid (np.ndarray): The (n, k) mask of the neighbors within tolerance.
+        label (np.ndarray): The (n,) int32 label voted for each descriptor (-1 for no match).
+        distance (np.ndarray): The (n,) float32 distance of the nearest neighbor of the voted
+                               identity (inf for no match).
+        votes (np.ndarray): The (n,) int32 number of valid neighbors of the voted identity.
+    """
+    def __init__(
+            self,
+            distances:np.ndarray,
+            rows:np.ndarray,
+            labels:np.ndarray,
+            valid:np.ndarray
+        ) -> None:
+        self.distances = distances
+        self.rows = rows
+        self.labels = labels
+        self.valid = valid
+        self.label, self.distance, self.votes = vote(labels, distances, valid)
+
+    @property
+    def matched(self) -> np.ndarray:
+        """np.ndarray: The (n,) mask of the descriptors that matched an identity."""
+        return self.label >= 0
+
+class RangeMatches:
+    """Class for the Results of a Range Identification (every neighbor within tolerance)
+
+    The matches are stored back to back: those of descriptor i are at `lims[i]:lims[i+1]`, sorted
+    by distance.
+
+    Attributes:
+        lims (np.ndarray): The (n + 1,) offsets of the matches of each descriptor.
+        distances (np.ndarray): The float32 distances of the matches.
+        rows (np.ndarray): The int64 gallery rows of the matches.
+        labels (np.ndarray): The int32 labels of the matches.
+    """
+    def __init__(
+            self,
+            lims:np.ndarray,
+            distances:np.ndarray,
+            rows:np.ndarray,
+            labels:np.ndarray
+        ) -> None:
+        self.lims = lims
+        self.distances = distances
+        self.rows = rows
+        self.labels = labels
+
+    @property
+    def counts(self) -> np.ndarray:
+        """np.ndarray: The (n,) number of matches of each descriptor."""
+        return np.diff(self.lims)
+
+    @property
+    def queries(self) -> np.ndarray:
+        """np.ndarray: The descriptor (query) index of each match."""
+        return np.repeat(np.arange(self.lims.shape[0] - 1), self.counts)
 
 class FaceIdentification:
-    """Class for Face Identification"""
+    """Class for Face Identification
+
+    With a `PrototypeIndex`, the nearest neighbors are searched in two stages (nearest identity
+    centroids first, then their raw descriptors) instead of among every enrolled descriptor.
+    Range identification always searches every descriptor.
+    """
     def __init__(
             self,
-            tolerance = FACE_RECOGNITION_TOLERANCE
+            tolerance = FACE_RECOGNITION_TOLERANCE,
+            gallery:Optional[FaceGallery] = None,
+            prototypes:Optional[PrototypeIndex] = None
         ) -> None:
         self.tolerance = tolerance
-        self.vectordb = faiss.read_index(VECTOR_DB_PATH)
-        self.vectorkeys = joblib.load(VECTOR_KEYS_PATH)
+        if gallery is None:
+            gallery = FaceGallery.shared()
+        self.gallery = gallery
+        self.prototypes = prototypes
+
+    @property
+    def vectordb(self) -> faiss.Index:
+        """faiss.Index: The index of the shared gallery."""
+        return self.gallery.vectordb
+
+    @property
+    def vectorkeys(self) -> List[Union[str,int]]:
+        """List[Union[str,int]]: The keys of the shared gallery."""
+        return self.gallery.vectorkeys
 
     def get_name(
             self,
@@ -34,45 +147,162 @@ class FaceIdentification:
             i (int): The sequential ID in the vector DB.
 
         Returns:
-            str: The name of the file as stored in the keys pickle objects.
+            str: The name of the identity, as resolved from its key when it was enrolled.
         """
-        path = self.vectorkeys[i]
-        if '/' in path:
-            name = os.path.basename(os.path.dirname(path))
-        else:
-            name = path
-        return name
+        return self.gallery.get_name(i)
 
     def identify(
             self,
-            descriptors:List[np.ndarray],
-            k:Optional[int] = 1
+            descriptors:Union[np.ndarray, List[np.ndarray]],
+            k:Optional[int] = 1,
+            nprobe:Optional[int] = None,
+            ef_search:Optional[int] = None
         ) -> Tuple[List, List]:
         """Identifies the given descriptors by searching for nearest neighbors in the vector
            database.
 
         Args:
-            descriptors (List[np.ndarray]): A list of numpy arrays representing the descriptors to
-                                            be identified.
+            descriptors (Union[np.ndarray, List[np.ndarray]]): The (n, dimensions) descriptors to
+                                                               be identified (i.e. as returned by
+                                                               `FaceRepresentation.represent`).
             k (Optional[int]): The number of nearest neighbors to search for. Defaults to 1.
+            nprobe (Optional[int]): The number of inverted lists to visit when the gallery uses an
+                                    IVF index. Defaults to None (the index's own setting).
+            ef_search (Optional[int]): The size of the candidate list when the gallery uses an HNSW
+                                       index. Defaults to None (the index's own setting).
 
         Returns:
             Tuple[List, List]: A tuple containing two lists. The first list contains the distances
                                of the nearest neighbors, and the second list contains the names of
-                               the nearest neighbors.
+                               the nearest neighbors (only those within tolerance, so they may
+                               be empty).
 
         Example:
             distances, neighbors = identify(descriptors, k=3)
         """
-        distances, neighbors = self.vectordb.search(np.array(descriptors), k)
-        masks = [d < self.tolerance for d in distances]
-        distances = [[i for i in d[m]]\
-                     for d, m in zip(distances, masks)]
-        neighbors = [[self.get_name(i) for i in n[m]]\
-                     for n, m in zip(neighbors, masks)]
-
+        matches = self.identify_batch(descriptors, k, nprobe, ef_search)
+        label_names = self.gallery.label_names
+        distances = [list(d[m]) for d, m in zip(matches.distances, matches.valid)]
+        neighbors = [[label_names[label] for label in l[m]]\
+                     for l, m in zip(matches.labels, matches.valid)]
         return distances, neighbors
 
+    def identify_batch(
+            self,
+            descriptors:np.ndarray,
+            k:int = 1,
+            nprobe:Optional[int] = None,
+            ef_search:Optional[int] = None,
+            batch_size:int = IDENTIFY_BATCH_SIZE
+        ) -> IdentityMatches:
+        """Identifies a batch of descriptors by majority vote of their k nearest neighbors.
+
+        Tolerance filtering and voting are vectorized and no names are resolved, so it scales to
+        hundreds of thousands of descriptors (i.e. de-duplication jobs).
+
+        Args:
+            descriptors (np.ndarray): The (n, dimensions) descriptors to be identified.
+            k (int): The number of nearest neighbors that vote. Defaults to 1.
+            nprobe (Optional[int]): The number of inverted lists to visit when the gallery uses an
+                                    IVF index. Defaults to None (the index's own setting, and
+                                    unused with prototypes).
+            ef_search (Optional[int]): The size of the candidate list when the gallery uses an HNSW
+                                       index. Defaults to None (the index's own setting, and
+                                       unused with prototypes).
+            batch_size (int): The number of descriptors searched at a time. Defaults to
+                              IDENTIFY_BATCH_SIZE.
+
+        Returns:
+            IdentityMatches: The neighbors and voted identity of each descriptor.
+
+        Example:
+            matches = identify_batch(descriptors, k=5)
+            names = names(matches.label)
+        """
+        descriptors = np.asarray(descriptors, dtype='float32').reshape(-1, self.gallery.dimensions)
+        distances = np.empty((descriptors.shape[0], k), dtype='float32')
+        rows = np.empty((descriptors.shape[0], k), dtype='int64')
+        for start in range(0, descriptors.shape[0], batch_size):
+            end = start + batch_size
+            if self.prototypes is not None:
+                distances[start:end], rows[start:end] = self.prototypes.search(\
+                    descriptors[start:end], k)
+            else:
+                distances[start:end], rows[start:end] = self.gallery.search(\
+                    descriptors[start:end], k, nprobe, ef_search)
+        labels = self.gallery.labels_of(rows)
+        valid = (labels >= 0) & (distances < self.tolerance)
+        return IdentityMatches(distances, rows, labels, valid)
+
+    def identify_range(
+            self,
+            descriptors:np.ndarray,
+            tolerance:Optional[float] = None,
+            nprobe:Optional[int] = None,
+            ef_search:Optional[int] = None,
+            batch_size:int = IDENTIFY_BATCH_SIZE
+        ) -> RangeMatches:
+        """Finds every enrolled face within tolerance of each descriptor (no need to guess k).
+
+        Args:
+            descriptors (np.ndarray): The (n, dimensions) descriptors to be identified.
+            tolerance (Optional[float]): The search radius. Defaults to None (`self.tolerance`).
+            nprobe (Optional[int]): The number of inverted lists to visit when the gallery uses an
+                                    IVF index. Defaults to None (the index's own setting).
+            ef_search (Optional[int]): The size of the candidate list when the gallery uses an HNSW
+                                       index. Defaults to None (the index's own setting).
+            batch_size (int): The number of descriptors searched at a time. Defaults to
+                              IDENTIFY_BATCH_SIZE.
+
+        Returns:
+            RangeMatches: The matches of each descriptor.
+
+        Raises:
+            ValueError: If the gallery isn't 'euclidean' (with inner products a range search
+                        returns the neighbors above the radius).
+        """
+        if self.gallery.metric != 'euclidean':
+            raise ValueError("Range identification needs a 'euclidean' gallery")
+        tolerance = self.tolerance if tolerance is None else tolerance
+        descriptors = np.asarray(descriptors, dtype='float32').reshape(-1, self.gallery.dimensions)
+        counts, distances, rows = [np.zeros(0, dtype='int64')], [], []
+        for start in range(0, descriptors.shape[0], batch_size):
+            lims, batch_distances, batch_rows = self.gallery.range_search(\
+                descriptors[start:start + batch_size], tolerance, nprobe, ef_search)
+            counts.append(np.diff(lims))
+            distances.append(batch_distances)
+            rows.append(batch_rows)
+        lims = np.concatenate([[0], np.cumsum(np.concatenate(counts))]).astype('int64')
+        distances = np.concatenate(distances or [np.zeros(0)]).astype('float32')
+        rows = np.concatenate(rows or [np.zeros(0)]).astype('int64')
+        queries = np.repeat(np.arange(descriptors.shape[0]), np.diff(lims))
+        order = np.lexsort((distances, queries))
+        distances, rows = distances[order], rows[order]
+        labels = self.gallery.labels_of(rows)
+        # a row can be deleted between the search and the label lookup
+        if (labels < 0).any():
+            keep = labels >= 0
+            lims = np.concatenate([[0], np.cumsum(np.bincount(queries[keep],\
+                                   minlength=descriptors.shape[0]))]).astype('int64')
+            distances, rows, labels = distances[keep], rows[keep], labels[keep]
+        return RangeMatches(lims, distances, rows, labels)
+
+    def names(
+            self,
+            labels:np.ndarray
+        ) -> List[Optional[str]]:
+        """Resolves labels (i.e. `IdentityMatches.label`) to the names of their identities.
+
+        Args:
+            labels (np.ndarray): The labels (-1 for no match).
+
+        Returns:
+            List[Optional[str]]: The names (None for no match), flattened.
+        """
+        label_names = self.gallery.label_names
+        return [label_names[label] if label >= 0 else None\
+                for label in np.asarray(labels).ravel().tolist()]
+
     def count(
             self,
             name:str
@@ -86,20 +316,30 @@ class FaceIdentification:
         Returns:
             int: The number of occurrences of the given name.
         """
-        self.vectorkeys = joblib.load(VECTOR_KEYS_PATH)
-        key_cnt = len(self.vectorkeys)
-        names = [self.get_name(i) for i in range(key_cnt)]
-        return len([n for n in names if n == name])
+        return self.gallery.count(name)
+
+    def list_keys(
+            self,
+            name:str
+        ) -> List[Union[str,int]]:
+        """Lists the vector keys enrolled for a given name.
+
+        Args:
+            name (str): The name to list the keys for.
+
+        Returns:
+            List[Union[str,int]]: The keys enrolled for the name.
+        """
+        return [self.vectorkeys[i] for i in self.gallery.rows(name)]
 
     def reload_vectordb(self) -> None:
         """Reloads the vector database.
 
-        This function reads the vector database from the specified path and updates the `vectordb`
-        attribute of the object. It also loads the vector keys from the specified path and updates
-        the `vectorkeys` attribute.
+        Enrollments made through a `FaceRepresentation` sharing the same gallery are searchable
+        right away, so this is only needed to pick up enrollments made by another process. It
+        reads the last snapshot and replays the append-only log on top, in the shared gallery.
 
         Returns:
             None
         """
-        self.vectordb = faiss.read_index(VECTOR_DB_PATH)
-        self.vectorkeys = joblib.load(VECTOR_KEYS_PATH)
+        self.gallery.reload()
@@ -0,0 +1,272 @@
+"""Opt-in Latency Instrumentation (Prometheus Text Format) Functionality"""
+# pylint: disable=E1101,E0401,C0413
+from typing import Callable, Dict, List, Optional, Tuple, Union
+import os
+import time
+import bisect
+import threading
+from contextlib import nullcontext
+
+# Whether stages are timed (overridable with the environment variable of the same name)
+RECOGNITION_METRICS = os.environ.get('RECOGNITION_METRICS', '0') == '1'
+# Upper bounds of the histogram buckets, in seconds
+METRICS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,\
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Histogram of the stages timed within the library
+STAGE_HISTOGRAM = 'facial_recognition_stage_seconds'
+# Returned by `timed` when the metrics are off, so a timed stage costs a function call
+_NULL_TIMER = nullcontext()
+
+def _labels(
+        label_names:Tuple[str,...],
+        label_values:Tuple[str,...],
+        extra:str = ''
+    ) -> str:
+    """Formats label values as `{name="value",...}` (empty without any)."""
+    pairs = [f'{name}="{value}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Histogram:
+    """Class for a Histogram of Observations (i.e. durations in seconds) by Label Values
+
+    Only the count of each bucket, the sum and the count are kept per series, so observing is
+    O(log buckets) and the memory doesn't grow with the number of observations.
+    """
+    def __init__(
+            self,
+            name:str,
+            description:str,
+            label_names:Tuple[str,...] = (),
+            buckets:Tuple[float,...] = METRICS_BUCKETS
+        ) -> None:
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # label values -> [count of each bucket and of +Inf, sum]
+        self.series:Dict[Tuple[str,...],List[float]] = {}
+
+    def observe(
+            self,
+            value:float,
+            *label_values:str
+        ) -> None:
+        """Records an observation.
+
+        Args:
+            value (float): The observed value (i.e. seconds).
+            *label_values (str): The value of each label, in the order of `label_names`.
+
+        Returns:
+            None
+        """
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[bucket] += 1
+            series[-1] += value
+
+    def render(self) -> List[str]:
+        """Renders the histogram in the Prometheus text format.
+
+        Returns:
+            List[str]: The lines of the histogram.
+        """
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = {values: list(counts) for values, counts in self.series.items()}
+        for values, counts in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts[:-1]):
+                cumulative += count
+                le_label = 'le="' + (bound if isinstance(bound, str) else f"{bound:g}") + '"'
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, values, le_label)}"
+                             f" {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, values)} {counts[-1]:.6g}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, values)} {cumulative}")
+        return lines
+
+class _StageTimer:
+    """Context manager that observes the seconds spent in its block."""
+    __slots__ = ('histogram', 'label_values', 'start')
+
+    def __init__(
+            self,
+            histogram:Histogram,
+            label_values:Tuple[str,...]
+        ) -> None:
+        self.histogram = histogram
+        self.label_values = label_values
+        self.start = 0.0
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info) -> None:
+        self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+
+class MetricsRegistry:
+    """Class for the Registry of Metrics, rendered for a `/metrics` endpoint
+
+    Histograms are updated as stages run, but only while `enabled`: otherwise `timed` returns a
+    shared no-op context manager and `observe` returns right away, so the instrumentation costs
+    next to nothing when it's off. Gauges and counters that other objects already keep (gallery
+    size, cache counters, queue depth) are registered as callbacks, only sampled when rendered.
+    """
+    def __init__(
+            self,
+            enabled:bool = RECOGNITION_METRICS
+        ) -> None:
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.histograms:Dict[str,Histogram] = {}
+        # name -> (description, type, label names, callback)
+        self.callbacks:Dict[str,Tuple[str, str, Tuple[str,...], Callable]] = {}
+        self.stages = self.histogram(STAGE_HISTOGRAM, "Seconds spent in each stage of the"
+                                     " recognition (library calls).", ('stage',))
+
+    def histogram(
+            self,
+            name:str,
+            description:str,
+            label_names:Tuple[str,...] = ()
+        ) -> Histogram:
+        """Gets a histogram, creating it on first use.
+
+        Args:
+            name (str): The name of the metric.
+            description (str): The help text of the metric.
+            label_names (Tuple[str,...]): The names of its labels. Defaults to ().
+
+        Returns:
+            Histogram: The histogram.
+        """
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(name, description, label_names)
+            return self.histograms[name]
+
+    def register(
+            self,
+            name:str,
+            description:str,
+            callback:Callable[[], Union[float, Dict[Tuple[str,...],float]]],
+            metric_type:str = 'gauge',
+            label_names:Tuple[str,...] = ()
+        ) -> None:
+        """Registers a gauge or counter whose value is read from a callback when rendering.
+
+        Args:
+            name (str): The name of the metric.
+            description (str): The help text of the metric.
+            callback (Callable[[], Union[float, Dict[Tuple[str,...],float]]]): Gets the value, or
+                the value of each series by label values (None when there's nothing to report).
+            metric_type (str): 'gauge' or 'counter'. Defaults to 'gauge'.
+            label_names (Tuple[str,...]): The names of its labels. Defaults to ().
+
+        Returns:
+            None
+        """
+        with self.lock:
+            self.callbacks[name] = (description, metric_type, label_names, callback)
+
+    def observe(
+            self,
+            histogram:Histogram,
+            value:float,
+            *label_values:str
+        ) -> None:
+        """Records an observation in a histogram, if the metrics are on.
+
+        Args:
+            histogram (Histogram): The histogram.
+            value (float): The observed value (i.e. seconds).
+            *label_values (str): The value of each label.
+
+        Returns:
+            None
+        """
+        if self.enabled:
+            histogram.observe(value, *label_values)
+
+    def render(self) -> str:
+        """Renders every metric in the Prometheus text format.
+
+        Returns:
+            str: The metrics, one sample per line.
+        """
+        lines = []
+        with self.lock:
+            histograms = list(self.histograms.values())
+            callbacks = list(self.callbacks.items())
+        for name, (description, metric_type, label_names, callback) in callbacks:
+            value = callback()
+            if value is None:
+                continue
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {metric_type}"]
+            if not isinstance(value, dict):
+                value = {(): value}
+            for values, sample in sorted(value.items()):
+                lines.append(f"{name}{_labels(label_names, values)} {sample:.6g}")
+        for histogram in histograms:
+            lines += histogram.render()
+        return '\n'.join(lines) + '\n'
+
+# Process-wide registry (the stages of worker processes are recorded in their own registry)
+REGISTRY = MetricsRegistry()
+
+def timed(
+        stage:str
+    ):
+    """Times a block as a stage of the library in the process-wide registry (a no-op when the
+       metrics are off).
+
+    Args:
+        stage (str): The name of the stage.
+
+    Returns:
+        A context manager.
+
+    Example:
+        with timed('search'):
+            vectordb.search(descriptors, k)
+    """
+    if not REGISTRY.enabled:
+        return _NULL_TIMER
+    return _StageTimer(REGISTRY.stages, (stage,))
+
+def enable_metrics(
+        enabled:bool = True
+    ) -> None:
+    """Turns the metrics of the process-wide registry on or off.
+
+    Args:
+        enabled (bool): Whether to record the metrics. Defaults to True.
+
+    Returns:
+        None
+    """
+    REGISTRY.enabled = enabled
+
+def server_timing(
+        timings:Dict[str,float],
+        total:Optional[float] = None
+    ) -> str:
+    """Formats the time spent in each stage as a `Server-Timing` header.
+
+    Args:
+        timings (Dict[str,float]): The time spent in each stage, in milliseconds.
+        total (Optional[float]): The total time of the request, in milliseconds. Defaults to None.
+
+    Returns:
+        str: The header value (i.e. `imdecode;dur=1.2, represent;dur=8.5`).
+    """
+    entries = [f"{stage};dur={ms:.3f}" for stage, ms in timings.items()]
+    if total is not None:
+        entries.append(f"total;dur={total:.3f}")
+    return ', '.join(entries)
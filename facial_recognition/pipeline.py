@@ -0,0 +1,340 @@
+"""Streaming Face Recognition Pipeline Functionality"""
+# pylint: disable=E1101,E0401,C0413
+from typing import Literal, List, Dict, Optional, Union, Iterable, Iterator, Callable
+import os
+import time
+import queue
+import threading
+import cv2
+import dlib
+import numpy as np
+from .detect import FaceDetection, DETECT_MAX_SIZE
+from .align import FaceAlignment
+from .represent import FaceRepresentation
+from .identify import FaceIdentification
+
+PIPELINE_QUEUE_SIZE = 2
+# Number of faces aligned per frame
+PIPELINE_MAX_NUM_FACES = 4
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+# Seconds between checks of the stop event while blocked on a queue
+_POLL_INTERVAL = 0.1
+# Marks the end of the stream in the stage queues
+_END = object()
+
+def read_frames(
+        source:Union[int, str],
+        width:Optional[int] = None,
+        height:Optional[int] = None
+    ) -> Iterator[np.ndarray]:
+    """Reads the BGR frames of a camera, a video file or a directory of images.
+
+    Args:
+        source (Union[int, str]): The camera ID, the path of the video file or the path of the
+                                  directory (its images are read in name order).
+        width (Optional[int]): The frame width to request from a camera. Defaults to None.
+        height (Optional[int]): The frame height to request from a camera. Defaults to None.
+
+    Returns:
+        Iterator[np.ndarray]: The BGR frames.
+
+    Example:
+        for frame in read_frames(0):
+            cv2.imshow('Camera', frame)
+    """
+    if isinstance(source, str) and os.path.isdir(source):
+        for file in sorted(os.listdir(source)):
+            if file.lower().endswith(IMAGE_EXTENSIONS):
+                frame = cv2.imread(os.path.join(source, file))
+                if frame is not None:
+                    yield frame
+        return
+    cap = cv2.VideoCapture(source)
+    if width is not None and height is not None:
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+    try:
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            yield frame
+    finally:
+        cap.release()
+
+class FrameResult:
+    """Class for the Results of the Pipeline on a Frame
+
+    Attributes:
+        index (int): The position of the frame in the source (counting dropped frames).
+        frame (np.ndarray): The frame as read from the source.
+        frame_rgb (np.ndarray): The RGB frame.
+        faces (List[dlib.rectangle]): The detected faces.
+        landmarks (np.ndarray): The (n_faces, n_points, 2) landmark coordinates of the faces.
+        descriptors (Optional[np.ndarray]): The (n, dimensions) descriptors of the faces (None if
+                                            the pipeline doesn't represent faces).
+        distances (Optional[List]): The distances of the nearest neighbors of each face (None if
+                                    the pipeline doesn't identify faces).
+        neighbors (Optional[List]): The names of the nearest neighbors of each face (None if the
+                                    pipeline doesn't identify faces).
+        timings (Dict[str,float]): The time spent in each stage, in milliseconds.
+        dropped (int): The number of stale frames dropped since the previous result.
+    """
+    def __init__(
+            self,
+            index:int,
+            frame:np.ndarray,
+            frame_rgb:np.ndarray,
+            dropped:int = 0
+        ) -> None:
+        self.index = index
+        self.frame = frame
+        self.frame_rgb = frame_rgb
+        self.faces:List[dlib.rectangle] = []
+        self.landmarks = np.empty((0, 0, 2), dtype='int32')
+        self.descriptors:Optional[np.ndarray] = None
+        self.distances:Optional[List] = None
+        self.neighbors:Optional[List] = None
+        self.timings:Dict[str,float] = {}
+        self.dropped = dropped
+
+class FacePipeline:
+    """Class for the Face Recognition Pipeline (detect → align → represent → identify)
+
+    `process` runs every stage on a single frame, while `stream` runs each stage in its own thread,
+    connected by bounded queues, so that a frame is being detected while the previous one is being
+    aligned, and so on. The throughput is then that of the slowest stage rather than that of all
+    the stages together. With `drop_stale` the frames that arrive while the first stage is busy
+    replace the one waiting for it, so live sources (cameras) are always processed with the
+    least latency; without it every frame is processed (video files, directories).
+
+    `stages` is the last stage to run (i.e. 'align' to only detect and align faces), and the
+    models of the stages that don't run are never loaded. The default landmark predictor tracks
+    the face meshes between frames, so give it one with `static_image_mode` to process unrelated
+    images. With `roi`, the default models detect faces on a downscaled frame and only run the
+    mesh on a crop around each face, for high resolution sources.
+    """
+    def __init__(
+            self,
+            face_detector:Optional[FaceDetection] = None,
+            landmark_predictor:Optional[FaceAlignment] = None,
+            face_descriptor:Optional[FaceRepresentation] = None,
+            face_identifier:Optional[FaceIdentification] = None,
+            stages:Literal['detect', 'align', 'represent', 'identify'] = 'identify',
+            k:int = 1,
+            color:Literal['bgr', 'rgb'] = 'bgr',
+            queue_size:int = PIPELINE_QUEUE_SIZE,
+            drop_stale:bool = True,
+            roi:bool = False
+        ) -> None:
+        self.stage_names = ['detect', 'align', 'represent', 'identify']
+        self.stage_names = self.stage_names[:self.stage_names.index(stages) + 1]
+        self.face_detector = face_detector or\
+                             FaceDetection(max_size=DETECT_MAX_SIZE if roi else None)
+        self.landmark_predictor = None
+        self.face_descriptor = None
+        self.face_identifier = None
+        if 'align' in self.stage_names:
+            self.landmark_predictor = landmark_predictor or\
+                                      FaceAlignment(static_image_mode=False,\
+                                                    max_num_faces=PIPELINE_MAX_NUM_FACES, roi=roi)
+        if 'represent' in self.stage_names:
+            self.face_descriptor = face_descriptor or FaceRepresentation()
+        if 'identify' in self.stage_names:
+            self.face_identifier = face_identifier or FaceIdentification()
+        self.k = k
+        self.color = color
+        self.queue_size = queue_size
+        self.drop_stale = drop_stale
+
+    def _detect(
+            self,
+            result:FrameResult
+        ) -> None:
+        """Detects the faces of a frame."""
+        result.faces = self.face_detector.detect(result.frame_rgb)
+
+    def _align(
+            self,
+            result:FrameResult
+        ) -> None:
+        """Aligns the faces of a frame."""
+        if result.faces:
+            # faces without landmarks are left out, to keep `faces` in step with `landmarks`
+            result.faces, result.landmarks = self.landmark_predictor.align_array(result.frame_rgb,\
+                                                                                 result.faces)
+
+    def _represent(
+            self,
+            result:FrameResult
+        ) -> None:
+        """Represents the faces of a frame."""
+        result.descriptors = self.face_descriptor.represent(result.frame_rgb, result.landmarks)
+
+    def _identify(
+            self,
+            result:FrameResult
+        ) -> None:
+        """Identifies the faces of a frame."""
+        if len(result.descriptors) == 0:
+            result.distances, result.neighbors = [], []
+            return
+        result.distances, result.neighbors = self.face_identifier.identify(result.descriptors,\
+                                                                           k=self.k)
+
+    def _stages(self) -> List[Callable[[FrameResult], None]]:
+        """Gets the functions of the stages to run, in order."""
+        stages = {'detect': self._detect, 'align': self._align,\
+                  'represent': self._represent, 'identify': self._identify}
+        return [stages[name] for name in self.stage_names]
+
+    def _new_result(
+            self,
+            index:int,
+            frame:np.ndarray
+        ) -> FrameResult:
+        """Wraps a frame read from the source in a result."""
+        frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) if self.color == 'bgr' else frame
+        return FrameResult(index, frame, frame_rgb)
+
+    def _run_stage(
+            self,
+            name:str,
+            stage:Callable[[FrameResult], None],
+            result:FrameResult
+        ) -> None:
+        """Runs a stage on a frame, timing it."""
+        stage_start = time.perf_counter()
+        stage(result)
+        result.timings[name] = (time.perf_counter() - stage_start) * 1000
+
+    def process(
+            self,
+            frame:np.ndarray
+        ) -> FrameResult:
+        """Runs every stage of the pipeline on a single frame.
+
+        Args:
+            frame (np.ndarray): The frame (in the pipeline's `color` order).
+
+        Returns:
+            FrameResult: The results of the pipeline on the frame.
+        """
+        result = self._new_result(0, frame)
+        for name, stage in zip(self.stage_names, self._stages()):
+            self._run_stage(name, stage, result)
+        return result
+
+    def stream(
+            self,
+            frames:Iterable[np.ndarray]
+        ) -> Iterator[FrameResult]:
+        """Runs the pipeline on a sequence of frames, with every stage in its own thread.
+
+        Results are yielded lazily and in order. Frames are read from `frames` in a capture thread
+        too, so reading (i.e. waiting for the camera) overlaps with the other stages. Closing the
+        generator (or breaking out of the loop over it) stops every thread.
+
+        Args:
+            frames (Iterable[np.ndarray]): The frames (in the pipeline's `color` order), i.e. from
+                                           `read_frames`.
+
+        Returns:
+            Iterator[FrameResult]: The results of the pipeline on each frame that wasn't dropped.
+
+        Raises:
+            Exception: Any exception raised by a stage or by `frames`, once the results before it
+                       have been yielded.
+
+        Example:
+            for result in FacePipeline().stream(read_frames(0)):
+                draw_bounding_boxes(result.frame, result.faces)
+        """
+        stop = threading.Event()
+        queues = [queue.Queue(maxsize=self.queue_size)\
+                  for _ in range(len(self.stage_names) + 1)]
+
+        def put(
+                out_queue:queue.Queue,
+                item
+            ) -> bool:
+            """Puts an item in a queue, blocking until there's room or the stream is stopped."""
+            while not stop.is_set():
+                try:
+                    out_queue.put(item, timeout=_POLL_INTERVAL)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def get(
+                in_queue:queue.Queue
+            ):
+            """Gets an item from a queue, blocking until there's one or the stream is stopped."""
+            while not stop.is_set():
+                try:
+                    return in_queue.get(timeout=_POLL_INTERVAL)
+                except queue.Empty:
+                    pass
+            return _END
+
+        def capture() -> None:
+            """Reads the frames into the first queue, replacing the waiting one if `drop_stale`."""
+            out_queue = queues[0]
+            try:
+                for index, frame in enumerate(frames):
+                    if stop.is_set():
+                        return
+                    result = self._new_result(index, frame)
+                    if not self.drop_stale:
+                        if not put(out_queue, result):
+                            return
+                        continue
+                    while True:
+                        try:
+                            out_queue.put_nowait(result)
+                            break
+                        except queue.Full:
+                            try:
+                                result.dropped += out_queue.get_nowait().dropped + 1
+                            except queue.Empty:
+                                pass
+            except Exception as exc: # pylint: disable=W0718
+                put(out_queue, exc)
+            put(out_queue, _END)
+
+        def work(
+                name:str,
+                stage:Callable[[FrameResult], None],
+                in_queue:queue.Queue,
+                out_queue:queue.Queue
+            ) -> None:
+            """Runs a stage on every frame of its input queue."""
+            while True:
+                item = get(in_queue)
+                if isinstance(item, FrameResult):
+                    try:
+                        self._run_stage(name, stage, item)
+                    except Exception as exc: # pylint: disable=W0718
+                        item = exc
+                if not put(out_queue, item) or item is _END or isinstance(item, Exception):
+                    return
+
+        threads = [threading.Thread(target=capture, name='pipeline-capture', daemon=True)]
+        for i, (name, stage) in enumerate(zip(self.stage_names, self._stages())):
+            threads.append(threading.Thread(target=work, name=f"pipeline-{name}", daemon=True,\
+                                            args=(name, stage, queues[i], queues[i + 1])))
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = get(queues[-1])
+                if item is _END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
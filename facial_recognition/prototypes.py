@@ -0,0 +1,190 @@
+"""Per-identity Prototype Index (Two-stage Search) Functionality"""
+# pylint: disable=E1101,E0401,C0413
+from typing import Dict, List, Optional, Tuple
+import faiss
+import numpy as np
+from .gallery import FaceGallery, ReadWriteLock
+
+# Number of candidate identities whose raw descriptors are re-ranked
+PROTOTYPE_CANDIDATES = 8
+# Number of descriptors whose candidates are re-ranked at a time
+RERANK_GROUP_SIZE = 64
+
+class PrototypeIndex:
+    """Class for the Index of Identity Prototypes (centroids) of a Gallery, for Two-stage Search
+
+    Each identity is summarized by the centroid of its descriptors in a small secondary FAISS
+    index (one vector per identity instead of up to `MAX_FACES_PER_NAME`). A search first finds
+    the `candidates` nearest centroids and then re-ranks only the raw descriptors of those
+    identities, reconstructed from the gallery by row (only the rows of each identity are kept
+    alongside, the descriptors stay in the gallery). With `rerank` disabled only
+    the centroids are searched, a compact model for edge deployments.
+
+    The index follows the gallery: it subscribes to its changes, so the prototypes of the
+    identities that are enrolled (i.e. by `FaceRepresentation.add_to_vectordb`), deleted or
+    reloaded are updated incrementally.
+    """
+    def __init__(
+            self,
+            gallery:Optional[FaceGallery] = None,
+            candidates:int = PROTOTYPE_CANDIDATES,
+            rerank:bool = True
+        ) -> None:
+        if gallery is None:
+            gallery = FaceGallery.shared()
+        self.gallery = gallery
+        self.candidates = candidates
+        self.rerank = rerank
+        self.lock = ReadWriteLock()
+        if gallery.metric == 'euclidean':
+            self.index = faiss.IndexIDMap2(faiss.IndexFlatL2(gallery.dimensions))
+        else:
+            self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(gallery.dimensions))
+        # label -> rows of the identity in the gallery, for the re-ranking
+        self.members:Dict[int,np.ndarray] = {}
+        self.update(list(gallery.label_names))
+        gallery.subscribe(self._on_change)
+
+    def _on_change(
+            self,
+            event:str,
+            names:List[str]
+        ) -> None:
+        """Updates the prototypes after a change of the gallery."""
+        if event == 'reload':
+            with self.lock.write():
+                self.index.reset()
+                self.members = {}
+            names = list(self.gallery.label_names)
+        self.update(names)
+
+    def update(
+            self,
+            names:List[str]
+        ) -> None:
+        """Recomputes the prototypes of some identities from their descriptors in the gallery.
+
+        Args:
+            names (List[str]): The names of the identities (those without descriptors left are
+                               removed).
+
+        Returns:
+            None
+        """
+        labels, centroids, members = [], [], {}
+        with self.gallery.lock.read():
+            labels = [self.gallery.label_ids[name] for name in names\
+                      if name in self.gallery.label_ids]
+            # the rows in the index (rather than in the metadata store) match its embeddings
+            label_rows = self.gallery.label_rows(labels)
+            for label in labels:
+                rows = label_rows.get(label)
+                if rows is None:
+                    continue
+                descriptors = self.gallery.vectordb.reconstruct_batch(rows)
+                centroid = descriptors.mean(axis=0)
+                if self.gallery.metric == 'cosine':
+                    centroid /= max(float(np.linalg.norm(centroid)), 1e-12)
+                members[label] = rows
+                centroids.append(centroid)
+        if not labels:
+            return
+        with self.lock.write():
+            self.index.remove_ids(np.array(labels, dtype='int64'))
+            for label in labels:
+                self.members.pop(label, None)
+            if members:
+                self.index.add_with_ids(np.array(centroids, dtype='float32'),\
+                                        np.array(list(members), dtype='int64'))
+                self.members.update(members)
+
+    @property
+    def num_prototypes(self) -> int:
+        """int: The number of identities in the index."""
+        return self.index.ntotal
+
+    def search(
+            self,
+            descriptors:np.ndarray,
+            k:int = 1
+        ) -> Tuple[np.ndarray, np.ndarray]:
+        """Searches the k nearest neighbors of the descriptors among the raw descriptors of their
+           nearest identities (same results as `FaceGallery.search` when the true neighbors belong
+           to one of the `candidates` nearest centroids).
+
+        Args:
+            descriptors (np.ndarray): The (n, dimensions) descriptors to search for.
+            k (int): The number of nearest neighbors to search for. Defaults to 1.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The (n, k) distances and gallery rows of the neighbors
+                                           (-1 when there are fewer than k). Without `rerank`, the
+                                           distances to the nearest centroids and a row of each
+                                           of their identities.
+        """
+        descriptors = np.ascontiguousarray(descriptors, dtype='float32')
+        euclidean = self.gallery.metric == 'euclidean'
+        distances = np.full((descriptors.shape[0], k), np.inf if euclidean else -np.inf,\
+                            dtype='float32')
+        rows = np.full((descriptors.shape[0], k), -1, dtype='int64')
+        with self.lock.read():
+            if self.index.ntotal == 0 or descriptors.shape[0] == 0:
+                return distances, rows
+            num_candidates = k if not self.rerank else max(k, self.candidates)
+            centroid_distances, labels = self.index.search(descriptors,\
+                                                           min(num_candidates, self.index.ntotal))
+            if not self.rerank:
+                found = labels[:, :k] >= 0
+                distances[:, :labels.shape[1]][found] = centroid_distances[:, :k][found]
+                rows[:, :labels.shape[1]][found] = [self.members[label][0]\
+                                                    for label in labels[:, :k][found]]
+                return distances, rows
+            empty = np.empty(0, dtype='int64')
+            candidate_rows = [np.concatenate([empty] + [self.members[label] for label in\
+                                                        query_labels if label >= 0])\
+                              for query_labels in labels]
+        return self._rerank(descriptors, k, candidate_rows)
+
+    def _rerank(
+            self,
+            descriptors:np.ndarray,
+            k:int,
+            candidate_rows:List[np.ndarray]
+        ) -> Tuple[np.ndarray, np.ndarray]:
+        """Computes the distances of each descriptor to the raw descriptors of its own candidate
+           rows only, reconstructed from the gallery `RERANK_GROUP_SIZE` descriptors at a time (so
+           the cost doesn't grow with the size of the gallery, nor with that of the batch)."""
+        euclidean = self.gallery.metric == 'euclidean'
+        num_descriptors = descriptors.shape[0]
+        distances = np.full((num_descriptors, k), np.inf if euclidean else -np.inf,\
+                            dtype='float32')
+        rows = np.full((num_descriptors, k), -1, dtype='int64')
+        for start in range(0, num_descriptors, RERANK_GROUP_SIZE):
+            group = candidate_rows[start:start + RERANK_GROUP_SIZE]
+            width = max(len(group_rows) for group_rows in group)
+            if width == 0:
+                continue
+            padded = np.full((len(group), width), -1, dtype='int64')
+            for i, group_rows in enumerate(group):
+                padded[i, :len(group_rows)] = group_rows
+            # rows deleted since the prototypes were last updated are left out too
+            missing = self.gallery.labels_of(padded) < 0
+            padded[missing] = -1
+            unique, positions = np.unique(padded, return_inverse=True)
+            with self.gallery.lock.read():
+                vectors = self.gallery.vectordb.reconstruct_batch(np.maximum(unique, 0))
+            candidates = vectors[positions.reshape(padded.shape)]
+            queries = descriptors[start:start + len(group), None, :]
+            if euclidean:
+                scores = ((candidates - queries) ** 2).sum(axis=2)
+                scores[missing] = np.inf
+                order = np.argsort(scores, axis=1, kind='stable')[:, :k]
+            else:
+                scores = (candidates * queries).sum(axis=2)
+                scores[missing] = -np.inf
+                order = np.argsort(-scores, axis=1, kind='stable')[:, :k]
+            end = start + len(group)
+            distances[start:end, :order.shape[1]] = np.take_along_axis(scores, order, axis=1)
+            rows[start:end, :order.shape[1]] = np.take_along_axis(padded, order, axis=1)
+        rows[~np.isfinite(distances)] = -1
+        return distances, rows
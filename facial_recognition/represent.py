@@ -1,102 +1,206 @@
 """Represent Faces (with Descriptors) and store in Vector DB Functionality"""
 # pylint: disable=E1101,E0401,C0413
-from typing import Literal, List, Union
+from typing import Literal, List, Union, Optional
 import os
-from pkg_resources import resource_filename
+from importlib.resources import files
 import dlib
 import faiss
-import joblib
 import numpy as np
+from ._utils import landmarks_to_dlib
+from .metrics import timed
+from .gallery import FaceGallery, VECTOR_METRIC, VECTOR_DIMENSIONS, VECTOR_STORAGE,\
+                     VECTOR_LOG_COMPACT_EVERY, VECTOR_INDEX_TYPE
 
-VECTOR_DB_PATH = os.path.join(os.path.dirname(__file__),\
-                                     '../data/vectordb/faces_l2.faiss')
-VECTOR_KEYS_PATH = os.path.join(os.path.dirname(__file__),\
-                                     '../data/vectordb/faces_l2.pkl')
-VECTOR_METRIC = 'euclidean'
-VECTOR_DIMENSIONS = 128
-DLIB_FACE_RECOGNITION_MDL_PATH = resource_filename(__name__,\
-                                        '../models/dlib_face_recognition_resnet_model_v1.dat')
+DLIB_FACE_RECOGNITION_MDL_PATH = os.path.normpath(files(__package__).joinpath(\
+                                        '../models/dlib_face_recognition_resnet_model_v1.dat'))
 class FaceRepresentation:
-    """Class for Face Representation (aka Face Descriptor)"""
+    """Class for Face Representation (aka Face Descriptor)
+
+    Neither the ResNet model nor the gallery are loaded until they are first used, so instances
+    that only enroll or only describe faces never pay for the other.
+    """
     def __init__(
             self,
             metric:Literal['euclidean', 'cosine'] = VECTOR_METRIC,
-            dimensions:int = VECTOR_DIMENSIONS
+            dimensions:int = VECTOR_DIMENSIONS,
+            storage:Literal['snapshot', 'log'] = VECTOR_STORAGE,
+            compact_every:int = VECTOR_LOG_COMPACT_EVERY,
+            index_type:Literal['flat', 'ivf', 'hnsw', 'ivfpq'] = VECTOR_INDEX_TYPE,
+            gallery:Optional[FaceGallery] = None
         ) -> None:
-        self.recognizer = dlib.face_recognition_model_v1(DLIB_FACE_RECOGNITION_MDL_PATH)
+        self._recognizer = None
         self.metric = metric
         self.dimensions = dimensions
-        self.vectordb = None
-        self.vectorkeys = []
-        self.num_records = 0
-        if os.path.exists(VECTOR_DB_PATH):
-            self.vectordb:faiss.IndexFlat = faiss.read_index(VECTOR_DB_PATH)
-            self.metric = 'euclidean' if self.vectordb.metric_type == 1 else 'cosine'
-            self.num_records = self.vectordb.ntotal
-            if os.path.exists(VECTOR_KEYS_PATH):
-                self.vectorkeys = joblib.load(VECTOR_KEYS_PATH)
-        else:
-            if self.metric == 'euclidean':
-                self.vectordb:faiss.IndexFlat = faiss.IndexFlatL2(dimensions)
-            elif self.metric == 'cosine':
-                self.vectordb:faiss.IndexFlat = faiss.IndexFlatIP(dimensions)
+        self._gallery_args = (metric, dimensions, storage, compact_every, index_type)
+        self._gallery = gallery
+        if gallery is not None:
+            self.metric = gallery.metric
+            self.dimensions = gallery.dimensions
+
+    @property
+    def recognizer(self) -> dlib.face_recognition_model_v1:
+        """dlib.face_recognition_model_v1: The ResNet model computing the descriptors, loaded on
+           first use."""
+        if self._recognizer is None:
+            self._recognizer = dlib.face_recognition_model_v1(DLIB_FACE_RECOGNITION_MDL_PATH)
+        return self._recognizer
+
+    @property
+    def gallery(self) -> FaceGallery:
+        """FaceGallery: The gallery embeddings are added to (the process-wide shared gallery unless
+           one was given). It's only loaded on first use, so instances that only `represent`
+           faces (i.e. in worker processes) never load it."""
+        if self._gallery is None:
+            metric, dimensions, storage, compact_every, index_type = self._gallery_args
+            self._gallery = FaceGallery.shared(metric, dimensions, storage, compact_every,\
+                                               index_type=index_type)
+            self.metric = self._gallery.metric
+            self.dimensions = self._gallery.dimensions
+        return self._gallery
+
+    @property
+    def vectordb(self) -> faiss.Index:
+        """faiss.Index: The index of the shared gallery."""
+        return self.gallery.vectordb
+
+    @property
+    def vectorkeys(self) -> List[Union[str,int]]:
+        """List[Union[str,int]]: The keys of the shared gallery."""
+        return self.gallery.vectorkeys
+
+    @property
+    def num_records(self) -> int:
+        """int: The number of embeddings in the shared gallery."""
+        return self.gallery.num_records
 
     def represent(
             self,
             img_rgb:np.ndarray,
-            landmarks:List[dlib.full_object_detection]
-        ) -> List[np.ndarray]:
+            landmarks:Union[List[dlib.full_object_detection], np.ndarray]
+        ) -> np.ndarray:
         """Represent the given image with facial descriptors given their facial landmarks.
 
+        All the faces are computed in a single call to the recognizer.
+
         Args:
             img_rgb (np.ndarray): The RGB image to represent.
-            landmarks (List[dlib.full_object_detection]): The list of facial landmarks.
+            landmarks (Union[List[dlib.full_object_detection], np.ndarray]): The list of facial
+                                                                             landmarks, or their
+                                                                             (n_faces, n_points,
+                                                                             2) array.
 
         Returns:
-            List[np.ndarray]: The list of descriptors representing the image with facial landmarks.
+            np.ndarray: The (n, dimensions) float32 descriptors representing the image with facial
+                        landmarks, one row per face.
         """
-        descriptors = [np.array(self.recognizer.compute_face_descriptor(img_rgb, landmark,\
-                                                                            num_jitters=1))\
-                       for landmark in landmarks]
-        return descriptors
+        if len(landmarks) == 0:
+            return np.empty((0, self.dimensions), dtype='float32')
+        if isinstance(landmarks, np.ndarray):
+            landmarks = landmarks_to_dlib(landmarks)
+        with timed('represent'):
+            descriptors = self.recognizer.compute_face_descriptor(img_rgb,\
+                                                        dlib.full_object_detections(landmarks),\
+                                                        num_jitters=1)
+        return np.array(descriptors, dtype='float32')
+
+    def represent_batch(
+            self,
+            imgs_rgb:List[np.ndarray],
+            landmarks:List[List[dlib.full_object_detection]]
+        ) -> np.ndarray:
+        """Represent many images (i.e. frames or enrollment photos) with facial descriptors given
+           their facial landmarks.
+
+        All the faces of all the images are computed in a single (batched) call to the recognizer.
+
+        Args:
+            imgs_rgb (List[np.ndarray]): The RGB images to represent.
+            landmarks (List[List[dlib.full_object_detection]]): The list of facial landmarks of
+                                                                each image.
+
+        Returns:
+            np.ndarray: The (n, dimensions) float32 descriptors of every face, in order of image and
+                        then of face within the image.
+        """
+        batch_imgs = []
+        batch_faces = []
+        for img_rgb, img_landmarks in zip(imgs_rgb, landmarks):
+            if len(img_landmarks) > 0:
+                batch_imgs.append(img_rgb)
+                batch_faces.append(dlib.full_object_detections(img_landmarks))
+        if len(batch_imgs) == 0:
+            return np.empty((0, self.dimensions), dtype='float32')
+        with timed('represent_batch'):
+            descriptors = self.recognizer.compute_face_descriptor(batch_imgs, batch_faces,\
+                                                                  num_jitters=1)
+        return np.array([d for img_descriptors in descriptors for d in img_descriptors],\
+                        dtype='float32')
 
     def add_to_vectordb(
             self,
             embeddings:np.ndarray,
-            ids:List[Union[str,int]] = None
-        ) -> None:
+            ids:List[Union[str,int]] = None,
+            qualities:Optional[List[Optional[float]]] = None,
+            max_per_name:Optional[int] = None
+        ) -> np.ndarray:
         """Adds embeddings to the VectorDB.
 
         Args:
             embeddings (np.ndarray): The embeddings to be added to the VectorDB.
             ids (List[Union[str,int]], optional): The IDs associated with the embeddings.
                                                   Defaults to None.
+            qualities (Optional[List[Optional[float]]]): The quality score of each face, recorded
+                                                         in the metadata store. Defaults to None.
+            max_per_name (Optional[int]): The maximum number of embeddings per name, counted
+                                          and enforced in the same write as the enrollment (the
+                                          ones beyond it are left out). Defaults to None.
 
         Returns:
-            None
+            np.ndarray: The mask of the embeddings that were added.
 
         Raises:
             AssertionError: If the length of `ids` is not equal to the length of `embeddings`.
 
         Note:
-            If `ids` is not provided, it will generate IDs automatically.
+            - If `ids` is not provided, it will generate IDs automatically.
+            - The embeddings are added to the shared gallery in place, so they are searchable by
+              every `FaceIdentification` using it as soon as this returns.
+            - With 'log' storage the embeddings are appended to the log in O(1) and merged into
+              a new snapshot by a background compaction every `compact_every` records. With
+              'snapshot' storage the whole index and keys are rewritten on every call.
 
         Example:
             add_to_vectordb(embeddings, ids)
         """
-        if (self.num_records==0) and (self.metric == 'cosine'):
-            faiss.normalize_L2(embeddings)
-        emb_len = embeddings.shape[0]
-        new_total = self.num_records + emb_len
-        self.vectordb.add(embeddings)
-        if ids is None:
-            ids = self.vectorkeys([*range(self.num_records,new_total)])
-        else:
-            assert emb_len == len(ids)
-        self.vectorkeys.extend(ids)
-        joblib.dump(self.vectorkeys, VECTOR_KEYS_PATH)
-        faiss.write_index(self.vectordb, VECTOR_DB_PATH)
-        self.num_records = new_total
+        return self.gallery.add(embeddings, ids, qualities, max_per_name)
+
+    def delete_from_vectordb(
+            self,
+            name:str
+        ) -> int:
+        """Deletes every embedding enrolled for a name from the VectorDB.
+
+        Args:
+            name (str): The name to delete.
+
+        Returns:
+            int: The number of embeddings deleted.
+        """
+        return self.gallery.delete(name)
+
+    def compact(
+            self,
+            block:bool = False
+        ) -> None:
+        """Merges the sealed log segments into a fresh snapshot of the Vector DB.
+
+        Args:
+            block (bool): Whether to wait for the compaction to finish. Defaults to False.
+
+        Returns:
+            None
+        """
+        self.gallery.compact(block)
 
     def convert_landmarks(
             self,
@@ -113,8 +217,6 @@ class FaceRepresentation:
         Returns:
             List[dlib.full_object_detection]: A list of dlib.full_object_detection objects.
         """
-        rect = dlib.rectangle(bb[0], bb[1], bb[2], bb[3])
-        dlib_parts = []
-        for pt in face_landmarks:
-            dlib_parts.append(dlib.point(pt[0], pt[1]))
-        return dlib.full_object_detection(rect=rect, parts=dlib_parts)
+        with timed('convert_landmarks'):
+            rect = dlib.rectangle(bb[0], bb[1], bb[2], bb[3])
+            return landmarks_to_dlib(np.asarray(face_landmarks)[None], [rect])[0]
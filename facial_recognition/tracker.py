@@ -0,0 +1,226 @@
+"""Track Faces (between Detection Keyframes) Functionality"""
+# pylint: disable=E1101,E0401,C0413
+from typing import List, Optional
+import cv2
+import dlib
+import numpy as np
+from .detect import FaceDetection
+from .align import FaceAlignment
+from .pipeline import PIPELINE_MAX_NUM_FACES
+from ._utils import match_rectangles, landmarks_to_dlib
+
+KEYFRAME_EVERY = 10
+MIN_TRACK_CONFIDENCE = 0.6
+MAX_FLOW_ERROR = 1.0
+TRACK_MATCH_IOU = 0.3
+LK_PARAMS = {'winSize': (15, 15), 'maxLevel': 2,\
+             'criteria': (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03)}
+
+class FaceTrack:
+    """Class for a Face Tracked across Frames
+
+    Attributes:
+        track_id (int): The ID of the track, unique within its tracker.
+        face (dlib.rectangle): The bounding box of the face in the current frame.
+        box (np.ndarray): The [x1, y1, x2, y2] coordinates of `face`, without rounding.
+        points (np.ndarray): The (p, 2) float32 coordinates of the landmarks in the current frame
+                             (see `landmarks` for them as a dlib shape).
+        confidence (float): The fraction of landmarks that were tracked reliably into the current
+                            frame (1 on keyframes).
+        fresh (bool): Whether the landmarks come from the landmark predictor (on a keyframe) rather
+                      than from optical flow, so they can be used to represent the face.
+        name (Optional[str]): The name the face was identified as (None until it's identified).
+        distance (Optional[float]): The distance to the identity.
+        identified (bool): Whether the face was identified at least once (even with no match).
+    """
+    def __init__(
+            self,
+            track_id:int,
+            face:dlib.rectangle,
+            points:np.ndarray
+        ) -> None:
+        self.track_id = track_id
+        self.name:Optional[str] = None
+        self.distance:Optional[float] = None
+        self.identified = False
+        self.update(face, points)
+
+    @property
+    def landmarks(self) -> dlib.full_object_detection:
+        """dlib.full_object_detection: The landmarks of the face in the current frame, as a dlib
+           shape (only built when needed, i.e. to represent the face)."""
+        if self._landmarks is None:
+            self._landmarks = landmarks_to_dlib(self.points[None], [self.face])[0]
+        return self._landmarks
+
+    def update(
+            self,
+            face:dlib.rectangle,
+            points:np.ndarray
+        ) -> None:
+        """Updates the track with fresh landmarks from a keyframe.
+
+        Args:
+            face (dlib.rectangle): The rectangle of the face.
+            points (np.ndarray): The (p, 2) coordinates of the landmarks of the face.
+
+        Returns:
+            None
+        """
+        self.face = face
+        self.box = np.array([face.left(), face.top(), face.right(), face.bottom()],\
+                            dtype='float64')
+        self.points = points.astype('float32')
+        self._landmarks:Optional[dlib.full_object_detection] = None
+        self.confidence = 1.0
+        self.fresh = True
+
+    def move(
+            self,
+            points:np.ndarray,
+            good:np.ndarray
+        ) -> None:
+        """Moves the track to the landmarks tracked into a new frame.
+
+        The box is shifted by the median motion of the reliably tracked landmarks and scaled by the
+        change of their spread, and the unreliable landmarks are moved along with the box.
+
+        Args:
+            points (np.ndarray): The (p, 2) tracked coordinates of the landmarks.
+            good (np.ndarray): The (p,) mask of the landmarks that were tracked reliably.
+
+        Returns:
+            None
+        """
+        self.confidence = float(good.mean()) if good.size else 0.0
+        self.fresh = False
+        if good.sum() < 2:
+            return
+        prev, curr = self.points[good], points[good]
+        shift = np.median(curr - prev, axis=0)
+        prev_spread = np.linalg.norm(prev - prev.mean(axis=0), axis=1).mean()
+        curr_spread = np.linalg.norm(curr - curr.mean(axis=0), axis=1).mean()
+        scale = curr_spread / prev_spread if prev_spread > 0 else 1.0
+
+        center = (self.box[:2] + self.box[2:]) / 2 + shift
+        half_size = (self.box[2:] - self.box[:2]) * scale / 2
+        self.box = np.concatenate([center - half_size, center + half_size])
+        self.face = dlib.rectangle(*(int(round(v)) for v in self.box))
+        self.points = np.where(good[:, None], points, self.points + shift).astype('float32')
+        self._landmarks = None
+
+class FaceTracker:
+    """Class for Face Tracking (detection on keyframes, optical flow in between)
+
+    Faces are detected and aligned every `keyframe_every` frames, or as soon as the landmarks of a
+    track can't be followed reliably (i.e. fast motion or occlusion). In between, the landmarks are
+    tracked with pyramidal Lucas-Kanade optical flow (checked forwards and backwards), which is
+    much cheaper than running both models. Faces detected on a keyframe are matched to the existing
+    tracks by IoU, so a track keeps its ID and identity and the face only has to be represented and
+    identified once. Up to `max_num_faces` faces are tracked (when the landmark predictor isn't
+    given).
+    """
+    def __init__(
+            self,
+            face_detector:Optional[FaceDetection] = None,
+            landmark_predictor:Optional[FaceAlignment] = None,
+            keyframe_every:int = KEYFRAME_EVERY,
+            min_confidence:float = MIN_TRACK_CONFIDENCE,
+            max_flow_error:float = MAX_FLOW_ERROR,
+            match_iou:float = TRACK_MATCH_IOU,
+            max_num_faces:int = PIPELINE_MAX_NUM_FACES
+        ) -> None:
+        self.face_detector = face_detector or FaceDetection()
+        self.landmark_predictor = landmark_predictor or\
+                                  FaceAlignment(max_num_faces=max_num_faces)
+        self.keyframe_every = keyframe_every
+        self.min_confidence = min_confidence
+        self.max_flow_error = max_flow_error
+        self.match_iou = match_iou
+        self.tracks:List[FaceTrack] = []
+        self.prev_gray:Optional[np.ndarray] = None
+        self.frames_since_keyframe = 0
+        self.next_track_id = 0
+
+    def _propagate(
+            self,
+            gray:np.ndarray
+        ) -> bool:
+        """Tracks the landmarks of every track into a new frame (in a single optical flow call).
+           Returns whether every track was followed with enough confidence."""
+        if not self.tracks:
+            return True
+        prev_pts = np.concatenate([track.points for track in self.tracks]).reshape(-1, 1, 2)
+        next_pts, status, _ = cv2.calcOpticalFlowPyrLK(self.prev_gray, gray, prev_pts, None,\
+                                                       **LK_PARAMS)
+        back_pts, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, self.prev_gray, next_pts, None,\
+                                                            **LK_PARAMS)
+        flow_error = np.linalg.norm(prev_pts - back_pts, axis=2).ravel()
+        good = (status.ravel() == 1) & (back_status.ravel() == 1) &\
+               (flow_error < self.max_flow_error)
+        next_pts = next_pts.reshape(-1, 2)
+        start = 0
+        for track in self.tracks:
+            end = start + track.points.shape[0]
+            track.move(next_pts[start:end], good[start:end])
+            start = end
+        return all(track.confidence >= self.min_confidence for track in self.tracks)
+
+    def _detect(
+            self,
+            frame_rgb:np.ndarray
+        ) -> None:
+        """Detects and aligns the faces of a keyframe and matches them to the existing tracks."""
+        faces = self.face_detector.detect(frame_rgb)
+        if faces:
+            faces, landmarks = self.landmark_predictor.align_array(frame_rgb, faces)
+        tracks:List[Optional[FaceTrack]] = [None] * len(faces)
+        for t, f in match_rectangles([track.face for track in self.tracks], faces,\
+                                     self.match_iou):
+            self.tracks[t].update(faces[f], landmarks[f])
+            tracks[f] = self.tracks[t]
+        for f, face in enumerate(faces):
+            if tracks[f] is None:
+                tracks[f] = FaceTrack(self.next_track_id, face, landmarks[f])
+                self.next_track_id += 1
+        self.tracks = tracks
+        self.frames_since_keyframe = 0
+
+    def track(
+            self,
+            frame_rgb:np.ndarray
+        ) -> List[FaceTrack]:
+        """Tracks the faces into a new frame.
+
+        Args:
+            frame_rgb (np.ndarray): The RGB frame.
+
+        Returns:
+            List[FaceTrack]: The tracks of the faces in the frame. The ones that are `fresh` and
+                             not `identified` yet should be represented and identified.
+
+        Example:
+            for track in tracker.track(frame_rgb):
+                draw_name(frame, track.face, track.name or "?")
+        """
+        gray = cv2.cvtColor(frame_rgb, cv2.COLOR_RGB2GRAY)
+        keyframe = self.prev_gray is None or self.frames_since_keyframe + 1 >= self.keyframe_every\
+                   or self.prev_gray.shape != gray.shape
+        if not keyframe:
+            keyframe = not self._propagate(gray)
+        if keyframe:
+            self._detect(frame_rgb)
+        else:
+            self.frames_since_keyframe += 1
+        self.prev_gray = gray
+        return self.tracks
+
+    def reset(self) -> None:
+        """Forgets every track, so the next frame is a keyframe.
+
+        Returns:
+            None
+        """
+        self.tracks = []
+        self.prev_gray = None
+        self.frames_since_keyframe = 0
@@ -0,0 +1,475 @@
+"""End-to-end Pipeline Stages (Latency, Throughput, Memory) Benchmark Script"""
+# pylint: disable=E1101,E0401,C0413
+from typing import Callable, Dict, List, Optional, Tuple
+import os
+import sys
+import glob
+import json
+import time
+import base64
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+import urllib.request
+import cv2
+import numpy as np
+sys.path.append("../")
+par_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, par_dir)
+from facial_recognition import FaceDetection, FaceAlignment, FaceRepresentation,\
+                               FaceIdentification, FaceGallery
+from facial_recognition._vectorindex import build_index
+from facial_recognition._vectorlog import write_snapshot
+from benchmark_index import load_gallery, make_queries
+
+# Constants
+NUM_ITERATIONS = 200
+NUM_WARMUP = 5
+FRAME_SIZE = (640, 480)
+GALLERY_SIZES = [1000, 100000]
+FACES_PER_IDENTITY = 5
+STAGES = ['startup', 'detect', 'align', 'represent', 'identify', 'add_to_vectordb', 'http']
+# Code run by the startup stage, each time in a fresh interpreter (the cold start of a CLI tool,
+# of a worker process or of the web app)
+STARTUP_SNIPPETS = {
+    'import': "import facial_recognition",
+    'identify': "from facial_recognition import FaceIdentification",
+    'detect': "from facial_recognition import FaceDetection; FaceDetection().detector",
+    'represent': "from facial_recognition import FaceRepresentation;"
+                 " FaceRepresentation().recognizer"
+}
+NUM_STARTUP_ITERATIONS = 20
+# Appended to the startup snippets to print the peak RSS of the interpreter in kB (the peak RSS
+# of the children as seen by the parent includes its own memory, copied when forking)
+PEAK_RSS_SNIPPET = "\nwith open('/proc/self/status', encoding='utf-8') as status:\n"\
+                   "    print([line.split()[1] for line in status if line.startswith('VmHWM')][0])"
+BASELINE_PATH = os.path.join(par_dir, 'data', 'benchmark_baseline.json')
+# Relative increase of a latency percentile or of the peak RSS (or decrease of the throughput)
+# over the baseline that is reported as a regression
+REGRESSION_TOLERANCE = 0.2
+# Metrics compared against the baseline, and whether higher is better
+COMPARED_METRICS = {'p50_ms': False, 'p95_ms': False, 'p99_ms': False,\
+                    'throughput': True, 'peak_rss_mb': False}
+
+def load_frames(
+        images_dir:Optional[str] = None,
+        num_frames:int = 8
+    ) -> List[np.ndarray]:
+    """Load the RGB frames to run the image stages on, or generate synthetic ones.
+
+    Args:
+        images_dir (Optional[str]): A directory of images (searched recursively). Defaults to None
+                                    (synthetic noise frames, which have no faces).
+        num_frames (int): The number of synthetic frames. Defaults to 8.
+
+    Returns:
+        List[np.ndarray]: The RGB frames.
+    """
+    if images_dir is not None:
+        frames = []
+        for path in sorted(glob.glob(os.path.join(images_dir, '**', '*.*'), recursive=True)):
+            img_bgr = cv2.imread(path)
+            if img_bgr is not None:
+                frames.append(cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB))
+        if not frames:
+            raise ValueError(f"No images found in `{images_dir}`")
+        return frames
+    rng = np.random.default_rng(0)
+    width, height = FRAME_SIZE
+    return [rng.integers(0, 256, (height, width, 3), dtype='uint8') for _ in range(num_frames)]
+
+def synthetic_landmarks(
+        frame:np.ndarray,
+        num_points:int = 68
+    ) -> np.ndarray:
+    """Make landmarks for a frame without a detected face (for the representation stage): points
+       on an ellipse centered in the frame.
+
+    Args:
+        frame (np.ndarray): The RGB frame.
+        num_points (int): The number of landmarks. Defaults to 68.
+
+    Returns:
+        np.ndarray: The (1, num_points, 2) int32 landmark coordinates.
+    """
+    height, width, _ = frame.shape
+    size = min(height, width) / 4
+    angles = np.linspace(0, 2 * np.pi, num_points, endpoint=False)
+    points = np.stack([width / 2 + size * np.cos(angles), height / 2 + size * np.sin(angles)], 1)
+    return np.rint(points[None]).astype('int32')
+
+def build_gallery(
+        num_records:int,
+        work_dir:str,
+        metadata:bool = False
+    ) -> FaceGallery:
+    """Build a synthetic gallery of random descriptors in a scratch directory.
+
+    Args:
+        num_records (int): The number of descriptors.
+        work_dir (str): The directory to write the snapshot, log and key table to.
+        metadata (bool): Whether to keep the metadata store (filling it takes a while for large
+                         galleries). Defaults to False.
+
+    Returns:
+        FaceGallery: The gallery, with FACES_PER_IDENTITY descriptors per identity.
+    """
+    embeddings = load_gallery(num_records)
+    keys = [f"person{i // FACES_PER_IDENTITY}" for i in range(num_records)]
+    db_path = os.path.join(work_dir, 'faces_l2.faiss')
+    keys_path = os.path.join(work_dir, 'faces_l2.keys')
+    write_snapshot(build_index('flat', 'euclidean', embeddings), keys, db_path, keys_path)
+    return FaceGallery(db_path=db_path, keys_path=keys_path,\
+                       log_dir=os.path.join(work_dir, 'faces_l2.wal'),\
+                       metadata_path=os.path.join(work_dir, 'faces_l2.sqlite')\
+                                     if metadata else None)
+
+def time_calls(
+        call:Callable[[int], int],
+        iterations:int,
+        warmup:int = NUM_WARMUP
+    ) -> Tuple[List[float], int]:
+    """Time calls one at a time, after some untimed warmup calls.
+
+    Args:
+        call (Callable[[int], int]): Gets the iteration number and returns the number of items it
+                                     processed (i.e. frames or faces).
+        iterations (int): The number of timed calls.
+        warmup (int): The number of untimed calls. Defaults to NUM_WARMUP.
+
+    Returns:
+        Tuple[List[float], int]: The latency of each call in seconds and the items processed.
+    """
+    for i in range(warmup):
+        call(i)
+    latencies, items = [], 0
+    for i in range(iterations):
+        start_time = time.perf_counter()
+        items += call(i)
+        latencies.append(time.perf_counter() - start_time)
+    return latencies, items
+
+def bench_startup(
+        config:Dict
+    ) -> Tuple[List[float], int, Optional[float]]:
+    """Time a fresh interpreter running a startup snippet (i.e. importing the package, or loading
+       a model), and get the peak RSS of the interpreter in MB (only on Linux)."""
+    linux = sys.platform.startswith('linux')
+    command = [sys.executable, '-c',\
+               STARTUP_SNIPPETS[config['snippet']] + (PEAK_RSS_SNIPPET if linux else '')]
+    peak_rss = []
+
+    def start(_i:int) -> int:
+        process = subprocess.run(command, cwd=par_dir, check=True, capture_output=True,\
+                                 text=True)
+        if linux:
+            peak_rss.append(int(process.stdout.split()[-1]) / 1024)
+        return 1
+
+    latencies, items = time_calls(start, min(config['iterations'], NUM_STARTUP_ITERATIONS),\
+                                  warmup=1)
+    return latencies, items, max(peak_rss) if peak_rss else None
+
+def bench_detect(
+        config:Dict
+    ) -> Tuple[List[float], int]:
+    """Time `FaceDetection.detect` on the frames."""
+    frames = load_frames(config['images'])
+    face_detector = FaceDetection()
+    return time_calls(lambda i: len(face_detector.detect(frames[i % len(frames)])) or 1,\
+                      config['iterations'])
+
+def bench_align(
+        config:Dict
+    ) -> Tuple[List[float], int]:
+    """Time `FaceAlignment.align` on the frames and their detected faces (in static image mode,
+       since the frames are unrelated)."""
+    frames = load_frames(config['images'])
+    face_detector = FaceDetection()
+    faces = [face_detector.detect(frame) for frame in frames]
+    landmark_predictor = FaceAlignment(static_image_mode=True)
+    return time_calls(lambda i: len(landmark_predictor.align(frames[i % len(frames)],\
+                                                             faces[i % len(frames)])) or 1,\
+                      config['iterations'])
+
+def bench_represent(
+        config:Dict
+    ) -> Tuple[List[float], int]:
+    """Time `FaceRepresentation.represent` on the aligned faces of the frames (synthetic landmarks
+       for the frames without any)."""
+    frames = load_frames(config['images'])
+    face_detector = FaceDetection()
+    landmark_predictor = FaceAlignment(static_image_mode=True)
+    landmarks = []
+    for frame in frames:
+        _, frame_landmarks = landmark_predictor.align_array(frame, face_detector.detect(frame))
+        landmarks.append(frame_landmarks if len(frame_landmarks) else synthetic_landmarks(frame))
+    face_descriptor = FaceRepresentation()
+    return time_calls(lambda i: len(face_descriptor.represent(frames[i % len(frames)],\
+                                                              landmarks[i % len(frames)])),\
+                      config['iterations'])
+
+def bench_identify(
+        config:Dict
+    ) -> Tuple[List[float], int]:
+    """Time `FaceIdentification.identify` of one descriptor at a time (like the web app does)
+       against a synthetic gallery."""
+    with tempfile.TemporaryDirectory() as work_dir:
+        gallery = build_gallery(config['gallery_size'], work_dir)
+        queries = make_queries(gallery.vectordb.reconstruct_n(0, min(gallery.num_records,\
+                                                                     100000)),\
+                               config['iterations'] + NUM_WARMUP)
+        face_identifier = FaceIdentification(gallery=gallery)
+        return time_calls(lambda i: len(face_identifier.identify(queries[i:i+1])[0]),\
+                          config['iterations'])
+
+def bench_add_to_vectordb(
+        config:Dict
+    ) -> Tuple[List[float], int]:
+    """Time `FaceRepresentation.add_to_vectordb` of one descriptor at a time (like an enrollment
+       through the web app) into a synthetic gallery, with the log storage."""
+    with tempfile.TemporaryDirectory() as work_dir:
+        gallery = build_gallery(config['gallery_size'], work_dir, metadata=True)
+        embeddings = load_gallery(config['iterations'] + NUM_WARMUP)
+        face_descriptor = FaceRepresentation(gallery=gallery)
+        result = time_calls(lambda i: face_descriptor.add_to_vectordb(embeddings[i:i+1],\
+                                                                      ids=[f"new{i}"]) or 1,\
+                            config['iterations'])
+        gallery.compact(block=True)
+        gallery.metadata.close()
+    return result
+
+def bench_http(
+        config:Dict
+    ) -> Tuple[List[float], int]:
+    """Time POST requests to the `/identify/` endpoint of a running web app."""
+    frames = load_frames(config['images'])
+    packets = []
+    for frame in frames:
+        _, frame_jpg = cv2.imencode('.jpg', cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+        frame_enc = 'data:image/jpeg;base64,' + base64.b64encode(frame_jpg).decode('ascii')
+        landmarks = synthetic_landmarks(frame)[0]
+        (left, top), (right, bottom) = landmarks.min(axis=0), landmarks.max(axis=0)
+        packets.append(json.dumps({"frame_enc": frame_enc,\
+                                   "bb": [int(left), int(top), int(right), int(bottom)],\
+                                   "landmarks": landmarks.tolist()}).encode('utf-8'))
+    url = config['url'].rstrip('/') + '/identify/'
+
+    def post(i:int) -> int:
+        request = urllib.request.Request(url, data=packets[i % len(packets)],\
+                                         headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request) as response:
+            response.read()
+        return 1
+
+    return time_calls(post, config['iterations'])
+
+BENCHMARKS = {
+    'startup': bench_startup,
+    'detect': bench_detect,
+    'align': bench_align,
+    'represent': bench_represent,
+    'identify': bench_identify,
+    'add_to_vectordb': bench_add_to_vectordb,
+    'http': bench_http
+}
+
+def run_stage(
+        stage:str,
+        config:Dict
+    ) -> Dict:
+    """Run the benchmark of a stage (in its own process, so its peak RSS is its own).
+
+    Args:
+        stage (str): The stage, a key of BENCHMARKS.
+        config (Dict): The options of the benchmark (iterations, images, gallery_size, url,
+                       snippet).
+
+    Returns:
+        Dict: The latencies in seconds, the items processed and the peak RSS in MB (of the
+              interpreters it started for the startup stage, when known).
+    """
+    latencies, items, *child_rss = BENCHMARKS[stage](config)
+    if child_rss:
+        peak_rss = child_rss[0]
+    else:
+        # kilobytes on Linux, bytes on macOS
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak_rss /= 1024 ** 2 if sys.platform == 'darwin' else 1024
+    return {'latencies': latencies, 'items': items, 'peak_rss_mb': peak_rss}
+
+def summarize(
+        latencies:List[float],
+        items:int,
+        peak_rss_mb:Optional[float]
+    ) -> Dict[str,float]:
+    """Summarize the latencies of a stage.
+
+    Args:
+        latencies (List[float]): The latency of each call in seconds.
+        items (int): The items processed by the calls.
+        peak_rss_mb (Optional[float]): The peak RSS of the process in MB (None if unknown).
+
+    Returns:
+        Dict[str,float]: The mean, p50, p95 and p99 latencies in milliseconds, the throughput in
+                         items per second, the number of calls and the peak RSS.
+    """
+    latencies_ms = np.array(latencies) * 1000
+    p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99])
+    return {'calls': len(latencies), 'mean_ms': float(latencies_ms.mean()), 'p50_ms': float(p50),\
+            'p95_ms': float(p95), 'p99_ms': float(p99),\
+            'throughput': items / max(float(np.sum(latencies)), 1e-12),\
+            'peak_rss_mb': None if peak_rss_mb is None else round(peak_rss_mb, 1)}
+
+def compare(
+        results:Dict[str,Dict[str,float]],
+        baseline:Dict[str,Dict[str,float]],
+        tolerance:float = REGRESSION_TOLERANCE
+    ) -> List[str]:
+    """Compare the results against a baseline.
+
+    Args:
+        results (Dict[str,Dict[str,float]]): The summary of each stage.
+        baseline (Dict[str,Dict[str,float]]): The summary of each stage in the baseline.
+        tolerance (float): The relative change that is a regression. Defaults to
+                           REGRESSION_TOLERANCE.
+
+    Returns:
+        List[str]: A description of each regression (stages missing from the baseline are
+                   skipped).
+    """
+    regressions = []
+    for stage, summary in results.items():
+        if stage not in baseline:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            value, base_value = summary.get(metric), baseline[stage].get(metric)
+            if value is None or not base_value:
+                continue
+            change = value / base_value - 1
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(f"{stage} {metric}: {base_value:.4g} -> {value:.4g}"
+                                   f" ({change:+.0%})")
+    return regressions
+
+def run_benchmark(
+        stages:List[str],
+        iterations:int = NUM_ITERATIONS,
+        gallery_sizes:Optional[List[int]] = None,
+        images_dir:Optional[str] = None,
+        url:Optional[str] = None
+    ) -> Dict:
+    """Benchmark the stages of the pipeline, each in a fresh process.
+
+    The gallery stages (`identify`, `add_to_vectordb`) run once per gallery size, reported as
+    `<stage>@<size>`, and the `startup` stage once per snippet of STARTUP_SNIPPETS, reported as
+    `startup:<snippet>` (at most NUM_STARTUP_ITERATIONS times). The `http` stage only runs when
+    the URL of a web app is given.
+
+    Args:
+        stages (List[str]): The stages to benchmark (keys of BENCHMARKS).
+        iterations (int): The number of timed calls per stage. Defaults to NUM_ITERATIONS.
+        gallery_sizes (Optional[List[int]]): The sizes of the synthetic galleries. Defaults to
+                                             None (GALLERY_SIZES).
+        images_dir (Optional[str]): A directory of images for the image stages. Defaults to None
+                                    (synthetic frames).
+        url (Optional[str]): The base URL of a running web app. Defaults to None.
+
+    Returns:
+        Dict: The environment of the run and the summary of each stage, under "stages".
+    """
+    if gallery_sizes is None:
+        gallery_sizes = GALLERY_SIZES
+    ctx = multiprocessing.get_context('spawn')
+    results = {}
+    for stage in stages:
+        if stage == 'http' and url is None:
+            print("Skipping http (no --url)", file=sys.stderr)
+            continue
+        if stage in ('identify', 'add_to_vectordb'):
+            variants = [(f"{stage}@{size}", {'gallery_size': size}) for size in gallery_sizes]
+        elif stage == 'startup':
+            variants = [(f"startup:{snippet}", {'snippet': snippet})\
+                        for snippet in STARTUP_SNIPPETS]
+        else:
+            variants = [(stage, {})]
+        for name, variant in variants:
+            config = {'iterations': iterations, 'images': images_dir, 'gallery_size': None,\
+                      'url': url, 'snippet': None, **variant}
+            print(f"Running {name}...", file=sys.stderr)
+            with ctx.Pool(1) as pool:
+                result = pool.apply(run_stage, (stage, config))
+            results[name] = summarize(result['latencies'], result['items'],\
+                                      result['peak_rss_mb'])
+    return {
+        'time': time.time(),
+        'machine': {'platform': platform.platform(), 'python': platform.python_version(),\
+                    'cpus': os.cpu_count()},
+        'config': {'iterations': iterations, 'gallery_sizes': gallery_sizes,\
+                   'images': images_dir, 'url': url},
+        'stages': results
+    }
+
+def print_results(
+        results:Dict[str,Dict[str,float]]
+    ) -> None:
+    """Print the summary of each stage as a table.
+
+    Args:
+        results (Dict[str,Dict[str,float]]): The summary of each stage.
+
+    Returns:
+        None
+    """
+    print(f"{'stage':<24} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'items/s':>10}"
+          f" {'RSS MB':>8}", file=sys.stderr)
+    for stage, summary in results.items():
+        print(f"{stage:<24} {summary['p50_ms']:>9.3f} {summary['p95_ms']:>9.3f}"
+              f" {summary['p99_ms']:>9.3f} {summary['throughput']:>10.1f}"
+              f" {summary['peak_rss_mb'] or float('nan'):>8.1f}", file=sys.stderr)
+
+# Main execution block
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES,\
+                        help='stages to benchmark (default: all)')
+    parser.add_argument('--iterations', type=int, default=NUM_ITERATIONS,\
+                        help='timed calls per stage')
+    parser.add_argument('--gallery-sizes', type=int, nargs='+', default=GALLERY_SIZES,\
+                        help='sizes of the synthetic galleries (i.e. 1000 1000000 10000000)')
+    parser.add_argument('--images', default=None,\
+                        help='directory of images for the image stages (default: synthetic)')
+    parser.add_argument('--url', default=None,\
+                        help='base URL of a running web app for the http stage')
+    parser.add_argument('--output', default=None, help='JSON file to write the results to')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='baseline JSON file')
+    parser.add_argument('--save-baseline', action='store_true',\
+                        help='save the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE,\
+                        help='relative change over the baseline that fails the run')
+    args = parser.parse_args()
+    report = run_benchmark(args.stages, args.iterations, args.gallery_sizes, args.images,\
+                           args.url)
+    print_results(report['stages'])
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline + '.tmp', 'w', encoding='utf-8') as baseline_file:
+            json.dump(report, baseline_file, indent=2)
+        os.replace(args.baseline + '.tmp', args.baseline)
+        print(f"Saved the baseline to `{args.baseline}`", file=sys.stderr)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            found = compare(report['stages'], json.load(baseline_file)['stages'], args.tolerance)
+        for regression in found:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if found:
+            sys.exit(1)
+        print("No regressions against the baseline", file=sys.stderr)
@@ -0,0 +1,157 @@
+"""Vector DB Index (Recall vs. Latency) Benchmark Script"""
+# pylint: disable=E1101,E0401,C0413
+from typing import Optional, Tuple
+import os
+import sys
+import time
+import argparse
+import faiss
+import numpy as np
+sys.path.append("../")
+par_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, par_dir)
+from facial_recognition._vectorindex import build_index, reconstruct_all, search_parameters
+from facial_recognition.gallery import VECTOR_DB_PATH
+
+# Constants
+NUM_QUERIES = 1000
+K = 10
+QUERY_NOISE = 0.02
+NPROBES = [1, 4, 16, 64]
+EF_SEARCHES = [16, 32, 64, 128]
+
+def load_gallery(
+        num_records:Optional[int] = None,
+        dimensions:int = 128
+    ) -> np.ndarray:
+    """Load the embeddings of the gallery, or generate a synthetic one.
+
+    Args:
+        num_records (Optional[int]): The size of a synthetic gallery. Defaults to None (use the
+                                     embeddings in the Vector DB).
+        dimensions (int): The dimensions of the synthetic embeddings. Defaults to 128.
+
+    Returns:
+        np.ndarray: The (n, dimensions) float32 embeddings.
+    """
+    if num_records is None:
+        return reconstruct_all(faiss.read_index(VECTOR_DB_PATH))
+    rng = np.random.default_rng(0)
+    # dlib descriptors have a norm of ~1 spread over all dimensions
+    return (rng.standard_normal((num_records, dimensions)) / np.sqrt(dimensions)).astype('f')
+
+def make_queries(
+        embeddings:np.ndarray,
+        num_queries:int,
+        noise:float = QUERY_NOISE
+    ) -> np.ndarray:
+    """Make queries by perturbing embeddings sampled from the gallery (i.e. new photos of enrolled
+       faces).
+
+    Args:
+        embeddings (np.ndarray): The embeddings of the gallery.
+        num_queries (int): The number of queries.
+        noise (float): The standard deviation of the noise per dimension. Defaults to QUERY_NOISE.
+
+    Returns:
+        np.ndarray: The (num_queries, dimensions) float32 queries.
+    """
+    rng = np.random.default_rng(1)
+    rows = rng.integers(0, embeddings.shape[0], num_queries)
+    queries = embeddings[rows] + rng.normal(0, noise, (num_queries, embeddings.shape[1]))
+    return queries.astype('f')
+
+def timed_search(
+        index:faiss.Index,
+        queries:np.ndarray,
+        k:int,
+        params:Optional[faiss.SearchParameters] = None
+    ) -> Tuple[float, np.ndarray]:
+    """Search the queries one at a time (like the web app does) and time it.
+
+    Args:
+        index (faiss.Index): The index to search.
+        queries (np.ndarray): The queries.
+        k (int): The number of nearest neighbors to search for.
+        params (Optional[faiss.SearchParameters]): The search parameters. Defaults to None.
+
+    Returns:
+        Tuple[float, np.ndarray]: The mean latency per query in milliseconds and the (n, k) row
+                                  IDs found.
+    """
+    neighbors = np.empty((queries.shape[0], k), dtype='int64')
+    start_time = time.perf_counter()
+    for i in range(queries.shape[0]):
+        if params is None:
+            _, neighbors[i:i+1] = index.search(queries[i:i+1], k)
+        else:
+            _, neighbors[i:i+1] = index.search(queries[i:i+1], k, params=params)
+    latency = (time.perf_counter() - start_time) * 1000 / queries.shape[0]
+    return latency, neighbors
+
+def recall_at_k(
+        truth:np.ndarray,
+        found:np.ndarray
+    ) -> float:
+    """Get the fraction of the true k nearest neighbors that were found.
+
+    Args:
+        truth (np.ndarray): The (n, k) true row IDs (from the flat index).
+        found (np.ndarray): The (n, k) row IDs found.
+
+    Returns:
+        float: The recall@k.
+    """
+    hits = sum(len(np.intersect1d(t, f)) for t, f in zip(truth, found))
+    return hits / truth.size
+
+def run_benchmark(
+        num_records:Optional[int] = None,
+        num_queries:int = NUM_QUERIES,
+        k:int = K
+    ) -> None:
+    """Compare the recall and latency of every index backend against the flat index.
+
+    Args:
+        num_records (Optional[int]): The size of a synthetic gallery. Defaults to None (use the
+                                     embeddings in the Vector DB).
+        num_queries (int): The number of queries. Defaults to NUM_QUERIES.
+        k (int): The number of nearest neighbors to search for. Defaults to K.
+
+    Returns:
+        None
+    """
+    embeddings = load_gallery(num_records)
+    queries = make_queries(embeddings, num_queries)
+    print(f"Gallery: {embeddings.shape[0]} x {embeddings.shape[1]}, queries: {num_queries}, k={k}")
+    print(f"{'backend':<8} {'param':<14} {'build (s)':>10} {'latency (ms)':>13} {'recall@k':>9}")
+
+    start_time = time.perf_counter()
+    flat = build_index('flat', 'euclidean', embeddings)
+    build_time = time.perf_counter() - start_time
+    flat_latency, truth = timed_search(flat, queries, k)
+    print(f"{'flat':<8} {'-':<14} {build_time:>10.2f} {flat_latency:>13.4f} {1.0:>9.4f}")
+
+    for index_type, knob, values in [('ivf', 'nprobe', NPROBES), ('ivfpq', 'nprobe', NPROBES),\
+                                     ('hnsw', 'efSearch', EF_SEARCHES)]:
+        start_time = time.perf_counter()
+        index = build_index(index_type, 'euclidean', embeddings)
+        build_time = time.perf_counter() - start_time
+        for value in values:
+            if knob == 'nprobe':
+                params = search_parameters(index, nprobe=value)
+            else:
+                params = search_parameters(index, ef_search=value)
+            latency, found = timed_search(index, queries, k, params)
+            print(f"{index_type:<8} {f'{knob}={value}':<14} {build_time:>10.2f} {latency:>13.4f}"
+                  f" {recall_at_k(truth, found):>9.4f}")
+
+# Main execution block
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--synthetic', type=int, default=None,\
+                        help='size of a synthetic gallery (default: use the Vector DB)')
+    parser.add_argument('--queries', type=int, default=NUM_QUERIES, help='number of queries')
+    parser.add_argument('-k', type=int, default=K, help='number of nearest neighbors')
+    args = parser.parse_args()
+    run_benchmark(args.synthetic, args.queries, args.k)
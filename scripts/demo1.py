@@ -44,7 +44,7 @@ def show_webcam_feed():
         cap.set(cv2.CAP_PROP_FRAME_HEIGHT, WINDOW_HEIGHT)
 
     face_detector = FaceDetection()
-    landmark_predictor = FaceAlignment()
+    landmark_predictor = FaceAlignment(static_image_mode=False)
 
     current_time = time.time()
 
@@ -4,31 +4,34 @@ import os
 import sys
 import time
 import cv2
+import numpy as np
 sys.path.append("../")
 par_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(1, par_dir)
-from facial_recognition import FaceDetection, draw_bounding_boxes, FaceAlignment,\
-                               draw_landmarks, draw_fps,\
-                               FaceRepresentation, FaceIdentification, draw_name
+from facial_recognition import FacePipeline, read_frames, draw_bounding_boxes,\
+                               draw_landmarks, draw_fps, draw_name, FaceTracker,\
+                               FaceRepresentation, FaceIdentification
 
 # Constants
 CAMERA_ID = 0
 WINDOW_WIDTH = 960
 WINDOW_HEIGHT = 540
+# Track faces between detection keyframes instead of running every model on every frame
+TRACK_FACES = True
+KEYFRAME_EVERY = 10
 
 def show_webcam_feed():
     """Shows the webcam feed and performs facial detection, landmark detection, face representation,
        and face identification.
 
-    This function opens the webcam feed and continuously reads frames from it. It performs the
-    following steps for each frame:
+    This function streams the webcam feed through a face recognition pipeline, which runs the
+    following steps in overlapping threads (so the FPS is that of the slowest step):
     - Detects faces in the frame using a face detection model.
-    - Draws bounding boxes around the detected faces.
     - Aligns the faces using a landmark detection model.
-    - Draws landmarks on the aligned faces.
     - Represents the faces using a face representation model.
     - Identifies the faces using a face identification model.
-    - Draws the name of the best match for each face.
+    Frames that arrive while the pipeline is busy are dropped. For each processed frame it draws
+    the bounding boxes, the landmarks and the name of the best match for each face.
 
     The function also displays the frames with the detected faces, landmarks, and FPS (frames per
     second) on a window titled "Facial Identification". Press the Escape key to exit the
@@ -40,53 +43,95 @@ def show_webcam_feed():
     Returns:
         None
     """
-    cap = cv2.VideoCapture(CAMERA_ID)
-    if WINDOW_WIDTH is not None and WINDOW_HEIGHT is not None:
-        cap.set(cv2.CAP_PROP_FRAME_WIDTH, WINDOW_WIDTH)
-        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, WINDOW_HEIGHT)
+    pipeline = FacePipeline()
 
-    face_detector = FaceDetection()
-    landmark_predictor = FaceAlignment()
+    current_time = time.time()
 
-    # Initializing two extra steps: Representation & Identifications
-    face_descriptor = FaceRepresentation()
-    face_identifier = FaceIdentification()
+    for result in pipeline.stream(read_frames(CAMERA_ID, WINDOW_WIDTH, WINDOW_HEIGHT)):
+        delta = time.time() - current_time
+        delta = delta if delta != 0 else 0.000001
+        current_time = time.time()
 
-    current_time = time.time()
+        frame = result.frame
+        if result.faces:
+            draw_bounding_boxes(frame, result.faces)
+            draw_landmarks(frame, result.landmarks)
+            for face, neighbors, distances in zip(result.faces, result.neighbors,\
+                                                  result.distances):
+                best_match_name = f"{neighbors[0]} {distances[0]:.3f}" if neighbors\
+                                  else "NO MATCH"
+                draw_name(frame, face, best_match_name)
+
+        draw_fps(frame, delta)
+        cv2.imshow('Facial Identification', frame)
+
+        key = cv2.waitKey(1)
+        if key == 27:  # Escape key
+            break
+
+    cv2.destroyAllWindows()
 
-    while True:
-        ret, frame = cap.read()
+def show_tracked_webcam_feed():
+    """Shows the webcam feed and tracks and identifies the faces in it.
 
-        if ret:
-            delta = time.time() - current_time
-            delta = delta if delta != 0 else 0.000001
-            current_time = time.time()
+    Faces are only detected and aligned every `KEYFRAME_EVERY` frames (or when they can't be
+    tracked reliably), and tracked with optical flow in between. Each track is represented and
+    identified once, on the first keyframe it appears in (and on later keyframes until it matches
+    someone), and keeps its name afterwards.
 
-            frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            faces = face_detector.detect(frame_rgb)
+    The function displays the frames with the tracked faces, landmarks, names and FPS on a window
+    titled "Facial Identification". Press the Escape key to exit the function.
 
-            if faces:
-                draw_bounding_boxes(frame, faces)
-                landmarks = landmark_predictor.align(frame_rgb, faces)
-                draw_landmarks(frame, landmarks)
+    Args:
+        None
 
-                # Executing two extra steps: Representation & Identification
-                descriptors = face_descriptor.represent(frame_rgb, landmarks)
-                best_distances, best_neighbors = face_identifier.identify(descriptors, k=1)
-                for face, neighbors, distances in zip(faces, best_neighbors, best_distances):
-                    best_match_name = f"{neighbors[0]} {distances[0]:.3f}"
-                    draw_name(frame, face, best_match_name)
+    Returns:
+        None
+    """
+    face_tracker = FaceTracker(keyframe_every=KEYFRAME_EVERY)
+    face_descriptor = FaceRepresentation()
+    face_identifier = FaceIdentification()
 
-            draw_fps(frame, delta)
-            cv2.imshow('Facial Identification', frame)
+    current_time = time.time()
 
-            key = cv2.waitKey(1)
-            if key == 27:  # Escape key
-                break
+    for frame in read_frames(CAMERA_ID, WINDOW_WIDTH, WINDOW_HEIGHT):
+        delta = time.time() - current_time
+        delta = delta if delta != 0 else 0.000001
+        current_time = time.time()
+
+        frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        tracks = face_tracker.track(frame_rgb)
+
+        pending = [track for track in tracks if track.fresh and track.name is None]
+        if pending:
+            descriptors = face_descriptor.represent(frame_rgb,\
+                                                    np.stack([track.points for track in pending]))
+            best_distances, best_neighbors = face_identifier.identify(descriptors, k=1)
+            for track, neighbors, distances in zip(pending, best_neighbors, best_distances):
+                track.identified = True
+                if neighbors:
+                    track.name, track.distance = neighbors[0], distances[0]
+
+        for track in tracks:
+            draw_bounding_boxes(frame, [track.face])
+            draw_landmarks(frame, track.points[None])
+            if track.name is not None:
+                draw_name(frame, track.face, f"{track.name} {track.distance:.3f}")
+            elif track.identified:
+                draw_name(frame, track.face, "NO MATCH")
+
+        draw_fps(frame, delta)
+        cv2.imshow('Facial Identification', frame)
+
+        key = cv2.waitKey(1)
+        if key == 27:  # Escape key
+            break
 
-    cap.release()
     cv2.destroyAllWindows()
 
 # Main execution block
 if __name__ == '__main__':
-    show_webcam_feed()
+    if TRACK_FACES:
+        show_tracked_webcam_feed()
+    else:
+        show_webcam_feed()
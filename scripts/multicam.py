@@ -0,0 +1,325 @@
+"""Multi-camera Recognition Service Script"""
+# pylint: disable=E1101,E0401,C0413
+from typing import List, Optional, Tuple, Union, TextIO
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from collections import deque
+import cv2
+import numpy as np
+sys.path.append("../")
+par_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, par_dir)
+from facial_recognition import FacePipeline, FaceAlignment, FaceRepresentation,\
+                               FaceIdentification
+from facial_recognition.pipeline import PIPELINE_MAX_NUM_FACES
+from cameras import test_all_cameras
+
+# Constants
+NUM_WORKERS = 2
+REPORT_EVERY = 5.0
+LATENCY_WINDOW = 100
+# Seconds between reconnection attempts of live sources (cameras, RTSP)
+RECONNECT_DELAY = 1.0
+
+class FrameSource:
+    """Class for a Video Source read by its own Capture Thread
+
+    Only the latest frame is kept: a frame that is replaced before a worker takes it is counted
+    as dropped, so a slow recognition never makes a source lag behind real time.
+    """
+    def __init__(
+            self,
+            uri:Union[int, str],
+            cond:threading.Condition,
+            realtime:Optional[bool] = None,
+            loop:bool = False
+        ) -> None:
+        self.uri = uri
+        self.name = str(uri)
+        self.is_file = isinstance(uri, str) and os.path.isfile(uri)
+        # files are read at their own frame rate so that they behave like cameras
+        self.realtime = self.is_file if realtime is None else realtime
+        self.loop = loop
+        self.cond = cond
+        self.frame:Optional[np.ndarray] = None
+        self.seq = 0
+        self.captured_at = 0.0
+        self.busy = False
+        self.finished = False
+        self.stopped = threading.Event()
+        self.captured = 0
+        self.dropped = 0
+        self.processed = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.thread = threading.Thread(target=self._capture, name=f"capture-{self.name}",\
+                                       daemon=True)
+
+    def start(self) -> None:
+        """Starts the capture thread."""
+        self.thread.start()
+
+    def stop(self) -> None:
+        """Stops the capture thread."""
+        self.stopped.set()
+
+    def _capture(self) -> None:
+        """Reads frames into the latest-frame slot until the source ends or is stopped."""
+        cap = cv2.VideoCapture(self.uri)
+        frame_time = 1 / (cap.get(cv2.CAP_PROP_FPS) or 30)
+        next_time = time.time()
+        while not self.stopped.is_set():
+            ret, frame = cap.read()
+            if not ret:
+                if self.is_file and self.loop:
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                    continue
+                if self.is_file:
+                    break
+                cap.release()
+                self.stopped.wait(RECONNECT_DELAY)
+                cap = cv2.VideoCapture(self.uri)
+                continue
+            if self.realtime:
+                next_time += frame_time
+                self.stopped.wait(max(0.0, next_time - time.time()))
+            with self.cond:
+                if self.frame is not None:
+                    self.dropped += 1
+                self.frame = frame
+                self.seq += 1
+                self.captured += 1
+                self.captured_at = time.time()
+                self.cond.notify()
+        cap.release()
+        with self.cond:
+            self.finished = True
+            self.cond.notify_all()
+
+class FairScheduler:
+    """Class for Round-robin Scheduling of the Sources' Latest Frames to a Pool of Workers
+
+    A source has at most one frame being processed at a time, and the next worker that's free
+    takes the latest frame of the next source in turn that has one, so every source gets an equal
+    share of the workers however fast it captures.
+    """
+    def __init__(
+            self,
+            sources:List[FrameSource],
+            cond:threading.Condition
+        ) -> None:
+        self.sources = sources
+        self.cond = cond
+        self.turn = 0
+        self.stopped = False
+
+    def next(self) -> Optional[Tuple[FrameSource, int, np.ndarray, float]]:
+        """Waits for the next frame to process.
+
+        Returns:
+            Optional[Tuple[FrameSource, int, np.ndarray, float]]: The source, sequence number,
+                                                                  frame and capture time (None
+                                                                  once every source finished).
+        """
+        with self.cond:
+            while not self.stopped:
+                for i in range(len(self.sources)):
+                    source = self.sources[(self.turn + i) % len(self.sources)]
+                    if source.frame is not None and not source.busy:
+                        self.turn = (self.turn + i + 1) % len(self.sources)
+                        frame, source.frame = source.frame, None
+                        source.busy = True
+                        return source, source.seq, frame, source.captured_at
+                if all(source.finished and not source.busy for source in self.sources):
+                    return None
+                self.cond.wait()
+            return None
+
+    def done(
+            self,
+            source:FrameSource,
+            latency:float
+        ) -> None:
+        """Marks the frame of a source as processed.
+
+        Args:
+            source (FrameSource): The source.
+            latency (float): The seconds from the capture of the frame to its result.
+
+        Returns:
+            None
+        """
+        with self.cond:
+            source.busy = False
+            source.processed += 1
+            source.latencies.append(latency)
+            self.cond.notify_all()
+
+    def stop(self) -> None:
+        """Wakes every worker up so that they exit."""
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+def recognition_worker(
+        scheduler:FairScheduler,
+        output:Optional[TextIO],
+        output_lock:threading.Lock,
+        roi:bool = False
+    ) -> None:
+    """Recognizes the faces of the frames given by the scheduler until there are no more.
+
+    Each worker has its own detection, alignment and representation models (they aren't
+    thread-safe), while the gallery is loaded once and shared by every worker.
+
+    Args:
+        scheduler (FairScheduler): The scheduler of the sources.
+        output (Optional[TextIO]): The file to write the results to, as JSON lines. Defaults to
+                                   None.
+        output_lock (threading.Lock): The lock of the output file.
+        roi (bool): Whether to detect faces on downscaled frames and only run the mesh on crops
+                    around them (for high resolution sources). Defaults to False.
+
+    Returns:
+        None
+    """
+    # frames of different sources are interleaved, so the meshes can't be tracked between them
+    pipeline = FacePipeline(landmark_predictor=FaceAlignment(static_image_mode=True,\
+                                                             max_num_faces=PIPELINE_MAX_NUM_FACES,\
+                                                             roi=roi),\
+                            face_descriptor=FaceRepresentation(),\
+                            face_identifier=FaceIdentification(), roi=roi)
+    while True:
+        task = scheduler.next()
+        if task is None:
+            return
+        source, seq, frame, captured_at = task
+        try:
+            result = pipeline.process(frame)
+        except Exception as exc:
+            # a bad frame mustn't stop the recognition of the source
+            source.errors += 1
+            print(f"{source.name}: frame {seq} failed: {exc!r}", file=sys.stderr)
+            continue
+        finally:
+            scheduler.done(source, time.time() - captured_at)
+        if output is not None:
+            faces = [{"bb": [face.left(), face.top(), face.right(), face.bottom()],\
+                      "name": neighbors[0] if neighbors else None,\
+                      "distance": float(distances[0]) if distances else None}\
+                     for face, neighbors, distances in zip(result.faces, result.neighbors,\
+                                                           result.distances)]
+            line = json.dumps({"source": source.name, "seq": seq, "time": captured_at,\
+                               "faces": faces})
+            with output_lock:
+                output.write(line + '\n')
+
+def report(
+        sources:List[FrameSource],
+        elapsed:float
+    ) -> None:
+    """Prints the FPS, dropped frames, failed frames and latency of every source.
+
+    Args:
+        sources (List[FrameSource]): The sources.
+        elapsed (float): The seconds since the sources were started.
+
+    Returns:
+        None
+    """
+    print(f"{'source':<24} {'capture fps':>11} {'process fps':>11} {'dropped':>8}"
+          f" {'errors':>8} {'p50 ms':>8} {'p95 ms':>8}")
+    for source in sources:
+        latencies = np.array(source.latencies) * 1000
+        p50, p95 = np.percentile(latencies, [50, 95]) if latencies.size else (np.nan, np.nan)
+        print(f"{source.name[-24:]:<24} {source.captured / elapsed:>11.1f}"
+              f" {source.processed / elapsed:>11.1f} {source.dropped:>8} {source.errors:>8}"
+              f" {p50:>8.1f} {p95:>8.1f}")
+
+def run_service(
+        uris:List[Union[int, str]],
+        workers:int = NUM_WORKERS,
+        report_every:float = REPORT_EVERY,
+        realtime:Optional[bool] = None,
+        loop:bool = False,
+        output_path:Optional[str] = None,
+        roi:bool = False
+    ) -> None:
+    """Recognizes faces in several sources concurrently with a shared pool of workers.
+
+    Args:
+        uris (List[Union[int, str]]): The camera IDs, RTSP URLs or video files.
+        workers (int): The number of recognition workers. Defaults to NUM_WORKERS.
+        report_every (float): The seconds between reports of the statistics. Defaults to
+                              REPORT_EVERY.
+        realtime (Optional[bool]): Whether to read the sources at their frame rate. Defaults to
+                                   None (only video files, which would otherwise be read as fast
+                                   as possible).
+        loop (bool): Whether to loop video files. Defaults to False.
+        output_path (Optional[str]): The file to write the results to, as JSON lines. Defaults to
+                                     None.
+        roi (bool): Whether to detect faces on downscaled frames and only run the mesh on crops
+                    around them (for high resolution sources). Defaults to False.
+
+    Returns:
+        None
+    """
+    cond = threading.Condition()
+    sources = [FrameSource(uri, cond, realtime, loop) for uri in uris]
+    scheduler = FairScheduler(sources, cond)
+    output = open(output_path, 'w', encoding='utf-8') if output_path else None
+    output_lock = threading.Lock()
+    threads = [threading.Thread(target=recognition_worker, name=f"recognition-{i}",\
+                                args=(scheduler, output, output_lock, roi), daemon=True)\
+               for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    start_time = time.time()
+    for source in sources:
+        source.start()
+    try:
+        while any(thread.is_alive() for thread in threads):
+            deadline = time.time() + report_every
+            for thread in threads:
+                thread.join(max(0.0, deadline - time.time()))
+            report(sources, time.time() - start_time)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for source in sources:
+            source.stop()
+        scheduler.stop()
+        for thread in threads:
+            thread.join()
+        if output is not None:
+            output.close()
+    report(sources, time.time() - start_time)
+
+# Main execution block
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('sources', nargs='*',\
+                        help='camera IDs, RTSP URLs or video files')
+    parser.add_argument('--all-cameras', action='store_true', help='add every camera found')
+    parser.add_argument('--workers', type=int, default=NUM_WORKERS,\
+                        help='number of recognition workers shared by the sources')
+    parser.add_argument('--report-every', type=float, default=REPORT_EVERY,\
+                        help='seconds between statistics reports')
+    parser.add_argument('--realtime', action=argparse.BooleanOptionalAction, default=None,\
+                        help='read sources at their frame rate (default: only video files)')
+    parser.add_argument('--loop', action='store_true', help='loop video files')
+    parser.add_argument('--output', default=None, help='JSON lines file to write results to')
+    parser.add_argument('--roi', action='store_true',\
+                        help='detect on downscaled frames and align on face crops (1080p, 4K)')
+    args = parser.parse_args()
+    source_uris = [int(uri) if uri.isdigit() else uri for uri in args.sources]
+    if args.all_cameras:
+        source_uris += [i for i in range(test_all_cameras()) if i not in source_uris]
+    if not source_uris:
+        parser.error("no sources given")
+    run_service(source_uris, args.workers, args.report_every, args.realtime, args.loop,\
+                args.output, args.roi)
@@ -1,135 +1,269 @@
 """Pre-process Image Script"""
 # pylint: disable=E1101,E0401,C0413
-from typing import List, Optional
+from typing import List, Optional, Dict, Tuple, Iterator
 import os
 import sys
+import json
 import shutil
-from pkg_resources import resource_filename
+import hashlib
+import argparse
+import multiprocessing
+from importlib.resources import files
 import cv2
-import dlib
 import numpy as np
 from tqdm import tqdm
 sys.path.append("../")
 par_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(1, par_dir)
-from facial_recognition import FaceDetection, FaceAlignment, FaceRepresentation
+from facial_recognition import FaceDetection, FaceAlignment, FaceRepresentation, FaceGallery,\
+                               crop_faces
+from facial_recognition.gallery import VECTOR_DB_PATH, VECTOR_KEYS_PATH, VECTOR_LOG_PATH,\
+                                       VECTOR_LEGACY_KEYS_PATH, VECTOR_METADATA_PATH
 
 # Constants
-RAW_IMAGES_PATH = resource_filename(__name__,\
-                               '../data/raw')
+RAW_IMAGES_PATH = os.path.normpath(files('facial_recognition').joinpath('../data/raw'))
 PROCESSED_IMAGES_PATH = os.path.join(os.path.dirname(__file__),\
                                      '../data/processed')
+MANIFEST_NAME = 'manifest.jsonl'
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+NUM_WORKERS = os.cpu_count() or 1
+CHUNK_SIZE = 1000
 
-def crop_faces(
-        img:np.ndarray,
-        faces:List[dlib.rectangle],
-        padding:Optional[float] = 0.35
-    ) -> List[np.ndarray]:
-    """Crop faces from an image.
+# Per-worker model instances (created once per worker process by `_init_worker`)
+_face_detector:Optional[FaceDetection] = None
+_landmark_predictor:Optional[FaceAlignment] = None
+_face_descriptor:Optional[FaceRepresentation] = None
+
+def load_manifest(
+        manifest_path:str
+    ) -> Dict[str,Dict]:
+    """Load the manifest of the images that were already processed.
+
+    Args:
+        manifest_path (str): The path of the manifest (one JSON entry per line).
+
+    Returns:
+        Dict[str,Dict]: The last entry of each image, by its path relative to the input directory.
+    """
+    manifest = {}
+    if not os.path.exists(manifest_path):
+        return manifest
+    with open(manifest_path, 'r', encoding='utf-8') as manifest_file:
+        for line in manifest_file:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # torn last line of an interrupted run
+                continue
+            manifest[entry['path']] = entry
+    return manifest
+
+def list_images(
+        input_dir:str
+    ) -> Iterator[Tuple[str, int, int]]:
+    """List the images in the input directory.
 
     Args:
-        img (numpy.ndarray): The input image.
-        faces (List[dlib.rectangle]): A list of face objects detected in the image.
-        padding (Optional[float]): The padding factor to apply when cropping the faces. Defaults
-                                   to 0.35.
+        input_dir (str): Path to the input directory containing the images.
 
     Returns:
-        list: A list of cropped face images.
+        Iterator[Tuple[str, int, int]]: The path (relative to `input_dir`), modification time (in
+                                        nanoseconds) and size of each image.
+    """
+    for root, _, files in os.walk(input_dir):
+        for file in sorted(files):
+            if file.lower().endswith(IMAGE_EXTENSIONS):
+                stat = os.stat(os.path.join(root, file))
+                yield os.path.relpath(os.path.join(root, file), input_dir), stat.st_mtime_ns,\
+                      stat.st_size
+
+def _init_worker() -> None:
+    """Loads the models of a worker process (the gallery is never loaded by the workers)."""
+    global _face_detector, _landmark_predictor, _face_descriptor # pylint: disable=W0603
+    _face_detector = FaceDetection()
+    _landmark_predictor = FaceAlignment()
+    _face_descriptor = FaceRepresentation()
+
+def process_image(
+        task:Tuple[str, str, str]
+    ) -> Tuple[str, str, Optional[str], Optional[np.ndarray], Optional[float]]:
+    """Detect, align, represent and crop the single face of an image (runs in a worker).
 
-    Example:
-        img = cv2.imread('image.jpg')
-        faces = detect_faces(img)
-        cropped_faces = crop_faces(img, faces)
+    Args:
+        task (Tuple[str, str, str]): The path of the image relative to the input directory, the
+                                     input directory and the output directory.
+
+    Returns:
+        Tuple[str, str, Optional[str], Optional[np.ndarray], Optional[float]]: The relative path
+            and SHA-1 of the image, and the Vector DB key, descriptor and quality (sharpness) of
+            its face (None if it doesn't have exactly one face).
     """
-    #mult = 1 + padding
-    mh, mw = img.shape[0], img.shape[1]
-
-    cropped_faces = []
-
-    for face in faces:
-        x, y, w, h = face.left(), face.top(), face.width(), face.height()
-        wh = max(w, h)
-        ow = max(0, int(x - (wh * (padding/2)))) + int(wh * (1 + padding)) - mw
-        oh = max(0, int(y - (wh * (padding/2)))) + int(wh * (1 + padding)) - mh
-        if ow > 0 or oh > 0:
-            pad = (max(ow, oh) / wh) * 2
-        else:
-            pad = padding
-        shift = wh * (pad/2)
-        whp = int(wh * (1 + pad))
-        x1, y1 = max(0, int(-shift + x)), max(0, int(-shift + y))
-        x2, y2 = x1 + whp, y1 + whp
-
-        cropped_face = img[y1:y2, x1:x2]
-        cropped_faces.append(cropped_face)
-
-    return cropped_faces
+    relative_path, input_dir, output_dir = task
+    with open(os.path.join(input_dir, relative_path), 'rb') as image_file:
+        img_bin = image_file.read()
+    sha1 = hashlib.sha1(img_bin).hexdigest()
+    img = cv2.imdecode(np.frombuffer(img_bin, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        return relative_path, sha1, None, None, None
+    img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    faces = _face_detector.detect(img_rgb)
+    if not isinstance(faces, list) or len(faces) != 1:
+        return relative_path, sha1, None, None, None
+    landmarks = _landmark_predictor.align(img_rgb, faces)
+    if not isinstance(landmarks, list) or len(landmarks) != 1:
+        return relative_path, sha1, None, None, None
+    descriptors = _face_descriptor.represent(img_rgb, landmarks)
+    if len(descriptors) != 1:
+        return relative_path, sha1, None, None, None
+
+    name, ext = os.path.splitext(relative_path)
+    output_image_path = os.path.join(output_dir, f"{name}_face0{ext}")
+    os.makedirs(os.path.dirname(output_image_path), exist_ok=True)
+    face_img = crop_faces(img, faces)[0]
+    cv2.imwrite(output_image_path, face_img)
+    # variance of the Laplacian, low for blurry faces
+    quality = float(cv2.Laplacian(cv2.cvtColor(face_img, cv2.COLOR_BGR2GRAY), cv2.CV_64F).var())
+    return relative_path, sha1, output_image_path.replace(output_dir, ""), descriptors[0],\
+           quality
+
+def commit_chunk(
+        gallery:FaceGallery,
+        manifest_file,
+        entries:List[Dict],
+        embeddings:List[np.ndarray],
+        keys:List[str],
+        qualities:List[float],
+        stale_keys:List[str]
+    ) -> None:
+    """Add a chunk of embeddings to the Vector DB and only then record its images in the manifest,
+       so an interrupted run never skips an image whose embedding wasn't committed.
+
+    Args:
+        gallery (FaceGallery): The gallery to add the embeddings to.
+        manifest_file: The manifest, opened for appending.
+        entries (List[Dict]): The manifest entries of the images of the chunk.
+        embeddings (List[np.ndarray]): The embeddings of the chunk.
+        keys (List[str]): The Vector DB keys of the embeddings.
+        qualities (List[float]): The quality scores of the faces.
+        stale_keys (List[str]): The keys of the embeddings of the previous versions of modified
+                                images, deleted before the new embeddings are added.
+
+    Returns:
+        None
+    """
+    if stale_keys:
+        gallery.delete_keys(stale_keys)
+    if embeddings:
+        gallery.add(np.array(embeddings, dtype='f'), ids=keys, qualities=qualities)
+    for entry in entries:
+        manifest_file.write(json.dumps(entry) + '\n')
+    manifest_file.flush()
+    os.fsync(manifest_file.fileno())
 
 def process_images(
         input_dir:str,
-        output_dir:str
+        output_dir:str,
+        workers:int = NUM_WORKERS,
+        chunk_size:int = CHUNK_SIZE,
+        rebuild:bool = False
     ) -> None:
     """Process images in the input directory and save the cropped faces in the output directory.
 
+    Images are processed by a pool of worker processes, each with its own models, and their
+    embeddings are committed to the Vector DB every `chunk_size` images. Processed images are
+    recorded in a manifest (path, modification time and SHA-1) in the output directory, so that
+    re-runs only process new or modified images and an interrupted run resumes where it stopped.
+    The embedding of the previous version of a modified image is deleted from the Vector DB when
+    the new one is added. Images without exactly one face are deleted.
+
+    The workers are spawned rather than forked, so they don't inherit the Vector DB files, locks
+    and SQLite connections of the main process.
+
     Args:
         input_dir (str): Path to the input directory containing the images.
         output_dir (str): Path to the output directory where the cropped faces will be saved.
+        workers (int): The number of worker processes. Defaults to the number of CPUs.
+        chunk_size (int): The number of images per commit to the Vector DB. Defaults to
+                          CHUNK_SIZE.
+        rebuild (bool): Whether to delete the output directory, manifest and Vector DB and
+                        process every image again. Defaults to False.
 
     Returns:
         None
     """
-    if os.path.exists(output_dir):
-        shutil.rmtree(output_dir)
-    os.mkdir(output_dir)
-
-    face_detector = FaceDetection()
-    landmark_predictor = FaceAlignment()
-    face_descriptor = FaceRepresentation()
-    embeddings = []
-    paths = []
-
-    num_dirs = len(os.listdir(input_dir)) + 1
-    for root, _, files in tqdm(os.walk(input_dir), total=num_dirs):
-        for file in files:
-            if file.lower().endswith(('.png', '.jpg', '.jpeg')):
-                input_image_path = os.path.join(root, file)
-                img = cv2.imread(input_image_path)
-                if img is not None:
-                    img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-                    faces = face_detector.detect(img_rgb)
-                else:
-                    faces = None
-                if isinstance(faces, list) and len(faces) == 1:
-                    landmarks = landmark_predictor.align(img_rgb, faces)
-                    if isinstance(landmarks, list) and len(landmarks)==1:
-                        descriptors = face_descriptor.represent(img_rgb, landmarks)
-                        if isinstance(descriptors, list) and len(descriptors) == 1:
-                            relative_path = os.path.relpath(root, input_dir)
-                            output_subdir = os.path.join(output_dir, relative_path)
-                            os.makedirs(output_subdir, exist_ok=True)
-
-                            cropped_faces = crop_faces(img, faces)
-
-                            for idx, cropped_face in enumerate(cropped_faces):
-                                output_image_path = os.path.join(output_subdir,\
-                                                            f"{os.path.splitext(file)[0]}_face{idx}"
-                                                            f"{os.path.splitext(file)[1]}")
-                                cv2.imwrite(output_image_path, cropped_face)
-                                print(f"Saved: {output_image_path}")
-                                embeddings.append(descriptors[0])
-                                paths.append(output_image_path.replace(output_dir, ""))
-                        else:
-                            print(f"Delete: {input_image_path}")
-                            os.remove(input_image_path)
-                    else:
-                        print(f"Delete: {input_image_path}")
-                        os.remove(input_image_path)
-                else:
-                    print(f"Delete: {input_image_path}")
-                    os.remove(input_image_path)
-    embeddings = np.array(embeddings, dtype='f')
-    face_descriptor.add_to_vectordb(embeddings, ids=paths)
+    if rebuild:
+        if os.path.exists(output_dir):
+            shutil.rmtree(output_dir)
+        for path in [VECTOR_DB_PATH, VECTOR_KEYS_PATH, VECTOR_LEGACY_KEYS_PATH,\
+                     VECTOR_METADATA_PATH, VECTOR_METADATA_PATH + '-wal',\
+                     VECTOR_METADATA_PATH + '-shm']:
+            if os.path.exists(path):
+                os.remove(path)
+        if os.path.exists(VECTOR_LOG_PATH):
+            shutil.rmtree(VECTOR_LOG_PATH)
+    os.makedirs(output_dir, exist_ok=True)
+
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+    tasks, stats = [], {}
+    for relative_path, mtime_ns, size in list_images(input_dir):
+        entry = manifest.get(relative_path)
+        if entry is not None and entry['mtime_ns'] == mtime_ns and entry['size'] == size:
+            continue
+        tasks.append((relative_path, input_dir, output_dir))
+        stats[relative_path] = (mtime_ns, size)
+    print(f"{len(tasks)} new or modified images ({len(manifest)} already processed)")
+    if not tasks:
+        return
+
+    gallery = FaceGallery.shared()
+    committed_keys = set(gallery.vectorkeys)
+    entries, embeddings, keys, qualities, stale_keys = [], [], [], [], []
+    num_added, num_deleted = 0, 0
+    with multiprocessing.get_context('spawn').Pool(workers, initializer=_init_worker) as pool,\
+         open(manifest_path, 'a', encoding='utf-8') as manifest_file:
+        results = pool.imap_unordered(process_image, tasks, chunksize=8)
+        for relative_path, sha1, key, descriptor, quality in tqdm(results, total=len(tasks)):
+            previous = manifest.get(relative_path)
+            if previous is not None and previous['sha1'] != sha1 and previous.get('key'):
+                # the embedding of the previous version of the image would keep voting
+                stale_keys.append(previous['key'])
+            if key is None:
+                print(f"Delete: {os.path.join(input_dir, relative_path)}")
+                os.remove(os.path.join(input_dir, relative_path))
+                num_deleted += 1
+                continue
+            mtime_ns, size = stats[relative_path]
+            entries.append({'path': relative_path, 'mtime_ns': mtime_ns, 'size': size,\
+                            'sha1': sha1, 'key': key})
+            # skip images that were only touched, or whose embedding was committed by a run
+            # interrupted before recording them in the manifest
+            if (previous is None and key not in committed_keys) or\
+               (previous is not None and previous['sha1'] != sha1):
+                embeddings.append(descriptor)
+                keys.append(key)
+                qualities.append(quality)
+            if len(entries) >= chunk_size:
+                commit_chunk(gallery, manifest_file, entries, embeddings, keys, qualities,\
+                             stale_keys)
+                num_added += len(embeddings)
+                entries, embeddings, keys, qualities, stale_keys = [], [], [], [], []
+        commit_chunk(gallery, manifest_file, entries, embeddings, keys, qualities, stale_keys)
+        num_added += len(embeddings)
+    gallery.compact(block=True)
+    print(f"Added {num_added} faces to the Vector DB, deleted {num_deleted} images")
 
 # Main execution block
 if __name__ == '__main__':
-    process_images(RAW_IMAGES_PATH, PROCESSED_IMAGES_PATH)
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--input', default=RAW_IMAGES_PATH, help='directory of raw images')
+    parser.add_argument('--output', default=PROCESSED_IMAGES_PATH,\
+                        help='directory of cropped faces (and of the manifest)')
+    parser.add_argument('--workers', type=int, default=NUM_WORKERS,\
+                        help='number of worker processes')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,\
+                        help='number of images per commit to the Vector DB')
+    parser.add_argument('--rebuild', action='store_true',\
+                        help='delete the processed images, manifest and Vector DB and start over')
+    args = parser.parse_args()
+    process_images(args.input, args.output, args.workers, args.chunk_size, args.rebuild)
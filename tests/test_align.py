@@ -0,0 +1,75 @@
+"""Tests of the Face Alignment"""
+# pylint: disable=E1101,E0401,C0413
+from types import SimpleNamespace
+import dlib
+import numpy as np
+from facial_recognition.align import FaceAlignment
+
+class FakeMesh:
+    """Finds a mesh (in normalized coordinates) in each of the given boxes, recording the shape
+       of the images it's run on."""
+    def __init__(
+            self,
+            boxes
+        ) -> None:
+        rng = np.random.default_rng(0)
+        self.meshes = [rng.random((478, 2)) * (x2 - x1, y2 - y1) + (x1, y1)\
+                       for x1, y1, x2, y2 in boxes]
+        self.shapes = []
+
+    def process(
+            self,
+            img_rgb
+        ):
+        """Returns the meshes, like MediaPipe."""
+        self.shapes.append(img_rgb.shape[:2])
+        faces = [SimpleNamespace(landmark=[SimpleNamespace(x=x, y=y) for x, y in mesh])\
+                 for mesh in self.meshes]
+        return SimpleNamespace(multi_face_landmarks=faces)
+
+def make_alignment(
+        boxes,
+        **kwargs
+    ) -> FaceAlignment:
+    """Makes an alignment whose mesh finds a face in each of the (normalized) boxes."""
+    landmark_predictor = FaceAlignment(**kwargs)
+    landmark_predictor._predictor = FakeMesh(boxes) # pylint: disable=W0212
+    return landmark_predictor
+
+def inside(
+        landmarks:np.ndarray,
+        face:dlib.rectangle
+    ) -> bool:
+    """Whether the landmarks of a face lie in its rectangle."""
+    return bool((landmarks >= (face.left(), face.top())).all() and\
+                (landmarks <= (face.right(), face.bottom())).all())
+
+def test_meshes_are_matched_to_their_faces_whatever_their_order():
+    faces = [dlib.rectangle(40, 40, 120, 120), dlib.rectangle(240, 240, 320, 320),\
+             dlib.rectangle(300, 0, 360, 60)]
+    landmark_predictor = make_alignment([(0.6, 0.6, 0.8, 0.8), (0.1, 0.1, 0.3, 0.3)],\
+                                        static_image_mode=False, max_num_faces=4)
+    img = np.zeros((400, 400, 3), dtype='uint8')
+    matched, landmarks = landmark_predictor.align_array(img, faces)
+    # the face without a mesh is left out
+    assert matched == faces[:2] and landmarks.shape == (2, 68, 2)
+    assert inside(landmarks[0], faces[0]) and inside(landmarks[1], faces[1])
+    shapes = landmark_predictor.align(img, faces)
+    assert [shape.rect for shape in shapes] == faces[:2] and shapes[0].num_parts == 68
+
+def test_no_mesh_gives_no_landmarks():
+    landmark_predictor = make_alignment([], landmark_subset='small')
+    faces, landmarks = landmark_predictor.align_array(np.zeros((40, 40, 3), dtype='uint8'),\
+                                                      [dlib.rectangle(0, 0, 20, 20)])
+    assert faces == [] and landmarks.shape == (0, 5, 2)
+    # one face in static image mode unless asked otherwise
+    assert landmark_predictor.static_image_mode and landmark_predictor.max_num_faces == 1
+
+def test_roi_runs_the_mesh_on_a_crop_around_each_face():
+    faces = [dlib.rectangle(100, 100, 199, 199), dlib.rectangle(700, 500, 799, 599)]
+    landmark_predictor = make_alignment([(0.3, 0.3, 0.7, 0.7)], roi=True, max_num_faces=4)
+    matched, landmarks = landmark_predictor.align_array(np.zeros((1000, 1000, 3), dtype='uint8'),\
+                                                        faces)
+    assert matched == faces and landmark_predictor.static_image_mode
+    assert inside(landmarks[0], faces[0]) and inside(landmarks[1], faces[1])
+    assert landmark_predictor.predictor.shapes == [(135, 135), (135, 135)]
@@ -0,0 +1,174 @@
+"""Tests of the Web App Endpoints"""
+# pylint: disable=E1101,E0401,C0413
+import json
+import time
+import base64
+import cv2
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+from facial_recognition.gallery import FaceGallery
+from facial_recognition.represent import FaceRepresentation
+from facial_recognition.identify import FaceIdentification
+from facial_recognition.metrics import REGISTRY
+import webapp.app as app_module
+import webapp.workers as workers_module
+
+BB = [0, 0, 64, 64]
+LANDMARKS = [[8 + (i % 9) * 6, 8 + (i // 9) * 6] for i in range(68)]
+
+def fake_represent(
+        _self,
+        img_rgb:np.ndarray,
+        landmarks
+    ) -> np.ndarray:
+    """Describes every face of an image by the brightness of the image."""
+    return np.full((len(landmarks), 128), img_rgb.mean() / 255, dtype='float32')
+
+def fake_represent_batch(
+        _self,
+        imgs_rgb,
+        landmarks
+    ) -> np.ndarray:
+    """Describes the faces of many images by the brightness of each image."""
+    return np.array([[img_rgb.mean() / 255] * 128 for img_rgb, img_landmarks\
+                     in zip(imgs_rgb, landmarks) for _ in img_landmarks],\
+                    dtype='float32').reshape(-1, 128)
+
+def crop(
+        brightness:int
+    ) -> bytes:
+    """Encodes a face crop of a given brightness as PNG."""
+    return cv2.imencode('.png', np.full((64, 64, 3), brightness, dtype=np.uint8))[1].tobytes()
+
+def post_crop(
+        client:TestClient,
+        brightness:int,
+        **fields
+    ):
+    """Posts a face crop of a given brightness to `/identify/crop`, with the metadata fields."""
+    meta = {'bb': BB, 'landmarks': LANDMARKS, **fields}
+    return client.post('/identify/crop', content=crop(brightness),\
+                       headers={'content-type': 'application/octet-stream',\
+                                'x-face-meta': json.dumps(meta)})
+
+def session_message(
+        seq:int,
+        track_id:str,
+        brightness:int
+    ) -> bytes:
+    """Encodes a face crop of a given brightness as a message of a recognition session."""
+    meta = json.dumps({'seq': seq, 'track_id': track_id, 'bb': BB, 'landmarks': LANDMARKS})
+    return app_module.SESSION_HEADER.pack(len(meta)) + meta.encode() + crop(brightness)
+
+@pytest.fixture(name='client')
+def fixture_client(tmp_path, monkeypatch):
+    """Client of the app with an empty gallery and descriptors faked from the crop brightness."""
+    gallery = FaceGallery(db_path=f"{tmp_path}/faces.faiss", keys_path=f"{tmp_path}/faces.keys",\
+                          log_dir=f"{tmp_path}/faces.wal", metadata_path=None)
+    gallery.subscribe(app_module.invalidate_results)
+    monkeypatch.setattr(app_module, 'face_gallery', gallery)
+    monkeypatch.setattr(app_module, 'face_descriptor', FaceRepresentation(gallery=gallery))
+    monkeypatch.setattr(app_module, 'face_identifier', FaceIdentification(gallery=gallery))
+    monkeypatch.setattr(FaceRepresentation, 'represent', fake_represent)
+    monkeypatch.setattr(FaceRepresentation, 'represent_batch', fake_represent_batch)
+    app_module.result_cache.clear()
+    workers_module._descriptor_cache.clear() # pylint: disable=W0212
+    # not entered as a context manager: the shutdown would stop the worker pool of the module
+    return TestClient(app_module.app)
+
+def test_crops_are_enrolled_and_identified_as_form_or_body(client):
+    meta = {'bb': BB, 'landmarks': LANDMARKS}
+    response = client.post('/identify/crop', files={'crop': ('face.png', crop(50), 'image/png')},\
+                           data={'meta': json.dumps({**meta, 'name': 'ana'})})
+    assert response.json()['message'] == "Added `ana` to the Vector DB"
+    for brightness, name in ((50, 'ana'), (150, 'nomatch')):
+        response = client.post('/identify/crop', content=crop(brightness),\
+                               headers={'content-type': 'application/octet-stream',\
+                                        'x-face-meta': json.dumps(meta)})
+        assert response.json()['name'] == name
+    response = client.post('/identify/crop', content=crop(50),\
+                           headers={'content-type': 'application/octet-stream'})
+    assert response.status_code == 400
+
+def test_results_of_a_track_are_reused_and_served_when_saturated(client, monkeypatch):
+    post_crop(client, 50, name='ana')
+    first = post_crop(client, 50, track_id='t1').json()
+    # a recent result of the track is reused without describing the new crop
+    second = post_crop(client, 150, track_id='t1').json()
+    assert first['name'] == second['name'] == 'ana' and second['cached']
+    assert 'cached' not in first and second['trackId'] == 't1'
+    monkeypatch.setattr(app_module, 'TRACK_RESULT_TTL', 0.0)
+    post_crop(client, 50, track_id='t2')
+    # expired, but still better than a 429
+    monkeypatch.setattr(app_module.recognition_pool, 'max_pending', 0)
+    assert post_crop(client, 50, track_id='t2').json()['name'] == 'ana'
+    assert post_crop(client, 50).status_code == 429
+
+def test_cached_results_are_dropped_when_the_gallery_changes(client):
+    post_crop(client, 50, name='ana')
+    assert post_crop(client, 120, track_id='t1').json()['name'] == 'nomatch'
+    hits = client.get('/cache/stats').json()['descriptors']['hits']
+    # the same face again reuses its descriptor and result
+    assert post_crop(client, 120).json()['cached']
+    assert client.get('/cache/stats').json()['descriptors']['hits'] == hits + 1
+    post_crop(client, 120, name='bo')
+    result = post_crop(client, 120, track_id='t1').json()
+    assert result['name'] == 'bo' and 'cached' not in result
+
+def test_metrics_are_served_and_timed_only_when_enabled(client, monkeypatch):
+    monkeypatch.setattr(REGISTRY, 'enabled', False)
+    assert client.get('/metrics').status_code == 404
+    assert 'server-timing' not in post_crop(client, 50).headers
+    monkeypatch.setattr(REGISTRY, 'enabled', True)
+    response = post_crop(client, 60)
+    assert 'represent;dur=' in response.headers['server-timing']
+    metrics = client.get('/metrics').text
+    assert 'webapp_request_seconds_count{endpoint="identify_crop",result="computed"}' in metrics
+    assert 'webapp_stage_seconds_bucket{stage="represent",le="+Inf"}' in metrics
+    assert 'gallery_records 0\n' in metrics
+
+
+def test_batches_are_enrolled_up_to_the_cap_and_identified(client):
+    files = [('images', (f"{i}.png", crop(50 if i < 11 else 150), 'image/png')) for i in range(12)]
+    meta = [{'id': str(i), 'name': 'ana' if i < 11 else 'bo', 'bb': BB, 'landmarks': LANDMARKS}\
+            for i in range(12)]
+    response = client.post('/enroll/batch', files=files, data={'meta': json.dumps(meta)})
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    statuses = {line['index']: line['status'] for line in lines}
+    assert sorted(statuses) == list(range(12)) and statuses[10] == 'skipped'
+    assert [statuses[i] for i in range(10)] + [statuses[11]] == ['enrolled'] * 11
+    assert app_module.face_gallery.count('ana') == app_module.MAX_FACES_PER_NAME
+    lines = []
+    for i, brightness in enumerate((50, 150, 50, 90)):
+        image = 'data:image/png;base64,' + base64.b64encode(crop(brightness)).decode()
+        lines.append(json.dumps({'image': 'garbage' if i == 2 else image, 'id': f"x{i}",\
+                                 'bb': BB, 'landmarks': LANDMARKS}))
+    response = client.post('/identify/batch', content='\n'.join(lines),\
+                           headers={'content-type': 'application/x-ndjson'})
+    results = {line['index']: line for line in map(json.loads, response.text.splitlines())}
+    assert [results[i].get('name') for i in range(4)] == ['ana', 'bo', None, 'nomatch']
+    assert 'error' in results[2] and results[3]['id'] == 'x3'
+    # every image of an enrollment needs a name, and the content type must be known
+    assert client.post('/enroll/batch', files=files).status_code == 400
+    assert client.post('/identify/batch', content='x',\
+                       headers={'content-type': 'text/plain'}).status_code == 400
+
+def test_sessions_drop_superseded_crops_and_tag_results_with_their_seq(client, monkeypatch):
+    post_crop(client, 50, name='ana')
+    def slow_represent(self, img_rgb, landmarks):
+        time.sleep(0.2)
+        return fake_represent(self, img_rgb, landmarks)
+    monkeypatch.setattr(FaceRepresentation, 'represent', slow_represent)
+    with client.websocket_connect('/ws/session') as websocket:
+        # the crops of track `a` sent while its first one is described are superseded
+        for seq in range(4):
+            websocket.send_bytes(session_message(seq, 'a', 52))
+        websocket.send_bytes(session_message(4, 'b', 150))
+        websocket.send_text('hello')
+        results = [websocket.receive_json() for _ in range(6)]
+    by_seq = {result['seq']: result for result in results if 'seq' in result}
+    assert by_seq[0]['name'] == by_seq[3]['name'] == 'ana' and by_seq[4]['name'] == 'nomatch'
+    assert by_seq[1]['dropped'] and by_seq[2]['dropped'] and by_seq[1]['trackId'] == 'a'
+    assert [result for result in results if 'seq' not in result][0]['error']
+    assert not app_module.sessions
@@ -0,0 +1,26 @@
+"""Tests of the Pipeline Stages Benchmark"""
+# pylint: disable=E1101,E0401,C0413
+import os
+import sys
+import pytest
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),\
+                                'scripts'))
+from benchmark import time_calls, summarize, compare
+
+def test_calls_are_timed_after_the_warmup():
+    calls = []
+    latencies, items = time_calls(lambda i: calls.append(i) or 2, iterations=3, warmup=2)
+    assert calls == [0, 1, 0, 1, 2] and len(latencies) == 3 and items == 6
+
+def test_summary_has_percentiles_and_throughput():
+    summary = summarize([0.01] * 99 + [0.11], 200, None)
+    assert summary['calls'] == 100 and summary['p50_ms'] == pytest.approx(10)
+    assert summary['p99_ms'] == pytest.approx(11) and summary['peak_rss_mb'] is None
+    assert summary['throughput'] == pytest.approx(200 / 1.1)
+
+def test_only_changes_beyond_the_tolerance_are_regressions():
+    baseline = {'detect': {'p50_ms': 10.0, 'throughput': 100.0, 'peak_rss_mb': 0}}
+    results = {'detect': {'p50_ms': 11.0, 'throughput': 70.0, 'peak_rss_mb': 500.0},\
+               'identify': {'p50_ms': 1.0}}
+    assert compare(results, baseline) == ["detect throughput: 100 -> 70 (-30%)"]
+    assert len(compare(results, baseline, tolerance=0.05)) == 2
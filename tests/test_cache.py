@@ -0,0 +1,25 @@
+"""Tests of the Descriptor and Result Caches"""
+# pylint: disable=E1101,E0401,C0413
+import numpy as np
+from facial_recognition.cache import ResultCache, chip_hash, same_chip, HASH_CHIP_SIZE
+
+def test_same_chip_tells_colliding_faces_apart():
+    rng = np.random.default_rng(0)
+    chip = rng.integers(10, 200, (HASH_CHIP_SIZE, HASH_CHIP_SIZE), dtype=np.uint8)
+    noisy = (chip.astype('int16') + rng.integers(-3, 4, chip.shape)).astype(np.uint8)
+    # a uniformly brighter chip keeps the same gradients, so the same hash
+    brighter = chip + 40
+    assert same_chip(chip, noisy)
+    assert chip_hash(chip) == chip_hash(brighter)
+    assert not same_chip(chip, brighter)
+
+def test_result_cache_invalidates_by_tag_and_clears():
+    cache = ResultCache(max_size=2)
+    cache.set('a', 1, tag='ana')
+    cache.set('b', 2, tag='bo')
+    assert cache.invalidate('ana') == 1 and cache.get('a') is None and cache.get('b') == 2
+    cache.set('c', 3)
+    cache.set('d', 4)
+    assert cache.get('b') is None and cache.stats()['evictions'] == 1
+    cache.clear()
+    assert cache.stats()['size'] == 0 and cache.stats()['invalidations'] == 3
@@ -0,0 +1,30 @@
+"""Tests of the Face Detection"""
+# pylint: disable=E1101,E0401,C0413
+from types import SimpleNamespace
+import dlib
+import numpy as np
+from facial_recognition.detect import FaceDetection
+
+class FakeDetector:
+    """Detects a face at the same relative position in every image, recording their shapes."""
+    def __init__(self) -> None:
+        self.shapes = []
+
+    def process(
+            self,
+            img_rgb
+        ):
+        """Returns the detections, like MediaPipe."""
+        self.shapes.append(img_rgb.shape[:2])
+        bbox = SimpleNamespace(xmin=0.25, ymin=0.5, width=0.1, height=0.2)
+        return SimpleNamespace(detections=[SimpleNamespace(\
+            location_data=SimpleNamespace(relative_bounding_box=bbox))])
+
+def test_large_images_are_detected_downscaled_and_mapped_back():
+    face_detector = FaceDetection(max_size=640)
+    face_detector._detector = FakeDetector() # pylint: disable=W0212
+    assert face_detector.detect(np.zeros((1080, 1920, 3), dtype='uint8')) ==\
+           [dlib.rectangle(480, 540, 672, 756)]
+    assert face_detector.detect(np.zeros((300, 400, 3), dtype='uint8')) ==\
+           [dlib.rectangle(100, 150, 140, 210)]
+    assert face_detector.detector.shapes == [(360, 640), (300, 400)]
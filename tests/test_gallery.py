@@ -0,0 +1,158 @@
+"""Tests of the Shared Gallery"""
+# pylint: disable=E1101,E0401,C0413
+import os
+import threading
+import multiprocessing
+import joblib
+import numpy as np
+from facial_recognition.gallery import FaceGallery
+
+def make_gallery(
+        work_dir:str,
+        **kwargs
+    ) -> FaceGallery:
+    """Opens the gallery stored in a directory (without a metadata store by default)."""
+    kwargs.setdefault('metadata_path', None)
+    return FaceGallery(db_path=f"{work_dir}/faces.faiss", keys_path=f"{work_dir}/faces.keys",\
+                       log_dir=f"{work_dir}/faces.wal", **kwargs)
+
+def enroll(
+        work_dir:str,
+        name:str,
+        num_faces:int
+    ) -> None:
+    """Enrolls faces one at a time from a separate process."""
+    gallery = make_gallery(work_dir, compact_every=3)
+    for i in range(num_faces):
+        gallery.add(np.random.rand(1, 128).astype('float32'), [f"/{name}/{i}.jpg"])
+    if gallery.compaction is not None:
+        gallery.compaction.join()
+
+def test_writers_sharing_a_log_keep_every_enrollment(tmp_path):
+    first, second = make_gallery(str(tmp_path)), make_gallery(str(tmp_path))
+    first.add(np.random.rand(1, 128).astype('float32'), ['/procA/0.jpg'])
+    second.add(np.random.rand(1, 128).astype('float32'), ['/procB/0.jpg'])
+    assert second.count('procA') == 1 and second.num_records == 2
+    reopened = make_gallery(str(tmp_path))
+    assert reopened.count('procA') == 1 and reopened.count('procB') == 1
+
+def test_deletes_and_compactions_of_another_writer_are_applied(tmp_path):
+    first, second = make_gallery(str(tmp_path)), make_gallery(str(tmp_path))
+    first.add(np.random.rand(2, 128).astype('float32'), ['/ana/0.jpg', '/ana/1.jpg'])
+    assert second.delete('ana') == 2
+    first.compact(block=True)
+    second.add(np.random.rand(1, 128).astype('float32'), ['/bo/0.jpg'])
+    second.compact(block=True)
+    first.add(np.random.rand(1, 128).astype('float32'), ['/cy/0.jpg'])
+    for gallery in (first, make_gallery(str(tmp_path))):
+        assert gallery.num_records == 4
+        assert [gallery.count(name) for name in ('ana', 'bo', 'cy')] == [0, 1, 1]
+
+def test_processes_enrolling_concurrently_keep_every_enrollment(tmp_path):
+    ctx = multiprocessing.get_context('spawn')
+    processes = [ctx.Process(target=enroll, args=(str(tmp_path), f"proc{i}", 10))\
+                 for i in range(3)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+    gallery = make_gallery(str(tmp_path))
+    assert gallery.num_records == 30
+    assert [gallery.count(f"proc{i}") for i in range(3)] == [10, 10, 10]
+    names = [gallery.get_name(row) for row in range(30)]
+    for row in range(30):
+        np.testing.assert_array_equal(gallery.vectordb.reconstruct(row).shape, (128,))
+    assert sorted(names) == sorted(f"proc{i}" for i in range(3) for _ in range(10))
+
+def test_gallery_is_migrated_to_the_index_type_on_load(tmp_path):
+    gallery = make_gallery(str(tmp_path))
+    gallery.add(np.random.rand(100, 128).astype('float32'), [f"/ana/{i}.jpg" for i in range(100)])
+    migrated = make_gallery(str(tmp_path), index_type='ivf')
+    assert not migrated.vectorlog.segments()[:-1]
+    reopened = make_gallery(str(tmp_path), index_type='ivf')
+    assert type(reopened.vectordb).__name__ == 'IndexIVFFlat'
+    assert reopened.num_records == 100 and reopened.count('ana') == 100
+
+def test_lookups_and_deletes_go_through_the_metadata_store(tmp_path):
+    metadata_path = f"{tmp_path}/faces.sqlite"
+    first = make_gallery(str(tmp_path), metadata_path=metadata_path)
+    second = make_gallery(str(tmp_path), metadata_path=metadata_path)
+    first.add(np.random.rand(3, 128).astype('float32'), ['/ana/0.jpg', '/bo/0.jpg', '/ana/1.jpg'])
+    assert first.count('ana') == 2 and first.rows('ana') == [0, 2]
+    assert first.identities() == [('ana', 2), ('bo', 1)] and first.num_identities == 2
+    # rows another process enrolled are only listed once caught up with
+    assert second.count('ana') == 2 and second.rows('ana') == []
+    assert second.delete('ana') == 2
+    assert first.count('ana') == 0 and first.identities() == [('bo', 1)]
+    reopened = make_gallery(str(tmp_path), metadata_path=metadata_path)
+    assert reopened.rows('ana') == [] and reopened.rows('bo') == [1]
+    assert reopened.metadata.faces(name='bo')[0]['path'] == '/bo/0.jpg'
+
+def test_lookups_scan_the_labels_without_a_metadata_store(tmp_path):
+    gallery = make_gallery(str(tmp_path))
+    gallery.add(np.random.rand(3, 128).astype('float32'), ['/ana/0.jpg', '/bo/0.jpg', '/ana/1.jpg'])
+    assert gallery.rows('ana') == [0, 2] and gallery.identities() == [('ana', 2), ('bo', 1)]
+    assert gallery.delete('ana') == 2 and gallery.delete('ana') == 0
+    assert gallery.count('ana') == 0 and gallery.identities() == [('bo', 1)]
+
+def test_legacy_keys_are_converted_without_rewriting_the_index(tmp_path):
+    legacy = make_gallery(str(tmp_path), storage='snapshot', mmap=False)
+    legacy.add(np.random.rand(3, 128).astype('float32'), ['/ana/0.jpg', '/bo/0.jpg', '/ana/1.jpg'])
+    joblib.dump(list(legacy.vectorkeys), f"{tmp_path}/faces.pkl")
+    os.remove(f"{tmp_path}/faces.keys")
+    index_stat = os.stat(f"{tmp_path}/faces.faiss")
+    gallery = make_gallery(str(tmp_path))
+    assert os.path.exists(f"{tmp_path}/faces.keys") and gallery.rows('ana') == [0, 2]
+    assert os.stat(f"{tmp_path}/faces.faiss").st_mtime_ns == index_stat.st_mtime_ns
+
+def test_concurrent_enrollments_of_a_name_stay_within_the_cap(tmp_path):
+    first, second = make_gallery(str(tmp_path)), make_gallery(str(tmp_path))
+    added = []
+    def enroll_capped(gallery):
+        for _ in range(5):
+            added.extend(gallery.add(np.random.rand(1, 128).astype('float32'), ['ana'],\
+                                     max_per_name=3).tolist())
+    threads = [threading.Thread(target=enroll_capped, args=(gallery,))\
+               for gallery in (first, second, first, second)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(added) == 3 and make_gallery(str(tmp_path)).count('ana') == 3
+    mask = first.add(np.random.rand(2, 128).astype('float32'), ['ana', 'bo'], max_per_name=3)
+    assert mask.tolist() == [False, True]
+
+def test_delete_keys_only_deletes_those_keys_in_every_writer(tmp_path):
+    first, second = make_gallery(str(tmp_path)), make_gallery(str(tmp_path))
+    first.add(np.random.rand(3, 128).astype('float32'), ['/ana/0.jpg', '/ana/1.jpg', '/bo/0.jpg'])
+    assert first.delete_keys(['/ana/0.jpg', '/cy/0.jpg', 'bo']) == 1
+    first.add(np.random.rand(1, 128).astype('float32'), ['/ana/0.jpg'])
+    # caught up with on its next enrollment
+    second.add(np.random.rand(1, 128).astype('float32'), ['/cy/0.jpg'])
+    for gallery in (second, make_gallery(str(tmp_path))):
+        assert gallery.rows('ana') == [1, 3] and gallery.rows('bo') == [2]
+
+def test_enrollments_are_logged_and_compacted_into_the_snapshot(tmp_path):
+    gallery = make_gallery(str(tmp_path), compact_every=4)
+    gallery.add(np.random.rand(3, 128).astype('float32'), ['/ana/0.jpg', '/ana/1.jpg', '/bo/0.jpg'])
+    # appended to the log only, and replayed on load
+    assert not os.path.exists(f"{tmp_path}/faces.faiss")
+    assert make_gallery(str(tmp_path)).count('ana') == 2
+    gallery.add(np.random.rand(1, 128).astype('float32'), ['/bo/1.jpg'])
+    gallery.compaction.join()
+    assert os.path.exists(f"{tmp_path}/faces.faiss") and gallery.vectorlog.pending_records == 0
+    reopened = make_gallery(str(tmp_path))
+    assert reopened.num_records == 4 and reopened.count('bo') == 2
+
+def test_snapshot_is_mapped_and_copied_before_the_first_enrollment(tmp_path):
+    gallery = make_gallery(str(tmp_path))
+    gallery.add(np.random.rand(5, 128).astype('float32'), [f"/ana/{i}.jpg" for i in range(5)])
+    gallery.compact(block=True)
+    mapped = make_gallery(str(tmp_path))
+    assert mapped.mmapped and type(mapped.vectorkeys).__name__ == 'KeyTable'
+    assert mapped.count('ana') == 5 and mapped.delete('ana') == 5 and mapped.mmapped
+    np.testing.assert_array_equal(mapped.vectordb.reconstruct(2), gallery.vectordb.reconstruct(2))
+    mapped.add(np.random.rand(1, 128).astype('float32'), ['/bo/0.jpg'])
+    assert not mapped.mmapped and mapped.rows('bo') == [5]
+    assert not make_gallery(str(tmp_path), mmap=False).mmapped
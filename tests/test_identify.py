@@ -0,0 +1,80 @@
+"""Tests of the Face Identification"""
+# pylint: disable=E1101,E0401,C0413
+import numpy as np
+import pytest
+from facial_recognition.gallery import FaceGallery
+from facial_recognition.represent import FaceRepresentation
+from facial_recognition.identify import FaceIdentification, vote
+
+def make_gallery(
+        work_dir:str,
+        **kwargs
+    ) -> FaceGallery:
+    """Opens the gallery stored in a directory (without a metadata store)."""
+    return FaceGallery(db_path=f"{work_dir}/faces.faiss", keys_path=f"{work_dir}/faces.keys",\
+                       log_dir=f"{work_dir}/faces.wal", metadata_path=None, **kwargs)
+
+def test_enrollments_are_identified_through_the_shared_gallery(tmp_path):
+    gallery = make_gallery(str(tmp_path))
+    face_descriptor = FaceRepresentation(gallery=gallery)
+    face_identifier = FaceIdentification(gallery=gallery)
+    face = np.random.rand(1, 128).astype('float32')
+    face_descriptor.add_to_vectordb(face, ids=['/ana/0.jpg'])
+    # searchable right away, without reloading the index from disk
+    assert face_identifier.identify(face)[1] == [['ana']]
+    other = FaceRepresentation(gallery=make_gallery(str(tmp_path)))
+    other.add_to_vectordb(face + 1, ids=['/bo/0.jpg'])
+    assert face_identifier.identify(face + 1)[1] == [[]]
+    face_identifier.reload_vectordb()
+    assert face_identifier.identify(face + 1)[1] == [['bo']]
+
+def test_classes_share_one_gallery_per_process(tmp_path, monkeypatch):
+    monkeypatch.setattr(FaceGallery, '_shared', None)
+    gallery = FaceGallery.shared(db_path=f"{tmp_path}/faces.faiss",\
+                                 keys_path=f"{tmp_path}/faces.keys",\
+                                 log_dir=f"{tmp_path}/faces.wal", metadata_path=None)
+    assert FaceIdentification().gallery is gallery
+    assert FaceRepresentation().gallery is gallery
+
+def test_counts_keys_and_deletes_of_a_name(tmp_path):
+    gallery = make_gallery(str(tmp_path))
+    face_descriptor = FaceRepresentation(gallery=gallery)
+    face_identifier = FaceIdentification(gallery=gallery)
+    faces = np.random.rand(3, 128).astype('float32')
+    face_descriptor.add_to_vectordb(faces, ids=['/ana/0.jpg', '/bo/0.jpg', '/ana/1.jpg'])
+    assert face_identifier.count('ana') == 2 and face_identifier.count('cy') == 0
+    assert face_identifier.list_keys('ana') == ['/ana/0.jpg', '/ana/1.jpg']
+    assert face_descriptor.delete_from_vectordb('ana') == 2
+    # deleted rows are no longer found, nor counted after a reload
+    assert face_identifier.identify(faces[:1])[1] == [[]]
+    face_identifier.reload_vectordb()
+    assert face_identifier.count('ana') == 0 and face_identifier.list_keys('bo') == ['/bo/0.jpg']
+
+def test_votes_go_to_the_most_valid_neighbors_and_ties_to_the_nearest():
+    labels = np.array([[0, 1, 1], [2, 3, 3], [4, 5, 6]])
+    distances = np.array([[0.1, 0.2, 0.3]] * 3, dtype='float32')
+    valid = np.array([[True, True, True], [True, True, False], [False, False, False]])
+    label, distance, votes = vote(labels, distances, valid)
+    assert label.tolist() == [1, 2, -1] and votes.tolist() == [2, 1, 0]
+    assert distance[:2].tolist() == pytest.approx([0.2, 0.1]) and distance[2] == np.inf
+
+def test_batches_are_identified_and_range_searched_by_label(tmp_path):
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(3, 128)).astype('float32')
+    faces = np.repeat(centers, 4, axis=0) + rng.normal(scale=0.01, size=(12, 128))
+    gallery = make_gallery(str(tmp_path))
+    gallery.add(faces.astype('float32'), [f"/person{i // 4}/{i % 4}.jpg" for i in range(12)])
+    face_identifier = FaceIdentification(gallery=gallery)
+    queries = np.concatenate([centers, np.full((1, 128), 9.0, dtype='float32')])
+    matches = face_identifier.identify_batch(queries, k=3, batch_size=2)
+    assert face_identifier.names(matches.label) == ['person0', 'person1', 'person2', None]
+    assert matches.votes.tolist() == [3, 3, 3, 0] and matches.matched.tolist()[-1] is False
+    ranges = face_identifier.identify_range(queries, batch_size=3)
+    assert ranges.counts.tolist() == [4, 4, 4, 0]
+    assert ranges.queries.tolist() == np.repeat(np.arange(3), 4).tolist()
+    assert face_identifier.names(ranges.labels) == [f"person{i // 4}" for i in range(12)]
+    assert all((np.diff(ranges.distances[ranges.lims[i]:ranges.lims[i + 1]]) >= 0).all()\
+               for i in range(4))
+    with pytest.raises(ValueError):
+        FaceIdentification(gallery=make_gallery(f"{tmp_path}/cosine", metric='cosine'))\
+            .identify_range(queries)
@@ -0,0 +1,30 @@
+"""Tests of the Lazy Imports of the Package"""
+# pylint: disable=E1101,E0401,C0413
+import sys
+import subprocess
+import pytest
+import facial_recognition
+
+def imported_modules(
+        code:str
+    ) -> set:
+    """Runs code in a fresh interpreter and gets the heavy modules it imported."""
+    check = "import sys; print(' '.join(m for m in ('mediapipe', 'dlib', 'faiss', 'cv2')"\
+            " if m in sys.modules))"
+    output = subprocess.run([sys.executable, '-c', f"{code}\n{check}"], capture_output=True,\
+                            text=True, check=True).stdout
+    return set(output.split())
+
+def test_importing_the_package_loads_no_heavy_module():
+    assert imported_modules("import facial_recognition") == set()
+    assert 'mediapipe' not in imported_modules("from facial_recognition import FaceIdentification")
+
+def test_every_public_name_resolves_and_models_load_on_first_use():
+    assert set(facial_recognition.__all__) <= set(dir(facial_recognition))
+    for name in facial_recognition.__all__:
+        assert getattr(facial_recognition, name) is not None
+    with pytest.raises(AttributeError):
+        facial_recognition.FaceRecognizer # pylint: disable=W0104
+    assert facial_recognition.FaceDetection()._detector is None # pylint: disable=W0212
+    assert facial_recognition.FaceAlignment()._predictor is None # pylint: disable=W0212
+    assert facial_recognition.FaceRepresentation()._recognizer is None # pylint: disable=W0212
@@ -0,0 +1,31 @@
+"""Tests of the Memory-mapped Key Table"""
+# pylint: disable=E1101,E0401,C0413
+import pytest
+from facial_recognition._keytable import KeyTable, write_key_table
+from facial_recognition._vectorlog import key_name
+
+def test_keys_labels_and_names_round_trip(tmp_path):
+    keys = ['/ana/0.jpg', 7, None, '/José/0.jpg', '/ana/1.jpg', 'bo']
+    write_key_table(keys, f"{tmp_path}/faces.keys", key_name)
+    table = KeyTable(f"{tmp_path}/faces.keys")
+    assert list(table) == keys and len(table) == 6 and table[-1] == 'bo'
+    assert table.labels.tolist() == [0, 1, -1, 2, 0, 3]
+    assert table.label_names == ['ana', '7', 'José', 'bo']
+
+def test_changes_are_kept_in_memory_over_the_mapped_keys(tmp_path):
+    write_key_table(['/ana/0.jpg', '/ana/1.jpg'], f"{tmp_path}/faces.keys", key_name)
+    table = KeyTable(f"{tmp_path}/faces.keys")
+    table[0] = None
+    table.extend(['/bo/0.jpg'])
+    table.append(3)
+    table[3] = None
+    assert list(table) == [None, '/ana/1.jpg', '/bo/0.jpg', None] and table.changed == {0: None}
+    with pytest.raises(IndexError):
+        table[4] # pylint: disable=W0104
+    assert list(KeyTable(f"{tmp_path}/faces.keys")) == ['/ana/0.jpg', '/ana/1.jpg']
+
+def test_other_files_are_rejected(tmp_path):
+    with open(f"{tmp_path}/faces.pkl", 'wb') as other_file:
+        other_file.write(b'\0' * 64)
+    with pytest.raises(ValueError):
+        KeyTable(f"{tmp_path}/faces.pkl")
@@ -0,0 +1,19 @@
+"""Tests of the Metadata Store"""
+# pylint: disable=E1101,E0401,C0413
+from facial_recognition._metadata import MetadataStore
+
+def test_deletion_written_before_the_enrollment_sticks(tmp_path):
+    store = MetadataStore(f"{tmp_path}/faces.sqlite")
+    store.add(0, ['/ana/0.jpg'])
+    # another process deleted rows whose enrollment it hadn't written to the store yet
+    store.delete('ana', [0, 1])
+    store.add(1, ['/ana/1.jpg'], [0.9], 1.0)
+    assert store.count('ana') == 0 and store.rows('ana') == [] and store.identities() == []
+
+def test_sync_fills_in_missing_rows_and_deletions(tmp_path):
+    store = MetadataStore(f"{tmp_path}/faces.sqlite")
+    store.add(0, ['/ana/0.jpg'])
+    store.sync(['/ana/0.jpg', '/bo/0.jpg', None], [2])
+    assert store.num_rows == 3 and store.identities() == [('ana', 1), ('bo', 1)]
+    store.sync(['/cy/0.jpg'], [])
+    assert store.identities() == [('cy', 1)]
@@ -0,0 +1,46 @@
+"""Tests of the Latency Instrumentation"""
+# pylint: disable=E1101,E0401,C0413
+from facial_recognition.metrics import Histogram, MetricsRegistry, REGISTRY, timed,\
+                                       server_timing
+
+def test_histogram_renders_cumulative_buckets_by_label():
+    histogram = Histogram('stage_seconds', "Seconds per stage.", ('stage',), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value, 'detect')
+    assert histogram.render() == [
+        '# HELP stage_seconds Seconds per stage.', '# TYPE stage_seconds histogram',
+        'stage_seconds_bucket{stage="detect",le="0.1"} 2',
+        'stage_seconds_bucket{stage="detect",le="1"} 3',
+        'stage_seconds_bucket{stage="detect",le="+Inf"} 4',
+        'stage_seconds_sum{stage="detect"} 2.65', 'stage_seconds_count{stage="detect"} 4']
+
+def test_registry_only_records_when_enabled_and_samples_callbacks():
+    registry = MetricsRegistry(enabled=False)
+    histogram = registry.histogram('request_seconds', "Seconds per request.")
+    registry.observe(histogram, 0.5)
+    assert not histogram.series and registry.histogram('request_seconds', "") is histogram
+    registry.enabled = True
+    registry.observe(histogram, 0.5)
+    registry.register('queue_depth', "Pending requests.", lambda: 3)
+    registry.register('cache_events_total', "Cache events.", lambda: {('hit',): 2, ('miss',): 1},\
+                      'counter', ('event',))
+    registry.register('unknown', "Not reported.", lambda: None)
+    rendered = registry.render()
+    assert 'queue_depth 3\n' in rendered and 'cache_events_total{event="miss"} 1\n' in rendered
+    assert '# TYPE cache_events_total counter' in rendered and 'unknown' not in rendered
+    assert 'request_seconds_count 1\n' in rendered
+
+def test_library_stages_are_timed_only_when_enabled(monkeypatch):
+    monkeypatch.setattr(REGISTRY.stages, 'series', {})
+    monkeypatch.setattr(REGISTRY, 'enabled', False)
+    with timed('search'):
+        pass
+    assert ('search',) not in REGISTRY.stages.series
+    monkeypatch.setattr(REGISTRY, 'enabled', True)
+    with timed('search'):
+        pass
+    assert sum(REGISTRY.stages.series[('search',)][:-1]) == 1
+
+def test_server_timing_lists_the_stages_and_the_total():
+    assert server_timing({'imdecode': 1.23456, 'represent': 8.5}, 10.0) ==\
+           'imdecode;dur=1.235, represent;dur=8.500, total;dur=10.000'
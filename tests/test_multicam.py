@@ -0,0 +1,85 @@
+"""Tests of the Multi-camera Recognition Service"""
+# pylint: disable=E1101,E0401,C0413
+import io
+import os
+import sys
+import json
+import threading
+from types import SimpleNamespace
+import numpy as np
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),\
+                                'scripts'))
+import multicam
+from multicam import FrameSource, FairScheduler
+
+def capture(
+        source:FrameSource,
+        value:int
+    ) -> None:
+    """Puts a frame in the latest-frame slot of a source, like its capture thread."""
+    with source.cond:
+        if source.frame is not None:
+            source.dropped += 1
+        source.frame = np.full((4, 4, 3), value, dtype='uint8')
+        source.seq += 1
+        source.cond.notify()
+
+def finish(
+        source:FrameSource
+    ) -> None:
+    """Marks a source as finished, like its capture thread."""
+    with source.cond:
+        source.finished = True
+        source.cond.notify_all()
+
+def test_sources_take_turns_with_one_frame_in_progress_each():
+    cond = threading.Condition()
+    first, second = FrameSource('first', cond), FrameSource('second', cond)
+    scheduler = FairScheduler([first, second], cond)
+    capture(first, 1)
+    capture(first, 2)
+    capture(second, 3)
+    assert first.dropped == 1
+    source, seq, frame, _ = scheduler.next()
+    assert source is first and seq == 2 and frame[0, 0, 0] == 2
+    capture(first, 4)
+    # the first source is busy, so the second one goes next
+    assert scheduler.next()[0] is second
+    scheduler.done(first, 0.5)
+    assert scheduler.next()[2][0, 0, 0] == 4
+    scheduler.done(first, 0.5)
+    scheduler.done(second, 0.5)
+    finish(first)
+    finish(second)
+    assert scheduler.next() is None and first.processed == 2 and list(first.latencies) == [0.5] * 2
+
+def test_worker_keeps_going_after_a_failed_frame(monkeypatch):
+    class FakePipeline:
+        """Fails on frames whose first pixel is 0."""
+        def __init__(self, **_kwargs) -> None:
+            pass
+
+        def process(self, frame):
+            """Finds no face."""
+            if frame[0, 0, 0] == 0:
+                raise ValueError("Bad frame")
+            return SimpleNamespace(faces=[], neighbors=[], distances=[])
+
+    for name in ('FaceAlignment', 'FaceRepresentation', 'FaceIdentification'):
+        monkeypatch.setattr(multicam, name, lambda **_kwargs: None)
+    monkeypatch.setattr(multicam, 'FacePipeline', FakePipeline)
+    cond = threading.Condition()
+    source = FrameSource('camera', cond)
+    scheduler = FairScheduler([source], cond)
+    output = io.StringIO()
+    worker = threading.Thread(target=multicam.recognition_worker,\
+                              args=(scheduler, output, threading.Lock()))
+    worker.start()
+    capture(source, 0)
+    with cond:
+        cond.wait_for(lambda: source.errors == 1 and not source.busy, timeout=5)
+    capture(source, 1)
+    finish(source)
+    worker.join(timeout=5)
+    assert not worker.is_alive() and source.errors == 1 and source.processed == 2
+    assert [json.loads(line)['seq'] for line in output.getvalue().splitlines()] == [2]
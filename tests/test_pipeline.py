@@ -0,0 +1,91 @@
+"""Tests of the Streaming Face Recognition Pipeline"""
+# pylint: disable=E1101,E0401,C0413
+import threading
+import dlib
+import numpy as np
+import pytest
+from facial_recognition.pipeline import FacePipeline
+
+class FakeDetector:
+    """Detects as many faces as the first pixel of the frame, modulo 3."""
+    def detect(
+            self,
+            img_rgb
+        ):
+        """Returns the faces."""
+        return [dlib.rectangle(0, 0, 10, 10)] * (int(img_rgb[0, 0, 0]) % 3)
+
+class FakeAligner:
+    """Aligns every face."""
+    def align_array(
+            self,
+            _img_rgb,
+            faces
+        ):
+        """Returns the faces and their landmarks."""
+        return faces, np.zeros((len(faces), 68, 2), dtype='int32')
+
+class FakeDescriptor:
+    """Describes every face by the first pixel of the frame."""
+    def represent(
+            self,
+            img_rgb,
+            landmarks
+        ):
+        """Returns the descriptors."""
+        return np.full((len(landmarks), 128), img_rgb[0, 0, 0], dtype='float32')
+
+class FakeIdentifier:
+    """Identifies every face by its descriptor, failing on frames whose first pixel is 13."""
+    def identify(
+            self,
+            descriptors,
+            k
+        ):
+        """Returns the distances and names of the neighbors."""
+        if descriptors[0, 0] == 13:
+            raise ValueError("Unknown face")
+        return [[0.0] * k for _ in descriptors], [[str(int(d[0]))] * k for d in descriptors]
+
+def make_pipeline(**kwargs) -> FacePipeline:
+    """Makes a pipeline of the fake stages."""
+    return FacePipeline(FakeDetector(), FakeAligner(), FakeDescriptor(), FakeIdentifier(),\
+                        color='rgb', **kwargs)
+
+def frames(
+        *values:int
+    ):
+    """Makes frames whose pixels are each value."""
+    return [np.full((4, 4, 3), value, dtype='uint8') for value in values]
+
+def test_stream_yields_every_frame_in_order_like_process():
+    pipeline = make_pipeline(drop_stale=False, queue_size=1)
+    results = list(pipeline.stream(frames(*range(1, 13))))
+    assert [result.index for result in results] == list(range(12))
+    for result, frame in zip(results, frames(*range(1, 13))):
+        expected = pipeline.process(frame)
+        assert result.neighbors == expected.neighbors and len(result.faces) == len(expected.faces)
+        assert set(result.timings) == {'detect', 'align', 'represent', 'identify'}
+
+def test_stream_raises_a_stage_error_after_the_results_before_it():
+    results = []
+    with pytest.raises(ValueError):
+        for result in make_pipeline(drop_stale=False).stream(frames(1, 2, 13, 4)):
+            results.append(result.index)
+    assert results == [0, 1]
+    assert not [thread for thread in threading.enumerate() if thread.name.startswith('pipeline')]
+
+def test_closing_the_stream_stops_every_thread():
+    def endless():
+        while True:
+            yield frames(1)[0]
+    stream = make_pipeline().stream(endless())
+    assert next(stream).neighbors == [['1']]
+    stream.close()
+    assert not [thread for thread in threading.enumerate() if thread.name.startswith('pipeline')]
+
+def test_stages_that_dont_run_load_no_model():
+    pipeline = FacePipeline(FakeDetector(), FakeAligner(), stages='align', color='rgb')
+    assert pipeline.face_descriptor is None and pipeline.face_identifier is None
+    result = pipeline.process(frames(2)[0])
+    assert result.landmarks.shape == (2, 68, 2) and result.descriptors is None
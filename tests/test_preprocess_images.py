@@ -0,0 +1,38 @@
+"""Tests of the Pre-process Image Script"""
+# pylint: disable=E1101,E0401,C0413
+import os
+import json
+import numpy as np
+from facial_recognition.gallery import FaceGallery
+from scripts.preprocess_images import load_manifest, list_images, commit_chunk
+
+def test_manifest_keeps_the_last_entry_of_each_image_and_skips_a_torn_line(tmp_path):
+    manifest_path = f"{tmp_path}/manifest.jsonl"
+    with open(manifest_path, 'w', encoding='utf-8') as manifest_file:
+        manifest_file.write(json.dumps({'path': 'ana/0.jpg', 'sha1': 'a'}) + '\n')
+        manifest_file.write(json.dumps({'path': 'ana/0.jpg', 'sha1': 'b'}) + '\n')
+        manifest_file.write('{"path": "bo/0.jp')
+    assert load_manifest(manifest_path) == {'ana/0.jpg': {'path': 'ana/0.jpg', 'sha1': 'b'}}
+    assert not load_manifest(f"{tmp_path}/missing.jsonl")
+
+def test_images_are_listed_relative_to_the_input_directory(tmp_path):
+    os.makedirs(f"{tmp_path}/ana")
+    for name in ('ana/1.JPG', 'ana/0.png', 'ana/notes.txt'):
+        with open(f"{tmp_path}/{name}", 'wb') as image_file:
+            image_file.write(b'1234')
+    images = list(list_images(str(tmp_path)))
+    assert [path for path, _, _ in images] == [os.path.join('ana', '0.png'),\
+                                               os.path.join('ana', '1.JPG')]
+    assert all(size == 4 for _, _, size in images)
+
+def test_a_modified_image_replaces_its_previous_embedding(tmp_path):
+    gallery = FaceGallery(db_path=f"{tmp_path}/faces.faiss", keys_path=f"{tmp_path}/faces.keys",\
+                          log_dir=f"{tmp_path}/faces.wal", metadata_path=None)
+    manifest_path = f"{tmp_path}/manifest.jsonl"
+    with open(manifest_path, 'a', encoding='utf-8') as manifest_file:
+        entry = {'path': 'ana/0.jpg', 'sha1': 'a', 'key': '/ana/0_face0.jpg'}
+        commit_chunk(gallery, manifest_file, [entry], [np.zeros(128)], [entry['key']], [1.0], [])
+        entry = {**entry, 'sha1': 'b'}
+        commit_chunk(gallery, manifest_file, [entry], [np.ones(128)], [entry['key']], [1.0],\
+                     [entry['key']])
+    assert gallery.rows('ana') == [1] and load_manifest(manifest_path)['ana/0.jpg']['sha1'] == 'b'
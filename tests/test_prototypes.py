@@ -0,0 +1,45 @@
+"""Tests of the Prototype Index"""
+# pylint: disable=E1101,E0401,C0413
+import numpy as np
+import pytest
+from facial_recognition.gallery import FaceGallery
+from facial_recognition.prototypes import PrototypeIndex
+
+def make_gallery(
+        work_dir:str,
+        index_type:str = 'flat'
+    ) -> FaceGallery:
+    """Makes a gallery of 50 identities of 5 faces clustered around their own center."""
+    rng = np.random.default_rng(0)
+    gallery = FaceGallery(db_path=f"{work_dir}/faces.faiss", keys_path=f"{work_dir}/faces.keys",\
+                          log_dir=f"{work_dir}/faces.wal", metadata_path=None,\
+                          index_type=index_type)
+    centers = rng.normal(size=(50, 128)).astype('float32')
+    embeddings = np.repeat(centers, 5, axis=0) + rng.normal(scale=0.05, size=(250, 128))
+    gallery.add(embeddings.astype('float32'),\
+                [f"/person{i // 5}/{i % 5}.jpg" for i in range(250)])
+    if index_type != 'flat':
+        gallery.compact(block=True)
+    return gallery
+
+@pytest.mark.parametrize('index_type', ['flat', 'hnsw', 'ivf'])
+def test_reranked_search_matches_the_gallery_search(tmp_path, index_type):
+    gallery = make_gallery(str(tmp_path), index_type)
+    prototypes = PrototypeIndex(gallery, candidates=2)
+    assert not any(isinstance(rows, tuple) for rows in prototypes.members.values())
+    # more queries than are re-ranked at a time
+    queries = np.repeat(gallery.vectordb.reconstruct_n(0, 250)[::7], 3, axis=0) + 0.01
+    distances, rows = prototypes.search(queries, k=3)
+    expected_distances, expected_rows = gallery.search(queries, k=3)
+    np.testing.assert_array_equal(rows, expected_rows)
+    np.testing.assert_allclose(distances, expected_distances, rtol=1e-4)
+
+def test_prototypes_follow_enrollments_and_deletes(tmp_path):
+    gallery = make_gallery(str(tmp_path))
+    prototypes = PrototypeIndex(gallery)
+    gallery.delete('person0')
+    new_face = np.full((1, 128), 10.0, dtype='float32')
+    gallery.add(new_face, ['/newcomer/0.jpg'])
+    assert prototypes.num_prototypes == 50
+    _, rows = prototypes.search(new_face, k=6)
+    assert gallery.get_name(rows[0, 0]) == 'newcomer' and (rows[0, 1:] >= 5).all()
@@ -0,0 +1,59 @@
+"""Tests of the Face Representation"""
+# pylint: disable=E1101,E0401,C0413
+from typing import List
+import numpy as np
+from facial_recognition.represent import FaceRepresentation
+from facial_recognition._utils import landmarks_to_dlib
+
+class FakeRecognizer:
+    """Recognizer returning the x of the first landmark of each face, recording its calls."""
+    def __init__(self) -> None:
+        self.calls:List[int] = []
+
+    def compute_face_descriptor(
+            self,
+            imgs,
+            faces,
+            num_jitters:int = 0
+        ) -> List:
+        """Computes the descriptors of the faces of an image, or of each image of a batch."""
+        assert num_jitters == 1
+        if isinstance(imgs, list):
+            self.calls.append(len(imgs))
+            return [self.compute_face_descriptor(img, img_faces, num_jitters)\
+                    for img, img_faces in zip(imgs, faces)]
+        self.calls.append(1)
+        return [[float(face.part(0).x)] * 128 for face in faces]
+
+def make_representation() -> FaceRepresentation:
+    """Makes a representation with the fake recognizer (and no gallery)."""
+    face_descriptor = FaceRepresentation()
+    face_descriptor._recognizer = FakeRecognizer() # pylint: disable=W0212
+    return face_descriptor
+
+def landmarks_at(
+        *xs:int
+    ) -> np.ndarray:
+    """Makes the (n_faces, 68, 2) landmarks of faces whose first point is at each x."""
+    landmarks = np.tile(np.arange(68)[None, :, None], (len(xs), 1, 2))
+    landmarks[:, 0, 0] = xs
+    return landmarks
+
+def test_faces_of_an_image_are_described_in_one_call():
+    face_descriptor = make_representation()
+    img = np.zeros((100, 100, 3), dtype='uint8')
+    descriptors = face_descriptor.represent(img, landmarks_at(3, 5, 7))
+    assert descriptors.dtype == np.float32 and descriptors.shape == (3, 128)
+    assert descriptors[:, 0].tolist() == [3, 5, 7]
+    assert face_descriptor.represent(img, []).shape == (0, 128)
+    assert face_descriptor.recognizer.calls == [1]
+
+def test_faces_of_a_batch_are_described_in_one_call_in_order():
+    face_descriptor = make_representation()
+    img = np.zeros((100, 100, 3), dtype='uint8')
+    landmarks = [landmarks_to_dlib(landmarks_at(*xs)) for xs in [(1, 2), (), (3,)]]
+    descriptors = face_descriptor.represent_batch([img, img, img], landmarks)
+    assert descriptors.shape == (3, 128) and descriptors[:, 0].tolist() == [1, 2, 3]
+    assert face_descriptor.represent_batch([img], [[]]).shape == (0, 128)
+    # the image without faces isn't sent to the recognizer
+    assert face_descriptor.recognizer.calls[0] == 2
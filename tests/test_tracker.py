@@ -0,0 +1,82 @@
+"""Tests of the Face Tracker"""
+# pylint: disable=E1101,E0401,C0413
+from types import SimpleNamespace
+import cv2
+import dlib
+import numpy as np
+from facial_recognition.tracker import FaceTracker
+
+class FakeDetector:
+    """Detects the same faces in every frame."""
+    def __init__(
+            self,
+            faces
+        ) -> None:
+        self.faces = faces
+
+    def detect(
+            self,
+            _img_rgb
+        ):
+        """Returns the faces."""
+        return list(self.faces)
+
+class FakeAligner:
+    """Aligns a grid of landmarks inside each face, counting the keyframes."""
+    def __init__(self) -> None:
+        self.calls = 0
+
+    def align_array(
+            self,
+            _img_rgb,
+            faces
+        ):
+        """Returns the faces and their landmarks."""
+        self.calls += 1
+        grid = np.array([[10 + (i % 9) * 7, 10 + (i // 9) * 7] for i in range(68)])
+        return faces, np.array([grid + [face.left(), face.top()] for face in faces])
+
+class FakeMesh:
+    """Finds a mesh (in normalized coordinates) around each of the given centers."""
+    def __init__(
+            self,
+            centers
+        ) -> None:
+        rng = np.random.default_rng(0)
+        self.meshes = [rng.random((478, 2)) * 0.2 + center for center in centers]
+
+    def process(
+            self,
+            _img_rgb
+        ):
+        """Returns the meshes, like MediaPipe, up to `max_num_faces`."""
+        faces = [SimpleNamespace(landmark=[SimpleNamespace(x=x, y=y) for x, y in mesh])\
+                 for mesh in self.meshes]
+        return SimpleNamespace(multi_face_landmarks=faces[:self.max_num_faces])
+
+def test_keyframe_with_two_faces_gives_two_tracks():
+    faces = [dlib.rectangle(40, 40, 120, 120), dlib.rectangle(240, 240, 320, 320)]
+    tracker = FaceTracker(face_detector=FakeDetector(faces))
+    mesh = FakeMesh([(0.1, 0.1), (0.6, 0.6)])
+    mesh.max_num_faces = tracker.landmark_predictor.max_num_faces
+    tracker.landmark_predictor._predictor = mesh  # pylint: disable=W0212
+    tracks = tracker.track(np.zeros((400, 400, 3), dtype='uint8'))
+    assert [track.face for track in tracks] == faces
+    assert len({track.track_id for track in tracks}) == 2
+
+def test_faces_are_followed_between_keyframes_and_keep_their_track():
+    rng = np.random.default_rng(0)
+    texture = cv2.GaussianBlur(rng.integers(0, 255, (240, 320), dtype=np.uint8), (5, 5), 2)
+    detector, aligner = FakeDetector([]), FakeAligner()
+    tracker = FaceTracker(face_detector=detector, landmark_predictor=aligner, keyframe_every=4)
+    for i in range(5):
+        detector.faces = [dlib.rectangle(100 + 2 * i, 80, 180 + 2 * i, 160)]
+        frame = np.repeat(np.roll(texture, 2 * i, axis=1)[:, :, None], 3, axis=2)
+        tracks = tracker.track(frame)
+        if i == 0:
+            tracks[0].name = 'ana'
+        elif i < 4:
+            # followed by optical flow, without detecting or aligning
+            assert not tracks[0].fresh and abs(tracks[0].box[0] - (100 + 2 * i)) < 1
+    assert aligner.calls == 2 and tracks[0].fresh
+    assert len(tracks) == 1 and tracks[0].track_id == 0 and tracks[0].name == 'ana'
@@ -0,0 +1,36 @@
+"""Tests of the Utility Functions"""
+# pylint: disable=E1101,E0401,C0413
+import dlib
+import numpy as np
+import pytest
+from facial_recognition._utils import rect_iou, match_rectangles, landmarks_to_dlib,\
+                                      landmarks_from_dlib, crop_box
+
+def test_rectangles_are_matched_greedily_by_overlap():
+    a = [dlib.rectangle(0, 0, 10, 10), dlib.rectangle(20, 0, 30, 10)]
+    b = [dlib.rectangle(21, 0, 31, 10), dlib.rectangle(2, 0, 12, 10),\
+         dlib.rectangle(50, 50, 60, 60)]
+    assert rect_iou(a[0], a[0]) == 1.0 and rect_iou(a[0], b[2]) == 0.0
+    assert rect_iou(a[0], b[1]) == pytest.approx(99 / 143)
+    assert sorted(match_rectangles(a, b)) == [(0, 1), (1, 0)]
+    assert match_rectangles(a, b, min_iou=0.7) == [(1, 0)]
+    # rectangles sharing an edge overlap by that edge
+    assert rect_iou(a[0], dlib.rectangle(10, 0, 20, 10)) == pytest.approx(11 / 231)
+    assert match_rectangles([], b) == []
+
+def test_landmarks_round_trip_through_dlib_shapes():
+    landmarks = np.array([[[1, 2], [5, 9], [3, 4]], [[10, 20], [14, 28], [12.4, 22.6]]])
+    shapes = landmarks_to_dlib(landmarks)
+    # the rectangle defaults to the bounding box of the landmarks
+    assert [shape.rect for shape in shapes] == [dlib.rectangle(1, 2, 5, 9),\
+                                                dlib.rectangle(10, 20, 14, 28)]
+    converted = landmarks_from_dlib(shapes)
+    assert converted.dtype == np.int32 and converted.tolist() == np.rint(landmarks).tolist()
+    face = dlib.rectangle(0, 0, 30, 30)
+    assert landmarks_to_dlib(landmarks[:1], [face])[0].rect == face
+    assert landmarks_to_dlib(np.empty((0, 68, 2))) == []
+    assert landmarks_from_dlib([]).shape == (0, 0, 2)
+
+def test_crop_box_is_a_padded_square_clipped_to_the_image():
+    assert crop_box(dlib.rectangle(100, 100, 199, 199), (1000, 1000)) == (82, 82, 217, 217)
+    assert crop_box(dlib.rectangle(0, 900, 99, 999), (1000, 800)) == (0, 883, 134, 1000)
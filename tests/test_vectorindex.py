@@ -0,0 +1,44 @@
+"""Tests of the Vector DB Index Factory"""
+# pylint: disable=E1101,E0401,C0413
+import numpy as np
+import pytest
+from facial_recognition._vectorindex import INDEX_TYPES, build_index, index_type_of,\
+                                            index_factory_string, ivf_nlist, reconstruct_all
+from facial_recognition.gallery import FaceGallery
+
+@pytest.mark.parametrize('index_type', INDEX_TYPES)
+@pytest.mark.parametrize('metric', ['euclidean', 'cosine'])
+def test_built_index_finds_its_own_embeddings(index_type, metric):
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(1000, 128)).astype('float32')
+    index = build_index(index_type, metric, embeddings)
+    assert index_type_of(index) == index_type and index.ntotal == 1000
+    assert reconstruct_all(index).shape == (1000, 128)
+    if index_type != 'ivfpq':
+        # reconstructed by row (IVF indexes have a direct map)
+        np.testing.assert_allclose(index.reconstruct(7), embeddings[7], rtol=1e-5)
+    if index_type in ('ivf', 'ivfpq'):
+        index.nprobe = index.nlist
+    _, rows = index.search(embeddings[:50], 1)
+    assert (rows[:, 0] == np.arange(50)).mean() >= (0.9 if index_type == 'ivfpq' else 1.0)
+
+def test_ivf_lists_have_enough_training_points():
+    assert ivf_nlist(1) == 1 and ivf_nlist(1000) == 1000 // 39
+    assert ivf_nlist(1_000_000) == 4000
+    assert index_factory_string('ivfpq', 100, 10_000) == 'IVF256,PQ8x8'
+    with pytest.raises(ValueError):
+        index_factory_string('lsh', 128, 1000)
+
+@pytest.mark.parametrize('index_type', ['ivf', 'hnsw', 'ivfpq'])
+def test_gallery_stays_flat_until_it_can_train_its_index(tmp_path, index_type):
+    gallery = FaceGallery(db_path=f"{tmp_path}/faces.faiss", keys_path=f"{tmp_path}/faces.keys",\
+                          log_dir=f"{tmp_path}/faces.wal", metadata_path=None,\
+                          index_type=index_type)
+    gallery.add(np.random.rand(10, 128).astype('float32'), [f"/ana/{i}.jpg" for i in range(10)])
+    assert index_type_of(gallery.vectordb) == 'flat'
+    gallery.add(np.random.rand(300, 128).astype('float32'), [f"/bo/{i}.jpg" for i in range(300)])
+    gallery.compact(block=True)
+    assert index_type_of(gallery.vectordb) == index_type
+    assert gallery.delete('ana') == 10
+    _, rows = gallery.search(gallery.vectordb.reconstruct_n(0, 10), 5, nprobe=64, ef_search=64)
+    assert (rows >= 10).all()
@@ -0,0 +1,75 @@
+"""Tests of the Append-only Vector DB Log"""
+# pylint: disable=E1101,E0401,C0413
+import os
+import numpy as np
+import pytest
+from facial_recognition._vectorlog import VectorLog, SegmentRemoved, RECORD_OP_DELETE,\
+                                          RECORD_HEADER
+
+DIMENSIONS = 4
+
+def embeddings(
+        n:int,
+        value:float = 0.0
+    ) -> np.ndarray:
+    """Makes n distinct embeddings."""
+    return (np.arange(n * DIMENSIONS, dtype='float32').reshape(n, DIMENSIONS) + value)
+
+def test_replay_returns_records_in_order(tmp_path):
+    log = VectorLog(str(tmp_path))
+    log.append(0, embeddings(2), ['/ana/0.jpg', '/ana/1.jpg'])
+    log.append(2, np.empty((0, DIMENSIONS), 'float32'), ['ana'], op=RECORD_OP_DELETE)
+    log.append(2, embeddings(1, 10), ['/bo/0.jpg'])
+    log.close()
+    records = list(VectorLog(str(tmp_path)).replay())
+    assert [(op, start, ids) for op, start, _, ids in records] ==\
+           [(b'A', 0, ['/ana/0.jpg', '/ana/1.jpg']), (b'D', 2, ['ana']), (b'A', 2, ['/bo/0.jpg'])]
+    np.testing.assert_array_equal(records[2][2], embeddings(1, 10))
+
+@pytest.mark.parametrize('damage', ['torn', 'crc'])
+def test_replay_stops_at_bad_record_and_repairs(tmp_path, damage):
+    log = VectorLog(str(tmp_path))
+    log.append(0, embeddings(1), ['/ana/0.jpg'])
+    good_size = os.path.getsize(log.segments()[0])
+    log.append(1, embeddings(1, 5), ['/bo/0.jpg'])
+    log.close()
+    path = log.segments()[0]
+    with open(path, 'r+b') as segment:
+        if damage == 'torn':
+            segment.truncate(os.path.getsize(path) - 3)
+        else:
+            segment.seek(good_size + RECORD_HEADER.size)
+            segment.write(b'\xff\xff\xff\xff')
+    assert [ids for *_, ids in VectorLog(str(tmp_path)).replay()] == [['/ana/0.jpg']]
+    assert os.path.getsize(path) > good_size
+    assert len(list(VectorLog(str(tmp_path)).replay(repair=True))) == 1
+    assert os.path.getsize(path) == good_size
+
+def test_rotate_seals_segments_and_new_records_go_to_a_fresh_one(tmp_path):
+    log = VectorLog(str(tmp_path))
+    log.append(0, embeddings(1), ['/ana/0.jpg'])
+    sealed = log.rotate()
+    assert len(sealed) == 1 and len(log.segments()) == 2
+    log.append(1, embeddings(1), ['/bo/0.jpg'])
+    log.remove(sealed)
+    assert [ids for *_, ids in VectorLog(str(tmp_path)).replay()] == [['/bo/0.jpg']]
+
+def test_writers_switch_to_the_segment_rotated_by_another(tmp_path):
+    first, second = VectorLog(str(tmp_path)), VectorLog(str(tmp_path))
+    first.append(0, embeddings(1), ['/ana/0.jpg'])
+    with second.lock:
+        assert [ids for *_, ids in second.read_new()] == [['/ana/0.jpg']]
+        sealed = second.rotate()
+    with first.lock:
+        assert not first.read_new()
+        first.append(1, embeddings(1), ['/bo/0.jpg'])
+    second.remove(sealed)
+    assert [ids for *_, ids in VectorLog(str(tmp_path)).replay()] == [['/bo/0.jpg']]
+
+def test_read_new_detects_removed_segments(tmp_path):
+    first, second = VectorLog(str(tmp_path)), VectorLog(str(tmp_path))
+    list(first.replay())
+    second.append(0, embeddings(1), ['/ana/0.jpg'])
+    second.remove(second.rotate())
+    with first.lock, pytest.raises(SegmentRemoved):
+        first.read_new()
@@ -0,0 +1,32 @@
+"""Tests of the Recognition Worker Pool"""
+# pylint: disable=E1101,E0401,C0413
+import time
+import asyncio
+import threading
+import pytest
+from webapp.workers import RecognitionPool, PoolSaturated
+
+def test_pool_runs_off_the_event_loop_and_bounds_pending_work():
+    pool = RecognitionPool(backend='thread', workers=1, max_pending=2)
+    release = threading.Event()
+
+    async def main():
+        first = asyncio.ensure_future(pool.run(release.wait))
+        second = asyncio.ensure_future(pool.run(time.sleep, 0))
+        await asyncio.sleep(0.05)
+        # the event loop keeps running while the worker is blocked
+        assert pool.pending == 2 and not first.done()
+        with pytest.raises(PoolSaturated):
+            await pool.run(time.sleep, 0)
+        release.set()
+        assert await first and await second is None
+        assert pool.pending == 0
+
+    try:
+        asyncio.run(main())
+    finally:
+        pool.shutdown()
+
+def test_unknown_backend_is_rejected():
+    with pytest.raises(ValueError):
+        RecognitionPool(backend='fiber')
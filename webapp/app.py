@@ -1,28 +1,121 @@
 """Fast API Front End & Back Ends"""
 # pylint: disable=E1101,C0413,W0718
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Tuple, Union, AsyncIterator, Set
 import os
 import sys
-import base64
-import cv2
+import json
+import time
+import struct
+import asyncio
+from contextlib import asynccontextmanager
 import numpy as np
-from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, Request, Response, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import HTMLResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.templating import _TemplateResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 import uvicorn
 sys.path.append("../")
 par_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(1, par_dir)
-from facial_recognition import FaceRepresentation, FaceIdentification
+from facial_recognition import FaceRepresentation, FaceIdentification, FaceGallery,\
+                               PrototypeIndex
+from facial_recognition.cache import ResultCache
+from facial_recognition.metrics import REGISTRY, server_timing
+from webapp.workers import RecognitionPool, PoolSaturated
 
-# Initialize FastAPI and Facial Recognition Classes
-app = FastAPI()
-face_descriptor = FaceRepresentation()
-face_identifier = FaceIdentification()
+# Whether to identify faces in two stages, against per-identity centroids first
+IDENTIFY_PROTOTYPES = os.environ.get('IDENTIFY_PROTOTYPES', '0') == '1'
+
+@asynccontextmanager
+async def lifespan(
+        _:FastAPI
+    ) -> AsyncIterator[None]:
+    """Shuts the worker pool down and compacts the Vector DB log when the server stops."""
+    yield
+    recognition_pool.shutdown()
+    face_descriptor.compact(block=True)
+
+# Initialize FastAPI and Facial Recognition Classes (sharing one in-memory gallery)
+app = FastAPI(lifespan=lifespan)
+face_gallery = FaceGallery()
+face_descriptor = FaceRepresentation(gallery=face_gallery)
+face_identifier = FaceIdentification(gallery=face_gallery,\
+                                     prototypes=PrototypeIndex(face_gallery)\
+                                                if IDENTIFY_PROTOTYPES else None)
+
+# Worker pool for decoding frames and computing descriptors (see `webapp/workers.py` for the
+# RECOGNITION_BACKEND, RECOGNITION_WORKERS and RECOGNITION_MAX_PENDING environment variables)
+recognition_pool = RecognitionPool(gallery=face_gallery)
+
+# Maximum number of faces that can be enrolled per name
+MAX_FACES_PER_NAME = 10
+
+# Maximum number of images in a batch request, number of images described per task of the worker
+# pool (in a single call to the recognizer, and searched at once), and seconds to wait before
+# submitting a chunk again when the pool is saturated
+BATCH_MAX_ITEMS = 1024
+BATCH_CHUNK_SIZE = 32
+BATCH_RETRY_DELAY = 0.05
+
+# Header of the binary messages of a recognition session: the length of the JSON metadata that
+# follows it (the encoded face crop comes after the metadata)
+SESSION_HEADER = struct.Struct('>I')
+
+# Seconds for which the last result of a face track, or of a near-duplicate face (same perceptual
+# hash), is reused instead of recomputing it (and returned instead of a 429 when the worker pool is
+# saturated)
+TRACK_RESULT_TTL = 1.0
+HASH_RESULT_TTL = 5.0
+result_cache = ResultCache(ttl=TRACK_RESULT_TTL)
+
+def invalidate_results(
+        _event:str,
+        _names:List[str]
+    ) -> None:
+    """Invalidates every cached result after a change of the gallery: a face enrolled under one
+       name can become the closest match of faces cached as another name (or as no match)."""
+    result_cache.clear()
+
+face_gallery.subscribe(invalidate_results)
+
+# Metrics (only recorded with RECOGNITION_METRICS=1): the histograms of the requests and of the
+# stages of each request (measured in the workers, so they also cover the process backend), and
+# the gauges and counters the gallery, caches and pool already keep, sampled on each scrape
+request_histogram = REGISTRY.histogram('webapp_request_seconds', "Seconds to answer a"
+                                       " recognition request.", ('endpoint', 'result'))
+stage_histogram = REGISTRY.histogram('webapp_stage_seconds', "Seconds spent in each stage of"
+                                     " a recognition request.", ('stage',))
+REGISTRY.register('gallery_records', "Embeddings in the gallery (including deleted ones).",\
+                  lambda: face_gallery.num_records)
+REGISTRY.register('gallery_identities', "Identities with embeddings in the gallery.",\
+                  lambda: face_gallery.num_identities)
+REGISTRY.register('recognition_pool_pending', "Requests queued or running in the worker pool.",\
+                  lambda: recognition_pool.pending)
+REGISTRY.register('recognition_sessions', "Open WebSocket recognition sessions.",\
+                  lambda: len(sessions))
+REGISTRY.register('recognition_session_frames_total', "Frames received by the WebSocket"
+                  " recognition sessions, by outcome.",\
+                  lambda: {(outcome,): count for outcome, count in session_frames.items()},\
+                  'counter', ('outcome',))
+REGISTRY.register('recognition_pool_max_pending', "Requests the worker pool accepts at a time.",\
+                  lambda: recognition_pool.max_pending)
+
+def cache_counters() -> Dict[Tuple[str,str],float]:
+    """Gets the counters of the result and descriptor caches by cache and event."""
+    counters = {}
+    for cache, stats in (('results', result_cache.stats()),\
+                         ('descriptors', recognition_pool.descriptor_cache_stats())):
+        for event, count in (stats or {}).items():
+            if event != 'size':
+                counters[(cache, event)] = count
+    return counters
+
+REGISTRY.register('recognition_cache_events_total', "Hits, misses, evictions and invalidations"
+                  " of the caches.", cache_counters, 'counter', ('cache', 'event'))
 
 # CORS breaker
 origins = ['*']
@@ -47,6 +140,328 @@ class VerifyPacket(BaseModel):
     bb:List[int]
     landmarks:List[List[int]]
     name:Optional[str] = None
+    track_id:Optional[str] = None
+
+class CropPacket(BaseModel):
+    """Model for Verification Metadata sent along a Face Crop (coordinates relative to the crop)"""
+    bb:List[int]
+    landmarks:List[List[int]]
+    name:Optional[str] = None
+    track_id:Optional[str] = None
+
+class SessionPacket(CropPacket):
+    """Model for the Metadata of a Face Crop sent through a Recognition Session"""
+    seq:int
+
+class RecognitionSession:
+    """Class for a WebSocket Recognition Session of a Client
+
+    Face crops stream in tagged with sequence numbers, and results stream back tagged with the
+    sequence number of their frame. Only the latest crop of each face track is kept pending: when
+    the server falls behind, a crop superseded by a newer one of the same track before it was
+    processed is dropped (and reported as such), so a slow session never lags behind real time.
+    Each track has at most one crop being processed at a time.
+    """
+    def __init__(
+            self,
+            websocket:WebSocket
+        ) -> None:
+        self.websocket = websocket
+        self.send_lock = asyncio.Lock()
+        # track ID -> latest (sequence number, packet, crop) not processed yet
+        self.pending:Dict[Optional[str],Tuple[int, SessionPacket, bytes]] = {}
+        self.tasks:Dict[Optional[str],asyncio.Task] = {}
+
+    async def send(
+            self,
+            data:Dict
+        ) -> None:
+        """Sends an event to the client (one at a time)."""
+        async with self.send_lock:
+            await self.websocket.send_json(data)
+
+    async def submit(
+            self,
+            packet:SessionPacket,
+            crop_bin:bytes
+        ) -> None:
+        """Queues a crop as the latest of its track, dropping the one it supersedes.
+
+        Args:
+            packet (SessionPacket): The metadata of the crop.
+            crop_bin (bytes): The encoded face crop.
+
+        Returns:
+            None
+        """
+        key = packet.track_id
+        superseded = self.pending.pop(key, None)
+        self.pending[key] = (packet.seq, packet, crop_bin)
+        session_frames['received'] += 1
+        if key not in self.tasks:
+            self.tasks[key] = asyncio.ensure_future(self._process(key))
+        if superseded is not None:
+            session_frames['dropped'] += 1
+            await self.send({"seq": superseded[0], "trackId": key, "dropped": True})
+
+    async def _process(
+            self,
+            key:Optional[str]
+        ) -> None:
+        """Recognizes the latest crop of a track until none is pending."""
+        try:
+            while key in self.pending:
+                seq, packet, crop_bin = self.pending.pop(key)
+                try:
+                    result = await recognize(lambda: recognition_pool.describe_crop(crop_bin,\
+                                                        packet.bb, packet.landmarks,\
+                                                        packet.name is None), packet, "session")
+                except HTTPException as exc:
+                    result = {"error": exc.detail, "status": exc.status_code,\
+                              "trackId": packet.track_id}
+                await self.send({"seq": seq, **result})
+        finally:
+            del self.tasks[key]
+
+    def close(self) -> None:
+        """Cancels the recognitions in progress.
+
+        Returns:
+            None
+        """
+        self.pending.clear()
+        for task in list(self.tasks.values()):
+            task.cancel()
+
+sessions:Set[RecognitionSession] = set()
+session_frames = {'received': 0, 'dropped': 0}
+
+class BatchItem(BaseModel):
+    """Model for the Metadata of an Image of a Batch (the face is found on the server when the
+       landmarks are left out, and coordinates are relative to the image)"""
+    id:Optional[str] = None
+    name:Optional[str] = None
+    bb:Optional[List[int]] = None
+    landmarks:Optional[List[List[int]]] = None
+
+def match_face(
+        descriptors:np.ndarray,
+        name:Optional[str] = None
+    ) -> Tuple[Dict, Dict[str,float]]:
+    """Enrolls or identifies a face given its descriptor (runs in the thread pool).
+
+    Args:
+        descriptors (np.ndarray): The (1, dimensions) descriptor of the face.
+        name (Optional[str]): The name to enroll the face under. Defaults to None (identify).
+
+    Returns:
+        Tuple[Dict, Dict[str,float]]: The response and the time spent in each stage (in
+                                      milliseconds).
+    """
+    timings = {}
+    if name is not None:
+        # the count and the enrollment are a single write of the gallery, so concurrent
+        # enrollments of a name can't both pass MAX_FACES_PER_NAME
+        stage_start = time.perf_counter()
+        added = face_descriptor.add_to_vectordb(descriptors, ids=[name],\
+                                                max_per_name=MAX_FACES_PER_NAME)
+        timings['add_to_vectordb'] = (time.perf_counter() - stage_start) * 1000
+        if added.all():
+            return {
+                "message":f"Added `{name}` to the Vector DB"
+            }, timings
+        name = None
+
+    stage_start = time.perf_counter()
+    best_distances, best_neighbors = face_identifier.identify(descriptors, k=1)
+    timings['identify'] = (time.perf_counter() - stage_start) * 1000
+    if best_neighbors:
+        return match_result(best_neighbors[0], best_distances[0], name), timings
+    return match_result([], [], name), timings
+
+def match_result(
+        neighbors:List[str],
+        distances:List[float],
+        name:Optional[str] = None
+    ) -> Dict:
+    """Formats the identification of a face.
+
+    Args:
+        neighbors (List[str]): The names of the nearest neighbors within tolerance.
+        distances (List[float]): Their distances.
+        name (Optional[str]): The name that was provided. Defaults to None.
+
+    Returns:
+        Dict: The name and distance of the nearest neighbor ("nomatch" without any).
+    """
+    if neighbors:
+        return {
+                "name": neighbors[0],
+                "distance": round(distances[0]*10000)/10000,
+                "displayName": f"{neighbors[0]} {distances[0]:.3f}",
+                "nameProvided": name
+            }
+    return {
+        "name":"nomatch",
+        "distance":300,
+        "displayName": "NO MATCH",
+        "nameProvided": name
+    }
+
+def get_cached_result(
+        key:Optional[str],
+        stale:bool = False
+    ) -> Optional[Dict]:
+    """Gets the recent result of a face track or perceptual hash.
+
+    Args:
+        key (Optional[str]): The cache key (`track:<track ID>` or `hash:<hash>`).
+        stale (bool): Whether to return the result even if it has expired. Defaults to False.
+
+    Returns:
+        Optional[Dict]: The result (None if there's none recent enough).
+    """
+    if key is None:
+        return None
+    result = result_cache.get(key, stale=stale)
+    if result is None:
+        return None
+    return {**result, "cached": True}
+
+def set_cached_result(
+        keys:List[Optional[str]],
+        result:Dict
+    ) -> None:
+    """Caches the result of an identification under the face track and perceptual hash keys
+       (until it expires or the gallery changes).
+
+    Args:
+        keys (List[Optional[str]]): The cache keys (`track:<track ID>`, `hash:<hash>` or None).
+        result (Dict): The result of the identification.
+
+    Returns:
+        None
+    """
+    if "displayName" not in result:
+        return
+    for key in keys:
+        if key is not None:
+            ttl = HASH_RESULT_TTL if key.startswith("hash:") else TRACK_RESULT_TTL
+            result_cache.set(key, result, ttl=ttl)
+
+async def recognize(
+        describe,
+        packet:BaseModel,
+        endpoint:str,
+        response:Optional[Response] = None
+    ) -> Dict:
+    """Recognizes the face of a packet (see `_recognize`), recording the time spent in each
+       stage in the metrics and in the `Server-Timing` header of the response when the metrics
+       are on.
+
+    Args:
+        describe: The coroutine function of the pool that computes the descriptor, with its
+                  arguments bound.
+        packet (BaseModel): The packet (`VerifyPacket` or `CropPacket`).
+        endpoint (str): The name of the endpoint, for the metrics.
+        response (Optional[Response]): The response to add the header to. Defaults to None.
+
+    Returns:
+        Dict: The result of the identification or enrollment.
+    """
+    if not REGISTRY.enabled:
+        return await _recognize(describe, packet)
+    request_start = time.perf_counter()
+    result = await _recognize(describe, packet)
+    total = time.perf_counter() - request_start
+    if "error" in result:
+        outcome, timings = "error", {}
+    elif result.get("cached"):
+        # the timings are those of the request the result was computed for
+        outcome, timings = "cached", {}
+    else:
+        outcome, timings = "computed", result.get("timings", {})
+    for stage, ms in timings.items():
+        stage_histogram.observe(ms / 1000, stage)
+    request_histogram.observe(total, endpoint, outcome)
+    if response is not None:
+        response.headers['Server-Timing'] = server_timing(timings, total * 1000)
+    return result
+
+async def _recognize(
+        describe,
+        packet:BaseModel
+    ) -> Dict:
+    """Runs the descriptor stage in the worker pool and the identification or enrollment in the
+       thread pool, reusing the recent result of the packet's face track, or of a near-duplicate
+       face, when there is one.
+
+    Args:
+        describe: The coroutine function of the pool that computes the descriptor, with its
+                  arguments bound.
+        packet (BaseModel): The packet (`VerifyPacket` or `CropPacket`).
+
+    Returns:
+        Dict: The result of the identification or enrollment.
+    """
+    track_key = f"track:{packet.track_id}" if packet.track_id is not None else None
+    if packet.name is None:
+        result = get_cached_result(track_key)
+        if result is not None:
+            return {**result, "trackId": packet.track_id}
+    try:
+        descriptors, timings, face_key = await describe()
+    except PoolSaturated as exc:
+        result = get_cached_result(track_key, stale=True)
+        if result is not None:
+            return {**result, "trackId": packet.track_id}
+        raise HTTPException(status_code=429, detail=f"Too many requests: {exc}") from exc
+    except Exception as exc:
+        return {"error": f"There was an error uploading the frame {exc}"}
+    # enrollments never reuse the descriptor or result of another face
+    hash_key = f"hash:{face_key}" if face_key is not None else None
+    if packet.name is None:
+        result = get_cached_result(hash_key)
+        if result is not None:
+            result["trackId"] = packet.track_id
+            set_cached_result([track_key], result)
+            return result
+    result, match_timings = await run_in_threadpool(match_face, descriptors, packet.name)
+    timings.update(match_timings)
+    result["timings"] = {stage: round(ms, 3) for stage, ms in timings.items()}
+    result["trackId"] = packet.track_id
+    set_cached_result([track_key, hash_key], result)
+    return result
+
+@app.get("/cache/stats")
+async def cache_stats() -> Dict:
+    """Get the hit/miss counters of the result and descriptor caches.
+
+    Returns:
+        dict: The hits, misses, evictions, invalidations and size of the result cache ("results")
+              and of the descriptor cache ("descriptors", only with the thread backend, as each
+              worker process has its own).
+    """
+    return {
+        "results": result_cache.stats(),
+        "descriptors": recognition_pool.descriptor_cache_stats()
+    }
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics() -> PlainTextResponse:
+    """Get the metrics in the Prometheus text format: the histograms of the requests, of their
+       stages and of the library stages (search, disk writes...), and the gallery size, caches
+       counters and worker pool queue depth.
+
+    Returns:
+        PlainTextResponse: The metrics.
+
+    Raises:
+        HTTPException: With status 404 if the metrics are off (RECOGNITION_METRICS isn't 1).
+    """
+    if not REGISTRY.enabled:
+        raise HTTPException(status_code=404, detail="Metrics are off (set RECOGNITION_METRICS=1)")
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
 
 @app.get("/", response_class=HTMLResponse)
 async def main(
@@ -64,11 +479,13 @@ async def main(
 
 @app.post("/identify/")
 async def identify(
+        response:Response,
         packet:VerifyPacket = None
     ) -> Dict:
     """Identify a face in a given frame.
 
     Args:
+        response (Response): The response (for the `Server-Timing` header).
         packet (VerifyPacket): The packet containing the frame and other information.
                                Defaults to None.
 
@@ -79,46 +496,302 @@ async def identify(
               to "nomatch".
             - "distance" (float): The distance between the identified person and the input frame.
             - "displayName" (str): A formatted string containing the name and distance.
+            - "timings" (dict): The time spent in each stage, in milliseconds.
+            - "trackId" (str): The face track ID sent by the client, if any.
+            - "cached" (bool): Only present (and True) when the recent result of the track was
+              reused.
 
     Raises:
         Exception: If there is an error uploading the frame.
+        HTTPException: With status 400 if the packet is empty (or has no frame or landmarks), or
+                       429 if the worker pool is saturated.
+    """
+    if packet is None or not packet.frame_enc or not packet.landmarks:
+        raise HTTPException(status_code=400, detail="Malformed request: can't send an empty packet")
+    return await recognize(lambda: recognition_pool.describe(packet.frame_enc, packet.bb,\
+                                                             packet.landmarks,\
+                                                             packet.name is None), packet,\
+                           "identify", response)
+
+@app.post("/identify/crop")
+async def identify_crop(
+        request:Request,
+        response:Response
+    ) -> Dict:
+    """Identify a face given only a (padded) crop of it, instead of the full frame.
+
+    The crop is sent as binary JPEG, WebP or PNG, either as the `crop` file of a multipart form
+    with the `CropPacket` as JSON in its `meta` field, or as the whole `application/octet-stream`
+    body with the `CropPacket` as JSON in the `X-Face-Meta` header. Coordinates are relative to
+    the crop.
+
+    Args:
+        request (Request): The request object.
+        response (Response): The response (for the `Server-Timing` header).
+
+    Returns:
+        dict: A dictionary containing the identification results (same as `/identify/`).
+
+    Raises:
+        HTTPException: With status 400 if the request is malformed, or 429 if the worker pool is
+                       saturated.
     """
-    if VerifyPacket is None:
-        raise ValueError("Can't send an empty packet")
     try:
-        frame_bin = base64.b64decode(packet.frame_enc.replace("data:image/png;base64,",""))
+        if request.headers.get('content-type', '').startswith('multipart/form-data'):
+            form = await request.form()
+            crop_bin = await form['crop'].read()
+            meta = form['meta']
+        else:
+            crop_bin = await request.body()
+            meta = request.headers['x-face-meta']
+        packet = CropPacket(**json.loads(meta))
     except Exception as exc:
-        return {"error": f"There was an error uploading the frame {exc}"}
-    frame_np = np.frombuffer(frame_bin, np.uint8)
-    frame_np = cv2.imdecode(frame_np, cv2.IMREAD_COLOR)
-    frame_rgb = cv2.cvtColor(frame_np, cv2.COLOR_BGR2RGB)
-    landmarks = [face_descriptor.convert_landmarks(packet.bb, packet.landmarks)]
-    descriptors = face_descriptor.represent(frame_rgb, landmarks)
-    if packet.name is not None:
-        name_cnt = face_identifier.count(packet.name)
-        if name_cnt < 10:
-            face_descriptor.add_to_vectordb(np.array(descriptors),\
-                                            ids=[packet.name])
-            face_identifier.reload_vectordb()
-            return {
-                "message":f"Added `{packet.name}` to the Vector DB"
-            }
+        raise HTTPException(status_code=400, detail=f"Malformed crop request: {exc}") from exc
+    return await recognize(lambda: recognition_pool.describe_crop(crop_bin, packet.bb,\
+                                                                  packet.landmarks,\
+                                                                  packet.name is None), packet,\
+                           "identify_crop", response)
+
+@app.websocket("/ws/session")
+async def session(
+        websocket:WebSocket
+    ) -> None:
+    """Recognize the faces of a client continuously over a WebSocket.
+
+    Each binary message holds a face crop: the length of its metadata (a big-endian uint32), the
+    metadata as JSON (a `CropPacket` with the `seq` number of the frame, coordinates relative to
+    the crop), and the encoded (JPEG, WebP, PNG...) crop. Each result is sent back as a JSON text
+    message with its `seq` (same as `/identify/`), or `{"seq", "trackId", "dropped": true}` for
+    a crop superseded by a newer one of the same track before it was processed.
+
+    Args:
+        websocket (WebSocket): The WebSocket of the session.
+
+    Returns:
+        None
+    """
+    await websocket.accept()
+    recognition_session = RecognitionSession(websocket)
+    sessions.add(recognition_session)
+    try:
+        while True:
+            message = await websocket.receive()
+            if message['type'] == 'websocket.disconnect':
+                break
+            try:
+                message_bin = message.get('bytes')
+                if message_bin is None:
+                    raise ValueError("expected a binary message")
+                (meta_len,) = SESSION_HEADER.unpack_from(message_bin)
+                meta_end = SESSION_HEADER.size + meta_len
+                packet = SessionPacket(**json.loads(message_bin[SESSION_HEADER.size:meta_end]))
+            except Exception as exc:
+                await recognition_session.send({"error": f"Malformed session message: {exc}"})
+                continue
+            await recognition_session.submit(packet, message_bin[meta_end:])
+    except WebSocketDisconnect:
+        pass
+    finally:
+        recognition_session.close()
+        sessions.discard(recognition_session)
+
+async def read_batch(
+        request:Request
+    ) -> Tuple[List[Union[bytes, str]], List[BatchItem]]:
+    """Reads the images of a batch request and their metadata.
+
+    The images are sent either as the `images` files of a multipart form, with a JSON array of
+    `BatchItem` (one per file, in order) in its optional `meta` field, or as NDJSON
+    (`application/x-ndjson`): one `BatchItem` per line with the base64 (data URL) encoded image
+    in its `image` field.
+
+    Args:
+        request (Request): The request object.
+
+    Returns:
+        Tuple[List[Union[bytes, str]], List[BatchItem]]: The encoded images (bytes or base64) and
+                                                         their metadata.
+
+    Raises:
+        HTTPException: With status 400 if the request is malformed or empty, or 413 if it has more
+                       than BATCH_MAX_ITEMS images.
+    """
+    try:
+        content_type = request.headers.get('content-type', '')
+        if content_type.startswith('multipart/form-data'):
+            form = await request.form()
+            images = [await upload.read() for upload in form.getlist('images')]
+            metas = json.loads(form['meta']) if 'meta' in form else [{}] * len(images)
+        elif content_type.startswith(('application/x-ndjson', 'application/jsonl')):
+            images, metas = [], []
+            for line in (await request.body()).splitlines():
+                if line.strip():
+                    meta = json.loads(line)
+                    images.append(meta.pop('image'))
+                    metas.append(meta)
         else:
-            packet.name = None
+            raise ValueError(f"unsupported content type `{content_type}`")
+        if len(metas) != len(images):
+            raise ValueError(f"{len(images)} images but {len(metas)} metadata")
+        items = [BatchItem(**meta) for meta in metas]
+    except Exception as exc:
+        raise HTTPException(status_code=400, detail=f"Malformed batch request: {exc}") from exc
+    if not images:
+        raise HTTPException(status_code=400, detail="Malformed batch request: no images")
+    if len(images) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Too many images ({len(images)}), the"
+                                                    f" maximum is {BATCH_MAX_ITEMS}")
+    return images, items
 
-    best_distances, best_neighbors = face_identifier.identify(descriptors, k=1)
-    for neighbors, distances in zip(best_neighbors, best_distances):
-        return {
-                "name": neighbors[0],
-                "distance": round(distances[0]*10000)/10000,
-                "displayName": f"{neighbors[0]} {distances[0]:.3f}",
-                "nameProvided": packet.name
-            }
-    return {
-        "name":"nomatch",
-        "distance":300,
-        "displayName": "NO MATCH"
-    }
+async def describe_chunks(
+        images:List[Union[bytes, str]],
+        items:List[BatchItem]
+    ) -> AsyncIterator[Tuple[List[int], np.ndarray, List[Optional[str]]]]:
+    """Computes the descriptors of a batch in chunks of BATCH_CHUNK_SIZE images (one task of the
+       worker pool each, with at most one chunk per worker in flight), yielding each chunk as it
+       completes.
+
+    Args:
+        images (List[Union[bytes, str]]): The encoded images.
+        items (List[BatchItem]): Their metadata.
+
+    Returns:
+        AsyncIterator[Tuple[List[int], np.ndarray, List[Optional[str]]]]: The indexes of the
+            images of each chunk, the descriptors of those without errors and the error of each.
+    """
+    semaphore = asyncio.Semaphore(recognition_pool.workers)
+
+    async def describe(indexes:List[int]):
+        metas = [{"bb": items[i].bb, "landmarks": items[i].landmarks} for i in indexes]
+        async with semaphore:
+            while True:
+                try:
+                    result = await recognition_pool.describe_batch([images[i] for i in indexes],\
+                                                                   metas)
+                    break
+                except PoolSaturated:
+                    # a batch waits for room instead of failing part way through its response
+                    await asyncio.sleep(BATCH_RETRY_DELAY)
+        descriptors, errors, timings = result
+        if REGISTRY.enabled:
+            for stage, ms in timings.items():
+                stage_histogram.observe(ms / 1000, stage)
+        return indexes, descriptors, errors
+
+    tasks = [asyncio.ensure_future(describe(list(range(start, min(start + BATCH_CHUNK_SIZE,\
+                                                                   len(images))))))\
+             for start in range(0, len(images), BATCH_CHUNK_SIZE)]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+@app.post("/identify/batch")
+async def identify_batch(
+        request:Request
+    ) -> StreamingResponse:
+    """Identify the face in each of many images or face crops (see `read_batch` for the format).
+
+    The descriptors are computed in chunks, each with a single batched call to the recognizer and
+    identified with a single search of the gallery, and the results are streamed back as NDJSON
+    as each chunk completes (so not in order).
+
+    Args:
+        request (Request): The request object.
+
+    Returns:
+        StreamingResponse: One JSON object per line with the "index" of the image in the request,
+                           its "id", and either the identification results (same as
+                           `/identify/`) or an "error" (i.e. when no face was found).
+
+    Raises:
+        HTTPException: With status 400 if the request is malformed, or 413 if it's too large.
+    """
+    images, items = await read_batch(request)
+
+    async def results() -> AsyncIterator[str]:
+        async for indexes, descriptors, errors in describe_chunks(images, items):
+            matches = iter(())
+            if descriptors.shape[0]:
+                # a single search for the whole chunk
+                best_distances, best_neighbors = await run_in_threadpool(\
+                                                    face_identifier.identify, descriptors, k=1)
+                matches = zip(best_neighbors, best_distances)
+            for index, error in zip(indexes, errors):
+                line = {"index": index, "id": items[index].id}
+                if error is not None:
+                    line["error"] = error
+                else:
+                    line.update(match_result(*next(matches)))
+                yield json.dumps(line) + '\n'
+
+    return StreamingResponse(results(), media_type='application/x-ndjson')
+
+@app.post("/enroll/batch")
+async def enroll_batch(
+        request:Request
+    ) -> StreamingResponse:
+    """Enroll the face in each of many images or face crops, under the `name` of each image
+       (see `read_batch` for the format).
+
+    The descriptors are computed in chunks, each with a single batched call to the recognizer, and
+    the errors are streamed back as NDJSON as each chunk completes. The faces are then added to
+    the gallery in a single write (one log record, one metadata transaction), up to
+    MAX_FACES_PER_NAME per name, and their results streamed back.
+
+    Args:
+        request (Request): The request object.
+
+    Returns:
+        StreamingResponse: One JSON object per line with the "index" of the image in the request,
+                           its "id" and "name", and either its "status" ("enrolled", or "skipped"
+                           when the name already has MAX_FACES_PER_NAME faces) or an "error".
+
+    Raises:
+        HTTPException: With status 400 if the request is malformed or an image has no name, or 413
+                       if it's too large.
+    """
+    images, items = await read_batch(request)
+    if any(not item.name for item in items):
+        raise HTTPException(status_code=400, detail="Malformed batch request: every image needs"
+                                                    " a `name` to enroll it under")
+
+    async def results() -> AsyncIterator[str]:
+        described = []
+        async for indexes, descriptors, errors in describe_chunks(images, items):
+            rows = iter(descriptors)
+            for index, error in zip(indexes, errors):
+                if error is not None:
+                    yield json.dumps({"index": index, "id": items[index].id,\
+                                      "name": items[index].name, "error": error}) + '\n'
+                else:
+                    described.append((index, next(rows)))
+        described.sort(key=lambda item: item[0])
+        accepted, skipped = [index for index, _ in described], []
+        status, error = "enrolled", None
+        if described:
+            # counted and added in a single write of the gallery (off the event loop), so
+            # concurrent enrollments of a name can't exceed MAX_FACES_PER_NAME
+            try:
+                descriptors = np.stack([descriptor for _, descriptor in described])
+                added = await run_in_threadpool(face_descriptor.add_to_vectordb, descriptors,\
+                                                ids=[items[index].name for index in accepted],\
+                                                max_per_name=MAX_FACES_PER_NAME)
+                skipped = [index for index, keep in zip(accepted, added) if not keep]
+                accepted = [index for index, keep in zip(accepted, added) if keep]
+            except Exception as exc:
+                status, error = None, f"There was an error enrolling the faces {exc}"
+        for index in accepted:
+            line = {"index": index, "id": items[index].id, "name": items[index].name}
+            line.update({"status": status} if error is None else {"error": error})
+            yield json.dumps(line) + '\n'
+        for index in skipped:
+            yield json.dumps({"index": index, "id": items[index].id, "name": items[index].name,\
+                              "status": "skipped"}) + '\n'
+
+    return StreamingResponse(results(), media_type='application/x-ndjson')
 
 if __name__ == "__main__":
     uvicorn.run(app, host='0.0.0.0', port=80)
@@ -33,7 +33,14 @@ function testSupport(supportedDevices) {
 
 // GLOBAL VARIABLES THAT STORE NAMES
 var nameProvided = null
-var nameMatch = null
+
+// GLOBAL VARIABLES THAT STORE FACE TRACKS
+/* Faces are tracked across frames by bounding box overlap and only (re-)identified when the
+   track is new, has moved a lot or its identity expired, with one request in flight per track
+   (`sessionMaxInFlight` crops over a session, as the server drops the superseded ones) */
+var tracks = []
+var nextTrackId = 0
+const sessionId = Math.random().toString(36).slice(2, 10);
 
 // IMPORTANT CONSTANTS
 /* UI Related */
@@ -61,6 +68,24 @@ const subset_idxs = [127, 234, 93, 215, 172, 136, 150, 176, 152, 400, 379,
     290, 33, 160, 158, 133, 153, 144, 362, 385, 386, 249, 373,
     380, 61, 39, 37, 11, 267, 269, 291, 321, 314, 17, 85, 181,
     78, 82, 13, 402, 308, 402, 14, 87]
+/* Upload protocol: 'session' streams a padded JPEG crop of each face over a WebSocket (falls
+   back to 'crop' when the socket closes), 'crop' sends them as binary multipart, 'frame' sends
+   the whole frame as a base64 PNG in JSON (legacy) */
+let uploadMode = 'session';
+const sessionMaxInFlight = 2;
+let socket = null;
+let nextSeq = 0;
+const sessionFrames = new Map();  // sequence number -> track of the crops in flight
+const cropPadding = 0.35;
+const cropType = 'image/jpeg';
+const cropQuality = 0.9;
+const cropCanvas = document.createElement('canvas');
+const cropCtx = cropCanvas.getContext('2d');
+/* For tracking */
+const trackMatchIoU = 0.3;      // minimum overlap to continue a track
+const trackMovedIoU = 0.5;      // re-identify when overlap with last identified box drops below
+const trackIdentityTTL = 2000;  // re-identify after (ms)
+const trackLostTTL = 1000;      // drop tracks unseen for (ms)
 
 // UTILITY FUNCTIONS FOR UI
 function showDialog() {
@@ -104,38 +129,183 @@ function drawName(canvasCtx, displayName, boundingBox, style){
     }
 }
 
-// FUNCTION TO IDENTIFY A FACE W/ AJAX
-function identify(imgDataURL, landmarks, boundingbox){
+// UTILITY FUNCTIONS FOR TRACKING
+function iou(a, b){
+    const ix = Math.max(0, Math.min(a[2], b[2]) - Math.max(a[0], b[0]));
+    const iy = Math.max(0, Math.min(a[3], b[3]) - Math.max(a[1], b[1]));
+    const inter = ix * iy;
+    const union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter;
+    return union > 0 ? inter / union : 0;
+}
+function matchTracks(boxes, now){
+    // Greedily continue the track that overlaps each box the most, or start a new one
+    let free = tracks.filter(track => now - track.lastSeen <= trackLostTTL);
+    const matched = boxes.map(box => {
+        let best = null;
+        let bestIoU = trackMatchIoU;
+        for (const track of free){
+            const overlap = iou(box, track.box);
+            if (overlap >= bestIoU){
+                best = track;
+                bestIoU = overlap;
+            }
+        }
+        if (best == null){
+            best = {id: `${sessionId}-${nextTrackId++}`, displayName: null, identifiedAt: 0,
+                    identifiedBox: null, inFlight: 0};
+        }
+        free = free.filter(track => track !== best);
+        best.box = box;
+        best.lastSeen = now;
+        return best;
+    });
+    tracks = matched.concat(free);
+    return matched;
+}
+function needsIdentification(track, now){
+    if (track.inFlight >= (sessionOpen() ? sessionMaxInFlight : 1)){
+        return false;
+    }
+    return nameProvided != null || track.identifiedBox == null ||
+           now - track.identifiedAt > trackIdentityTTL ||
+           iou(track.box, track.identifiedBox) < trackMovedIoU;
+}
+
+// FUNCTIONS TO IDENTIFY A FACE W/ AJAX
+function handleIdentification(track, data){
+    track.inFlight -= 1;
+    track.identifiedAt = performance.now();
+    if ('displayName' in data){
+        track.displayName = data.displayName
+        if (nameProvided != data.nameProvided){
+            nameProvided = data.nameProvided;
+        }
+    }else if ('message' in data){
+        console.log('Warning:', data.message);
+    }else if ('error' in data){
+        console.error('Error:', data.error);
+    }
+}
+function handleIdentificationError(track, error){
+    console.error('Error:', error);
+    track.inFlight -= 1;
+    track.identifiedBox = null;
+}
+function sendIdentification(track, url, options){
+    track.identifiedBox = track.box;
+    fetch(url, options)
+    .then(response => response.json())
+    .then(data => handleIdentification(track, data))
+    .catch(error => handleIdentificationError(track, error));
+}
+function identify(track, imgDataURL, landmarks, boundingbox){
     let dataToSend = {
         frame_enc: imgDataURL,
         bb:boundingbox,
         landmarks: landmarks,
-        name:nameProvided
+        name:nameProvided,
+        track_id: track.id
     };
-    fetch('/identify/', {
+    track.inFlight += 1;
+    sendIdentification(track, '/identify/', {
         method: 'POST',
         headers: {
             'Content-Type': 'application/json'
         },
         body: JSON.stringify(dataToSend)
-    })
-    .then(response => response.json())
-    .then(data => {
-        nameMatch = null
-        if ('displayName' in data){
-            nameMatch = data.displayName
-            if (nameProvided != data.nameProvided){
-                nameProvided = data.nameProvided;
-            }
-        }else if ('message' in data){
-            console.log('Warning:', data.message);
-        }else if ('error' in data){
-            console.error('Error:', data.error);
+    });
+}
+function getCropBox(boundingbox, width, height, padding=cropPadding){
+    // Square box around the face with the same padding as `crop_faces` on the server
+    const [x1, y1, x2, y2] = boundingbox;
+    const side = Math.max(x2 - x1, y2 - y1);
+    const size = Math.round(side * (1 + padding));
+    const minX = Math.max(0, Math.round((x1 + x2 - size) / 2));
+    const minY = Math.max(0, Math.round((y1 + y2 - size) / 2));
+    return {
+        minX: minX,
+        minY: minY,
+        width: Math.min(size, width - minX),
+        height: Math.min(size, height - minY)
+    };
+}
+function cropFace(track, image, landmarks, boundingbox, send){
+    // Encodes the padded crop of a face and passes it to `send` with its metadata
+    const crop = getCropBox(boundingbox, image.width, image.height);
+    if (crop.width <= 0 || crop.height <= 0){
+        return;
+    }
+    cropCanvas.width = crop.width;
+    cropCanvas.height = crop.height;
+    cropCtx.drawImage(image, crop.minX, crop.minY, crop.width, crop.height,
+                      0, 0, crop.width, crop.height);
+    const meta = {
+        bb: [boundingbox[0] - crop.minX, boundingbox[1] - crop.minY,
+             boundingbox[2] - crop.minX, boundingbox[3] - crop.minY],
+        landmarks: landmarks.map(([x, y]) => [x - crop.minX, y - crop.minY]),
+        name: nameProvided,
+        track_id: track.id
+    };
+    track.inFlight += 1;
+    cropCanvas.toBlob(blob => send(blob, meta), cropType, cropQuality);
+}
+function identifyCrop(track, image, landmarks, boundingbox){
+    cropFace(track, image, landmarks, boundingbox, (blob, meta) => {
+        const formData = new FormData();
+        formData.append('crop', blob, 'crop');
+        formData.append('meta', JSON.stringify(meta));
+        sendIdentification(track, '/identify/crop', {
+            method: 'POST',
+            body: formData
+        });
+    });
+}
+
+// FUNCTIONS TO IDENTIFY FACES OVER A WEBSOCKET SESSION
+function openSession(){
+    const protocol = location.protocol == 'https:' ? 'wss:' : 'ws:';
+    socket = new WebSocket(`${protocol}//${location.host}/ws/session`);
+    socket.binaryType = 'arraybuffer';
+    socket.onmessage = event => handleSessionMessage(JSON.parse(event.data));
+    socket.onclose = () => {
+        // The results of the crops in flight won't come anymore
+        sessionFrames.forEach(track => handleIdentificationError(track, 'Session closed'));
+        sessionFrames.clear();
+        socket = null;
+        uploadMode = 'crop';
+    };
+}
+function sessionOpen(){
+    return uploadMode == 'session' && socket != null && socket.readyState == WebSocket.OPEN;
+}
+function handleSessionMessage(data){
+    const track = sessionFrames.get(data.seq);
+    if (track === undefined){
+        console.error('Error:', data.error);
+        return;
+    }
+    sessionFrames.delete(data.seq);
+    if (data.dropped){
+        // Superseded by a newer crop of the track, whose result is still to come
+        track.inFlight -= 1;
+        return;
+    }
+    handleIdentification(track, data);
+}
+function identifySession(track, image, landmarks, boundingbox){
+    cropFace(track, image, landmarks, boundingbox, (blob, meta) => {
+        if (!sessionOpen()){
+            handleIdentificationError(track, 'Session closed');
+            return;
         }
-    })
-    .catch(error => {
-        console.error('Error:', error);
-        nameMatch = null
+        meta.seq = nextSeq++;
+        sessionFrames.set(meta.seq, track);
+        track.identifiedBox = track.box;
+        // [metadata length (big-endian uint32)][metadata JSON][crop]
+        const metaBytes = new TextEncoder().encode(JSON.stringify(meta));
+        const header = new DataView(new ArrayBuffer(4));
+        header.setUint32(0, metaBytes.length);
+        socket.send(new Blob([header, metaBytes, blob]));
     });
 }
 
@@ -143,33 +313,53 @@ function identify(imgDataURL, landmarks, boundingbox){
 function onResults(results) {
     document.body.classList.add("loaded");
     fpsControl.tick();
-    const imageDataURL = results.image.toDataURL('image/png');
+    const now = performance.now();
+    let imageDataURL = null;
     var width = results.image.width;
     var height = results.image.height;
     canvasCtx.save();
     canvasCtx.clearRect(0, 0, canvasElement.width, canvasElement.height);
     canvasCtx.drawImage(results.image, 0, 0, canvasElement.width, canvasElement.height);
     if (results.multiFaceLandmarks) {
-        for (const fullLandmarks of results.multiFaceLandmarks) {
-            var subsetLandmarks = subset_idxs.map(index => fullLandmarks[index]);
+        const faces = results.multiFaceLandmarks.map(fullLandmarks => {
+            const subsetLandmarks = subset_idxs.map(index => fullLandmarks[index]);
+            const bb = getBoundingBox(subsetLandmarks, width, height);
+            return {subsetLandmarks: subsetLandmarks,
+                    boundingBoxNorm: [bb.minX, bb.minY, bb.maxX, bb.maxY]};
+        });
+        const faceTracks = matchTracks(faces.map(face => face.boundingBoxNorm), now);
+        faces.forEach((face, i) => {
+            const track = faceTracks[i];
+            var subsetLandmarks = face.subsetLandmarks;
             drawingUtils.drawLandmarks(canvasCtx, subsetLandmarks, {color:"#30FF30", fillColor:"#30FF30", radius:2, lineWidth:0});
-            var subsetLandmarksNorm = subsetLandmarks.map(landmark => {
-                const x = Math.round(landmark.x * width);
-                const y = Math.round(landmark.y * height);
-                return [x, y];
-            });
-            var bb = getBoundingBox(subsetLandmarks, width, height);
-            var boundingBoxNorm = [bb.minX, bb.minY, bb.maxX, bb.maxY]
             var boundingBox = getBoundingBox(subsetLandmarks, canvasElement.width, canvasElement.height);
-            identify(imageDataURL, subsetLandmarksNorm, boundingBoxNorm)
+            if (needsIdentification(track, now)){
+                var subsetLandmarksNorm = subsetLandmarks.map(landmark => {
+                    const x = Math.round(landmark.x * width);
+                    const y = Math.round(landmark.y * height);
+                    return [x, y];
+                });
+                if (uploadMode == 'frame'){
+                    imageDataURL = imageDataURL || results.image.toDataURL('image/png');
+                    identify(track, imageDataURL, subsetLandmarksNorm, face.boundingBoxNorm)
+                }else if (sessionOpen()){
+                    identifySession(track, results.image, subsetLandmarksNorm, face.boundingBoxNorm)
+                }else{
+                    identifyCrop(track, results.image, subsetLandmarksNorm, face.boundingBoxNorm)
+                }
+            }
             drawBoundingBox(canvasCtx, boundingBox, {color:"#30FF30", lineWidth:2});
-            drawName(canvasCtx, nameMatch, boundingBox, {color:"#30FF30", font:"30px Arial"})
-        }
+            drawName(canvasCtx, track.displayName, boundingBox, {color:"#30FF30", font:"30px Arial"})
+        });
 
     }
     canvasCtx.restore();
 }
 
+if (uploadMode == 'session'){
+    openSession();
+}
+
 // FOR CONTROLING FACEMESH
 const faceMesh = new mpFaceMesh.FaceMesh(config);
 const solutionOptions = {
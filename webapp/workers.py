@@ -0,0 +1,383 @@
+"""Recognition Worker Pool (keeps CPU-bound work off the FastAPI event loop)"""
+# pylint: disable=E1101,C0413,W0603,W0718
+from typing import List, Tuple, Dict, Literal, Optional, Union
+import os
+import sys
+import time
+import base64
+import asyncio
+import itertools
+import threading
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+import cv2
+import numpy as np
+par_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, par_dir)
+from facial_recognition import FaceDetection, FaceAlignment, FaceRepresentation, FaceGallery,\
+                               landmarks_to_dlib
+from facial_recognition.cache import ResultCache, face_chip, chip_hash, same_chip
+
+# Defaults (overridable with environment variables of the same name)
+RECOGNITION_BACKEND = os.environ.get('RECOGNITION_BACKEND', 'thread')
+RECOGNITION_WORKERS = int(os.environ.get('RECOGNITION_WORKERS', os.cpu_count() or 1))
+RECOGNITION_MAX_PENDING = int(os.environ.get('RECOGNITION_MAX_PENDING',\
+                                             4 * RECOGNITION_WORKERS))
+DESCRIPTOR_CACHE_SIZE = int(os.environ.get('DESCRIPTOR_CACHE_SIZE', 1024))
+DESCRIPTOR_CACHE_TTL = float(os.environ.get('DESCRIPTOR_CACHE_TTL', 30.0))
+
+# Per-worker model instances (one per thread for threads, one per process for processes)
+_worker_state = threading.local()
+_worker_gallery:Optional[FaceGallery] = None
+# Recent (chip, descriptor, face key) by perceptual hash of the aligned face (one cache per worker
+# process)
+_descriptor_cache = ResultCache(DESCRIPTOR_CACHE_SIZE, DESCRIPTOR_CACHE_TTL)
+_face_keys = itertools.count()
+
+def _init_worker(
+        gallery:Optional[FaceGallery] = None
+    ) -> None:
+    """Initializes a worker (only the gallery for threads, which share the parent's memory)."""
+    global _worker_gallery
+    _worker_gallery = gallery
+
+def _face_descriptor() -> FaceRepresentation:
+    """Gets the face descriptor of the current worker, loading the model on first use."""
+    if getattr(_worker_state, 'face_descriptor', None) is None:
+        _worker_state.face_descriptor = FaceRepresentation(gallery=_worker_gallery)
+    return _worker_state.face_descriptor
+
+def _face_aligner() -> Tuple[FaceDetection, FaceAlignment]:
+    """Gets the face detector and aligner of the current worker (for images sent without
+       landmarks), loading the models on first use."""
+    if getattr(_worker_state, 'face_aligner', None) is None:
+        _worker_state.face_aligner = (FaceDetection(), FaceAlignment(static_image_mode=True))
+    return _worker_state.face_aligner
+
+def _decode(
+        image:Union[bytes, str]
+    ) -> np.ndarray:
+    """Decodes an encoded image, given as bytes or as a base64 (data URL) string, to RGB."""
+    if isinstance(image, str):
+        image = base64.b64decode(image.split(',', 1)[-1])
+    img = cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("The image couldn't be decoded")
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+def _describe(
+        img_bin:np.ndarray,
+        bb:List[int],
+        landmarks:List[List[int]],
+        timings:Dict[str,float],
+        cache:bool = True
+    ) -> Tuple[np.ndarray, Optional[str]]:
+    """Decodes an encoded image (PNG, JPEG, WebP...) and computes the descriptor of the face in it
+       (or, with `cache`, reuses the one of a near-duplicate face: same perceptual hash and
+       near-identical chip), adding the time spent in each stage to `timings`. Returns the
+       descriptor and the key of the face (the same for near-duplicates, None without `cache`)."""
+    stage_start = time.perf_counter()
+    img = cv2.imdecode(img_bin, cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("The image couldn't be decoded")
+    img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    timings['imdecode'] = (time.perf_counter() - stage_start) * 1000
+
+    face_descriptor = _face_descriptor()
+    stage_start = time.perf_counter()
+    face_landmarks = [face_descriptor.convert_landmarks(bb, landmarks)]
+    timings['landmarks'] = (time.perf_counter() - stage_start) * 1000
+
+    if cache:
+        stage_start = time.perf_counter()
+        chip = face_chip(img_rgb, face_landmarks[0])
+        hash_key = chip_hash(chip)
+        cached = _descriptor_cache.get(hash_key)
+        timings['hash'] = (time.perf_counter() - stage_start) * 1000
+        # a different face can have the same hash, so the chips must match too
+        if cached is not None and same_chip(chip, cached[0]):
+            return cached[1], cached[2]
+    stage_start = time.perf_counter()
+    descriptors = face_descriptor.represent(img_rgb, face_landmarks)
+    timings['represent'] = (time.perf_counter() - stage_start) * 1000
+    if not cache:
+        return descriptors, None
+    face_key = f"{hash_key}-{os.getpid()}-{next(_face_keys)}"
+    _descriptor_cache.set(hash_key, (chip, descriptors, face_key))
+    return descriptors, face_key
+
+def describe_face(
+        frame_enc:str,
+        bb:List[int],
+        landmarks:List[List[int]],
+        submitted:float,
+        cache:bool = True
+    ) -> Tuple[np.ndarray, Dict[str,float], Optional[str]]:
+    """Decodes a base64 frame and computes the descriptor of the face in it (runs in a worker).
+
+    Args:
+        frame_enc (str): The base64 (data URL) encoded frame.
+        bb (List[int]): The bounding box coordinates [x1, y1, x2, y2].
+        landmarks (List[List[int]]): The face landmarks coordinates [[x1, y1], [x2, y2], ...].
+        submitted (float): The time (`time.time()`) the work was submitted to the pool.
+        cache (bool): Whether to reuse the descriptor of a near-duplicate face (not when
+                      enrolling). Defaults to True.
+
+    Returns:
+        Tuple[np.ndarray, Dict[str,float], Optional[str]]: The (1, dimensions) descriptor, the
+                                                           time spent in each stage (in
+                                                           milliseconds) and the key of the face
+                                                           (None without `cache`).
+    """
+    timings = {'queue': (time.time() - submitted) * 1000}
+    stage_start = time.perf_counter()
+    frame_bin = base64.b64decode(frame_enc.split(',', 1)[-1])
+    frame_np = np.frombuffer(frame_bin, np.uint8)
+    timings['b64decode'] = (time.perf_counter() - stage_start) * 1000
+    descriptors, key = _describe(frame_np, bb, landmarks, timings, cache)
+    return descriptors, timings, key
+
+def describe_crop(
+        crop_bin:bytes,
+        bb:List[int],
+        landmarks:List[List[int]],
+        submitted:float,
+        cache:bool = True
+    ) -> Tuple[np.ndarray, Dict[str,float], Optional[str]]:
+    """Decodes a binary face crop and computes the descriptor of the face in it (runs in a worker).
+
+    Args:
+        crop_bin (bytes): The encoded (JPEG, WebP, PNG...) face crop.
+        bb (List[int]): The bounding box coordinates [x1, y1, x2, y2], relative to the crop.
+        landmarks (List[List[int]]): The face landmarks coordinates [[x1, y1], [x2, y2], ...],
+                                     relative to the crop.
+        submitted (float): The time (`time.time()`) the work was submitted to the pool.
+        cache (bool): Whether to reuse the descriptor of a near-duplicate face (not when
+                      enrolling). Defaults to True.
+
+    Returns:
+        Tuple[np.ndarray, Dict[str,float], Optional[str]]: The (1, dimensions) descriptor, the
+                                                           time spent in each stage (in
+                                                           milliseconds) and the key of the face
+                                                           (None without `cache`).
+    """
+    timings = {'queue': (time.time() - submitted) * 1000}
+    crop_np = np.frombuffer(crop_bin, np.uint8)
+    descriptors, key = _describe(crop_np, bb, landmarks, timings, cache)
+    return descriptors, timings, key
+
+def describe_batch(
+        images:List[Union[bytes, str]],
+        metas:List[Dict],
+        submitted:float
+    ) -> Tuple[np.ndarray, List[Optional[str]], Dict[str,float]]:
+    """Decodes many images and computes the descriptors of one face in each (runs in a worker).
+
+    The faces of images sent without landmarks are found on the worker (the largest face of the
+    image), and the descriptors of every face are computed in a single batched call to the
+    recognizer.
+
+    Args:
+        images (List[Union[bytes, str]]): The encoded (JPEG, WebP, PNG...) images or face crops,
+                                          as bytes or base64 (data URL) strings.
+        metas (List[Dict]): The `bb` and `landmarks` of the face in each image (both optional).
+        submitted (float): The time (`time.time()`) the work was submitted to the pool.
+
+    Returns:
+        Tuple[np.ndarray, List[Optional[str]], Dict[str,float]]: The (n, dimensions) descriptors
+                                                                 of the images without errors, in
+                                                                 order, the error of each image
+                                                                 (None if it has a descriptor)
+                                                                 and the time spent in each stage
+                                                                 (in milliseconds).
+    """
+    timings = {'queue': (time.time() - submitted) * 1000, 'imdecode': 0.0, 'landmarks': 0.0}
+    face_descriptor = _face_descriptor()
+    imgs_rgb, landmarks, errors = [], [], []
+    for image, meta in zip(images, metas):
+        try:
+            stage_start = time.perf_counter()
+            img_rgb = _decode(image)
+            timings['imdecode'] += (time.perf_counter() - stage_start) * 1000
+            stage_start = time.perf_counter()
+            if meta.get('landmarks'):
+                bb = meta.get('bb') or [0, 0, img_rgb.shape[1], img_rgb.shape[0]]
+                face_landmarks = face_descriptor.convert_landmarks(bb, meta['landmarks'])
+            else:
+                face_detector, landmark_predictor = _face_aligner()
+                faces, face_landmarks = landmark_predictor.align_array(img_rgb,\
+                                                               face_detector.detect(img_rgb))
+                if not faces:
+                    raise ValueError("No face was found")
+                largest = max(range(len(faces)), key=lambda i: faces[i].area())
+                face_landmarks = landmarks_to_dlib(face_landmarks[largest:largest+1],\
+                                                   [faces[largest]])[0]
+            timings['landmarks'] += (time.perf_counter() - stage_start) * 1000
+        except Exception as exc:
+            errors.append(str(exc))
+            continue
+        imgs_rgb.append(img_rgb)
+        landmarks.append([face_landmarks])
+        errors.append(None)
+    stage_start = time.perf_counter()
+    descriptors = face_descriptor.represent_batch(imgs_rgb, landmarks)
+    timings['represent'] = (time.perf_counter() - stage_start) * 1000
+    return descriptors, errors, timings
+
+class PoolSaturated(Exception):
+    """Raised when the pool already has as much pending work as it accepts"""
+
+class RecognitionPool:
+    """Class for the Pool of Workers that run the CPU-bound recognition stages
+
+    The 'thread' backend runs the workers in threads of the web server process, sharing its
+    gallery, while the 'process' backend runs them in separate processes (no GIL contention) that
+    each load their own model, but never the gallery. Either way the event loop only awaits the
+    result. Searches and enrollments, which need the gallery, run in the default thread pool.
+
+    At most `max_pending` requests can be queued or running at a time; beyond that `run` raises
+    `PoolSaturated` so that the server can answer with a 429 instead of queueing without bound.
+    """
+    def __init__(
+            self,
+            backend:Literal['thread', 'process'] = RECOGNITION_BACKEND,
+            workers:int = RECOGNITION_WORKERS,
+            max_pending:int = RECOGNITION_MAX_PENDING,
+            gallery:Optional[FaceGallery] = None
+        ) -> None:
+        self.backend = backend
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        if backend == 'thread':
+            _init_worker(gallery)
+            self.executor:Executor = ThreadPoolExecutor(workers,\
+                                                        thread_name_prefix='recognition')
+        elif backend == 'process':
+            self.executor:Executor = ProcessPoolExecutor(workers, initializer=_init_worker)
+        else:
+            raise ValueError(f"Unknown backend `{backend}`, must be 'thread' or 'process'")
+
+    async def run(
+            self,
+            func,
+            *args
+        ):
+        """Runs a function in the pool and awaits its result, respecting the bound on pending work.
+
+        Args:
+            func: The (picklable for processes) function to run.
+            *args: The arguments of the function.
+
+        Returns:
+            The result of the function.
+
+        Raises:
+            PoolSaturated: If `max_pending` requests are already queued or running.
+        """
+        if self.pending >= self.max_pending:
+            raise PoolSaturated(f"{self.pending} requests already pending")
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, func, *args)
+        finally:
+            self.pending -= 1
+
+    async def describe(
+            self,
+            frame_enc:str,
+            bb:List[int],
+            landmarks:List[List[int]],
+            cache:bool = True
+        ) -> Tuple[np.ndarray, Dict[str,float], Optional[str]]:
+        """Computes the descriptor of a face in a base64 encoded frame in the pool.
+
+        Args:
+            frame_enc (str): The base64 (data URL) encoded frame.
+            bb (List[int]): The bounding box coordinates [x1, y1, x2, y2].
+            landmarks (List[List[int]]): The face landmarks coordinates [[x1, y1], [x2, y2], ...].
+            cache (bool): Whether to reuse the descriptor of a near-duplicate face (not when
+                          enrolling). Defaults to True.
+
+        Returns:
+            Tuple[np.ndarray, Dict[str,float], Optional[str]]: The (1, dimensions) descriptor, the
+                                                               time spent in each stage (in
+                                                               milliseconds) and the key of the
+                                                               face (None without `cache`).
+
+        Raises:
+            PoolSaturated: If `max_pending` requests are already queued or running.
+        """
+        return await self.run(describe_face, frame_enc, bb, landmarks, time.time(), cache)
+
+    async def describe_crop(
+            self,
+            crop_bin:bytes,
+            bb:List[int],
+            landmarks:List[List[int]],
+            cache:bool = True
+        ) -> Tuple[np.ndarray, Dict[str,float], Optional[str]]:
+        """Computes the descriptor of a face in a binary face crop in the pool.
+
+        Args:
+            crop_bin (bytes): The encoded (JPEG, WebP, PNG...) face crop.
+            bb (List[int]): The bounding box coordinates [x1, y1, x2, y2], relative to the crop.
+            landmarks (List[List[int]]): The face landmarks coordinates [[x1, y1], [x2, y2], ...],
+                                         relative to the crop.
+            cache (bool): Whether to reuse the descriptor of a near-duplicate face (not when
+                          enrolling). Defaults to True.
+
+        Returns:
+            Tuple[np.ndarray, Dict[str,float], Optional[str]]: The (1, dimensions) descriptor, the
+                                                               time spent in each stage (in
+                                                               milliseconds) and the key of the
+                                                               face (None without `cache`).
+
+        Raises:
+            PoolSaturated: If `max_pending` requests are already queued or running.
+        """
+        return await self.run(describe_crop, crop_bin, bb, landmarks, time.time(), cache)
+
+    async def describe_batch(
+            self,
+            images:List[Union[bytes, str]],
+            metas:List[Dict]
+        ) -> Tuple[np.ndarray, List[Optional[str]], Dict[str,float]]:
+        """Computes the descriptors of one face in each of many images in the pool (as a single
+           task, with a single batched call to the recognizer).
+
+        Args:
+            images (List[Union[bytes, str]]): The encoded images or face crops, as bytes or base64
+                                              (data URL) strings.
+            metas (List[Dict]): The `bb` and `landmarks` of the face in each image (both
+                                optional, the largest face is found on the worker without them).
+
+        Returns:
+            Tuple[np.ndarray, List[Optional[str]], Dict[str,float]]: The descriptors of the images
+                                                                     without errors, the error of
+                                                                     each image and the time
+                                                                     spent in each stage.
+
+        Raises:
+            PoolSaturated: If `max_pending` requests are already queued or running.
+        """
+        return await self.run(describe_batch, images, metas, time.time())
+
+    def descriptor_cache_stats(self) -> Optional[Dict[str,int]]:
+        """Gets the counters of the descriptor cache shared by the worker threads.
+
+        Returns:
+            Optional[Dict[str,int]]: The counters (None with the process backend, where each
+                                     worker process has its own cache).
+        """
+        if self.backend != 'thread':
+            return None
+        return _descriptor_cache.stats()
+
+    def shutdown(self) -> None:
+        """Shuts the workers down.
+
+        Returns:
+            None
+        """
+        self.executor.shutdown(wait=False, cancel_futures=True)